@@ -0,0 +1,94 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Micro-benchmark of the date formatters of the Rtz report parser, compared to the strptime() path. Run it with :
+
+    python benchmarks/parser_formatters.py --server /path/to/openerp-server/bin
+
+The server path is needed because the parser imports the OpenERP report module. The directory containing this
+repository's modules is added to the path too, because the parser imports the rent module.
+"""
+
+import os
+import sys
+import imp
+import time
+import random
+import optparse
+import datetime
+
+SERVER_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def make_values(count, distinct):
+    begin = datetime.datetime(2011, 1, 1, 9, 0, 0)
+    pool = [(begin + datetime.timedelta(hours=random.randint(0, 24*365))).strftime(SERVER_DATETIME_FORMAT)
+            for i in range(distinct)]
+    return [random.choice(pool) for i in range(count)]
+
+def bench(name, function, values, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        for value in values:
+            function(value)
+        timings.append(time.time() - start)
+    best = min(timings)
+    print('%-28s %8.1f ms  %8.2f us/value' % (name, best * 1000, best * 1000000 / len(values)))
+    return best
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--server', help='Path of the OpenERP server sources (the bin directory)')
+    parser.add_option('--count', type='int', default=100000, help='Number of values formatted')
+    parser.add_option('--distinct', type='int', default=500, help='Number of distinct values')
+    parser.add_option('--repeat', type='int', default=5, help='Number of runs, the best one is kept')
+    options, args = parser.parse_args()
+
+    if options.server:
+        sys.path.insert(0, options.server)
+    addons_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sys.path.insert(0, addons_path)
+    path = os.path.join(addons_path, 'rent_rtz', 'reports', 'parser.py')
+    rtz_parser = imp.load_source('rent_rtz_parser', path)
+
+    values = make_values(options.count, options.distinct)
+    cache = rtz_parser.FormatCache()
+
+    def strptime_path(value):
+        return datetime.datetime.strptime(value, SERVER_DATETIME_FORMAT).strftime('%d/%m/%y')
+
+    def fast_path(value):
+        return rtz_parser.parse_server_datetime(value).strftime('%d/%m/%y')
+
+    def memoized_path(value):
+        result = cache.get(value)
+        if result is None:
+            result = fast_path(value)
+            cache.set(value, result)
+        return result
+
+    print('%d values, %d distinct' % (options.count, options.distinct))
+    reference = bench('strptime + strftime', strptime_path, values, options.repeat)
+    fast = bench('fast parser + strftime', fast_path, values, options.repeat)
+    memoized = bench('memoized fast parser', memoized_path, values, options.repeat)
+    print('Speedup: fast parser x%.1f, memoized x%.1f' % (reference / fast, reference / memoized))
+
+if __name__ == '__main__':
+    main()
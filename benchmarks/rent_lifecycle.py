@@ -0,0 +1,268 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Synthetic-load benchmark of the rent order lifecycle. It generates partners, rentable products and rent orders into
+an existing database where the rent module is installed, times the hot paths, and saves the results as JSON :
+
+    python benchmarks/rent_lifecycle.py --server /path/to/openerp-server/bin --config ~/.openerp_serverrc \\
+        --database bench --partners 200 --products 100 --orders 1000 --output results-0.4.json
+
+By default, everything is done in one transaction which is rolled back at the end, so the database is left
+unchanged. Two results files can be compared with :
+
+    python benchmarks/rent_lifecycle.py --compare results-0.4.json results-0.5.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import optparse
+
+SERVER_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Lines count of generated orders : most orders have few lines, some have a lot.
+LINES_COUNTS = [1] * 20 + [2] * 20 + [3] * 15 + [4] * 10 + [5] * 10 + [8] * 10 + [12] * 10 + [25] * 5
+
+# (unity name, min duration, max duration, weight)
+DURATIONS = [('Day', 1, 30, 70), ('Month', 2, 12, 25), ('Year', 1, 3, 5)]
+
+class Benchmark(object):
+
+    def __init__(self, cr, pool, uid, seed):
+        self.cr = cr
+        self.pool = pool
+        self.uid = uid
+        self.random = random.Random(seed)
+        self.results = {}
+
+    def timed(self, name, count, function, *args):
+        start = time.time()
+        result = function(*args)
+        seconds = time.time() - start
+        self.results[name] = {
+            'seconds' : seconds,
+            'count' : count,
+            'ms_per_item' : count and seconds * 1000.0 / count or 0.0,
+        }
+        print('%-32s %6d items %10.3f s %10.3f ms/item' % (name, count, seconds, self.results[name]['ms_per_item']))
+        return result
+
+    def unity_ids(self):
+        cr = self.cr
+        cr.execute("""
+            SELECT uom.name, uom.id FROM product_uom uom JOIN product_uom_categ categ ON categ.id = uom.category_id
+            WHERE categ.name = 'Duration'
+        """)
+        return dict(cr.fetchall())
+
+    def shop_id(self):
+        shop_ids = self.pool.get('sale.shop').search(self.cr, self.uid, [], limit=1, order='id')
+        if not shop_ids:
+            raise Exception('The database has no shop, rent orders can not be created.')
+        return shop_ids[0]
+
+    def get_addresses(self, partner_ids):
+        partner_pool = self.pool.get('res.partner')
+        # get_rent_addresses() is new in 0.5, older versions use the standard address_get()
+        if hasattr(partner_pool, 'get_rent_addresses'):
+            return partner_pool.get_rent_addresses(self.cr, self.uid, partner_ids)
+        return dict((partner_id, partner_pool.address_get(self.cr, self.uid, [partner_id],
+            ['default', 'invoice', 'delivery'])) for partner_id in partner_ids)
+
+    def make_partners(self, count):
+        partner_pool, address_pool = self.pool.get('res.partner'), self.pool.get('res.partner.address')
+        ids = []
+        for i in range(count):
+            partner_id = partner_pool.create(self.cr, self.uid, {'name' : 'Bench Customer %d' % i, 'customer' : True})
+            address_pool.create(self.cr, self.uid, {'partner_id' : partner_id, 'type' : 'default',
+                'name' : 'Bench Contact %d' % i, 'city' : 'Lyon'})
+            # A third of the customers have distinct invoice and delivery addresses
+            if i % 3 == 0:
+                for address_type in ('invoice', 'delivery'):
+                    address_pool.create(self.cr, self.uid, {'partner_id' : partner_id, 'type' : address_type,
+                        'name' : 'Bench %s %d' % (address_type, i), 'city' : 'Paris'})
+            ids.append(partner_id)
+        return ids
+
+    def make_products(self, count, unities):
+        product_pool = self.pool.get('product.product')
+        ids = []
+        for i in range(count):
+            # 70% of stockable products, 20% of consumables and 10% of rented services
+            product_type = self.random.choice(['product'] * 7 + ['consu'] * 2 + ['service'])
+            ids.append(product_pool.create(self.cr, self.uid, {
+                'name' : 'Bench Product %d' % i,
+                'type' : product_type,
+                'can_be_rent' : True,
+                'sale_ok' : True,
+                'rent_price' : self.random.randint(5, 500),
+                'rent_price_unity' : unities[self.random.choice(['Day'] * 8 + ['Month'] * 2)],
+                'standard_price' : self.random.randint(50, 5000),
+                'list_price' : self.random.randint(100, 8000),
+            }))
+        return ids
+
+    def make_orders(self, count, partner_ids, product_ids, unities, shop_id):
+        order_pool = self.pool.get('rent.order')
+        line_pool = self.pool.get('rent.order.line')
+        addresses = self.get_addresses(partner_ids)
+        durations = sum([[(name, low, high)] * weight for name, low, high, weight in DURATIONS], [])
+        ids = []
+
+        for i in range(count):
+            partner_id = self.random.choice(partner_ids)
+            unity, low, high = self.random.choice(durations)
+            duration = self.random.randint(low, high)
+            begin = datetime.datetime.now() + datetime.timedelta(days=self.random.randint(-60, 60), hours=1)
+            begin_str = begin.strftime(SERVER_DATETIME_FORMAT)
+            values = order_pool.on_duration_changed(self.cr, self.uid, [], begin_str, duration, unities[unity],
+                shop_id)
+            address = addresses[partner_id]
+
+            lines = []
+            for product_id in self.random.sample(product_ids, min(len(product_ids), self.random.choice(LINES_COUNTS))):
+                line_values = line_pool.on_product_changed(self.cr, self.uid, [], product_id, 1)['value']
+                line_values.update({'product_id' : product_id, 'quantity' : self.random.randint(1, 10)})
+                line_values.pop('product_id_uom', None) # Related field, writing it would modify the product
+                line_values['tax_ids'] = [(6, 0, line_values['tax_ids'])]
+                lines.append((0, 0, line_values))
+
+            ids.append(order_pool.create(self.cr, self.uid, {
+                'shop_id' : shop_id,
+                'partner_id' : partner_id,
+                'partner_order_address_id' : address['default'],
+                'partner_invoice_address_id' : address['invoice'] or address['default'],
+                'partner_shipping_address_id' : address['delivery'] or address['default'],
+                'date_created' : (begin - datetime.timedelta(days=1)).strftime(SERVER_DATETIME_FORMAT),
+                'date_begin_rent' : begin_str,
+                'date_out_shipping' : begin_str,
+                'date_in_shipping' : values['value']['date_in_shipping'],
+                'rent_duration' : duration,
+                'rent_duration_unity' : unities[unity],
+                'rent_line_ids' : lines,
+            }))
+
+        return ids
+
+    def run(self, partners, products, orders):
+        cr, uid = self.cr, self.uid
+        order_pool = self.pool.get('rent.order')
+        line_pool = self.pool.get('rent.order.line')
+        unities = self.unity_ids()
+        shop_id = self.shop_id()
+
+        partner_ids = self.timed('generate_partners', partners, self.make_partners, partners)
+        product_ids = self.timed('generate_products', products, self.make_products, products, unities)
+        order_ids = self.timed('generate_orders', orders, self.make_orders, orders, partner_ids, product_ids, unities,
+            shop_id)
+        cr.execute('SELECT id FROM rent_order_line WHERE order_id IN %s', (tuple(order_ids),))
+        line_ids = [row[0] for row in cr.fetchall()]
+
+        self.timed('get_totals', len(order_ids), order_pool.get_totals, cr, uid, order_ids, None, None, {})
+        self.timed('get_prices', len(line_ids), line_pool.get_prices, cr, uid, line_ids, None, None, {})
+        self.timed('get_end_date', len(order_ids), order_pool.get_end_date, cr, uid, order_ids, None, None, {})
+
+        # Half of the orders are confirmed, to be invoiced and shipped. The others are cancelled.
+        confirmed_ids = order_ids[:len(order_ids) // 2]
+        cancelled_ids = order_ids[len(order_ids) // 2:]
+        order_pool.write(cr, uid, confirmed_ids, {'state' : 'confirmed'})
+
+        self.timed('run_cron_make_invoices', len(confirmed_ids), order_pool.run_cron_make_invoices, cr, uid, {})
+        self.timed('run_cron_start_stop_rents', len(order_ids), order_pool.run_cron_start_stop_rents, cr, uid, {})
+
+        cr.execute("SELECT id FROM rent_order WHERE id IN %s AND NOT is_service_only AND state = 'confirmed'",
+            (tuple(confirmed_ids),))
+        shipped_ids = [row[0] for row in cr.fetchall()]
+        if shipped_ids:
+            self.timed('action_generate_out_move', len(shipped_ids), order_pool.action_generate_out_move,
+                cr, uid, shipped_ids)
+            self.timed('action_ongoing', len(shipped_ids), order_pool.action_ongoing, cr, uid, shipped_ids)
+
+        self.timed('action_cancel', len(cancelled_ids), order_pool.action_cancel, cr, uid, cancelled_ids)
+        return self.results
+
+def get_module_version(cr):
+    cr.execute("SELECT latest_version FROM ir_module_module WHERE name = 'rent'")
+    row = cr.fetchone()
+    return row and row[0] or None
+
+def compare(old_path, new_path):
+    old, new = json.load(open(old_path)), json.load(open(new_path))
+    print('%-32s %12s %12s %8s' % ('', old.get('version'), new.get('version'), 'ratio'))
+    for name in sorted(set(old['results']) & set(new['results'])):
+        old_ms, new_ms = old['results'][name]['ms_per_item'], new['results'][name]['ms_per_item']
+        print('%-32s %9.3f ms %9.3f ms %7.2fx' % (name, old_ms, new_ms, old_ms and new_ms / old_ms or 0.0))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--server', help='Path of the OpenERP server sources (the bin directory)')
+    parser.add_option('--config', help='The OpenERP server configuration file (database connection)')
+    parser.add_option('--database', help='The database to use, the rent module must be installed')
+    parser.add_option('--partners', type='int', default=100)
+    parser.add_option('--products', type='int', default=50)
+    parser.add_option('--orders', type='int', default=500)
+    parser.add_option('--seed', type='int', default=42, help='Random seed, to generate the same data again')
+    parser.add_option('--output', help='The JSON file where results are saved')
+    parser.add_option('--keep', action='store_true', help='Commit the generated data instead of rolling back')
+    parser.add_option('--compare', nargs=2, help='Compare two results files')
+    options, args = parser.parse_args()
+
+    if options.compare:
+        return compare(*options.compare)
+    if not options.server or not options.database:
+        parser.error('--server and --database are required')
+
+    sys.path.insert(0, options.server)
+    import tools
+    tools.config.parse_config(options.config and ['-c', options.config] or [])
+    import pooler
+
+    db, pool = pooler.get_db_and_pool(options.database)
+    cr = db.cursor()
+    try:
+        benchmark = Benchmark(cr, pool, 1, options.seed)
+        results = benchmark.run(options.partners, options.products, options.orders)
+        version = get_module_version(cr)
+        if options.keep:
+            cr.commit()
+        else:
+            cr.rollback()
+    finally:
+        cr.close()
+
+    if options.output:
+        output = open(options.output, 'w')
+        try:
+            json.dump({
+                'version' : version,
+                'date' : datetime.datetime.now().strftime(SERVER_DATETIME_FORMAT),
+                'parameters' : {'partners' : options.partners, 'products' : options.products,
+                                'orders' : options.orders, 'seed' : options.seed},
+                'results' : results,
+            }, output, indent=4, sort_keys=True)
+        finally:
+            output.close()
+        print('Results saved to %s' % options.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+--
+-- Migration script from 0.4 to 0.5
+--
+-- This script must be applied before you restart OpenERP with the new 0.5
+-- version. If you updated first, the archive tables already exist, and only
+-- the archival of the old orders is done. It can be applied several times.
+-- To apply this file, run :
+--
+--      psql -f Migrate-0.4-To-0.5.sql <database>
+--
+-- It can be reverted with Revert-0.5-To-0.4.sql.
+--
+
+BEGIN;
+
+-- Helpers, dropped at the end of the session
+CREATE FUNCTION pg_temp.rent_add_primary_key(tablename text) RETURNS void AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = tablename::regclass AND contype = 'p') THEN
+        EXECUTE 'ALTER TABLE ' || quote_ident(tablename) || ' ADD PRIMARY KEY (id)';
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION pg_temp.rent_create_index(indexname text, tablename text, columnname text) RETURNS void AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_class WHERE relname = indexname AND relkind = 'i') THEN
+        EXECUTE 'CREATE INDEX ' || quote_ident(indexname) || ' ON ' || quote_ident(tablename)
+            || ' (' || quote_ident(columnname) || ')';
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Copies the rows with the columns of the target which exist in the source, by name : the
+-- columns added by an update are not in the same order in both tables.
+CREATE FUNCTION pg_temp.rent_copy_rows(source text, target text, condition text) RETURNS void AS $$
+DECLARE
+    columns text;
+BEGIN
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+    FROM pg_attribute
+    WHERE attrelid = target::regclass AND attnum > 0 AND NOT attisdropped
+        AND attname IN (SELECT attname FROM pg_attribute
+                        WHERE attrelid = source::regclass AND attnum > 0 AND NOT attisdropped);
+    EXECUTE 'INSERT INTO ' || quote_ident(target) || ' (' || columns || ') SELECT ' || columns
+        || ' FROM ' || quote_ident(source) || ' WHERE ' || condition;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Archive tables : same columns as the current tables, but no constraints.
+CREATE TABLE IF NOT EXISTS rent_order_archive (LIKE rent_order INCLUDING DEFAULTS);
+SELECT pg_temp.rent_add_primary_key('rent_order_archive');
+SELECT pg_temp.rent_create_index('rent_order_archive_partner_id_index', 'rent_order_archive', 'partner_id');
+SELECT pg_temp.rent_create_index('rent_order_archive_date_begin_rent_index', 'rent_order_archive', 'date_begin_rent');
+
+CREATE TABLE IF NOT EXISTS rent_order_line_archive (LIKE rent_order_line INCLUDING DEFAULTS);
+SELECT pg_temp.rent_add_primary_key('rent_order_line_archive');
+SELECT pg_temp.rent_create_index('rent_order_line_archive_order_id_index', 'rent_order_line_archive', 'order_id');
+
+CREATE TABLE IF NOT EXISTS rent_order_invoices_archive (LIKE rent_order_invoices INCLUDING DEFAULTS);
+SELECT pg_temp.rent_create_index('rent_order_invoices_archive_rent_order_id_index',
+    'rent_order_invoices_archive', 'rent_order_id');
+
+CREATE TABLE IF NOT EXISTS rent_order_line_taxes_archive (LIKE rent_order_line_taxes INCLUDING DEFAULTS);
+SELECT pg_temp.rent_create_index('rent_order_line_taxes_archive_rent_order_line_id_index',
+    'rent_order_line_taxes_archive', 'rent_order_line_id');
+
+-- Archive the done and cancelled orders which ended more than 2 years ago (the default of the
+-- 'rent_archive_days' option). The links are moved first, because deleting the orders deletes them.
+CREATE TEMPORARY TABLE rent_order_to_archive AS
+    SELECT id FROM rent_order
+    WHERE state IN ('done', 'cancelled') AND date_end_rent < now() - interval '730 days';
+
+SELECT pg_temp.rent_copy_rows('rent_order_line_taxes', 'rent_order_line_taxes_archive',
+    'rent_order_line_id IN (SELECT id FROM rent_order_line WHERE order_id IN (SELECT id FROM rent_order_to_archive))');
+SELECT pg_temp.rent_copy_rows('rent_order_invoices', 'rent_order_invoices_archive',
+    'rent_order_id IN (SELECT id FROM rent_order_to_archive)');
+SELECT pg_temp.rent_copy_rows('rent_order_line', 'rent_order_line_archive',
+    'order_id IN (SELECT id FROM rent_order_to_archive)');
+SELECT pg_temp.rent_copy_rows('rent_order', 'rent_order_archive',
+    'id IN (SELECT id FROM rent_order_to_archive)');
+
+-- The production lots of the lines only exist if you updated first
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'rent_order_line_lots' AND relkind = 'r') THEN
+        CREATE TABLE IF NOT EXISTS rent_order_line_lots_archive (LIKE rent_order_line_lots INCLUDING DEFAULTS);
+        PERFORM pg_temp.rent_create_index('rent_order_line_lots_archive_rent_order_line_id_index',
+            'rent_order_line_lots_archive', 'rent_order_line_id');
+        PERFORM pg_temp.rent_copy_rows('rent_order_line_lots', 'rent_order_line_lots_archive',
+            'rent_order_line_id IN (SELECT id FROM rent_order_line WHERE order_id IN '
+            || '(SELECT id FROM rent_order_to_archive))');
+    END IF;
+END;
+$$;
+
+-- Deleting the orders deletes their lines, taxes, invoices and lots links in cascade
+DELETE FROM rent_order WHERE id IN (SELECT id FROM rent_order_to_archive);
+
+COMMIT;
@@ -0,0 +1,43 @@
+--
+-- Revert script from 0.5 to 0.4
+--
+-- This script moves all the archived rent orders back to the current tables,
+-- and drops the archive tables. Apply it before you restart OpenERP with the
+-- 0.4 version :
+--
+--      psql -f Revert-0.5-To-0.4.sql <database>
+--
+-- The columns are copied by name : the columns added by an update are not in
+-- the same order in the archive tables and in the current tables.
+--
+
+BEGIN;
+
+-- Helper, dropped at the end of the session
+CREATE FUNCTION pg_temp.rent_copy_rows(source text, target text) RETURNS void AS $$
+DECLARE
+    columns text;
+BEGIN
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+    FROM pg_attribute
+    WHERE attrelid = target::regclass AND attnum > 0 AND NOT attisdropped
+        AND attname IN (SELECT attname FROM pg_attribute
+                        WHERE attrelid = source::regclass AND attnum > 0 AND NOT attisdropped);
+    EXECUTE 'INSERT INTO ' || quote_ident(target) || ' (' || columns || ') SELECT ' || columns
+        || ' FROM ' || quote_ident(source);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT pg_temp.rent_copy_rows('rent_order_archive', 'rent_order');
+SELECT pg_temp.rent_copy_rows('rent_order_line_archive', 'rent_order_line');
+SELECT pg_temp.rent_copy_rows('rent_order_invoices_archive', 'rent_order_invoices');
+SELECT pg_temp.rent_copy_rows('rent_order_line_taxes_archive', 'rent_order_line_taxes');
+
+-- The production lots of the lines don't exist in 0.4
+DROP TABLE IF EXISTS rent_order_line_lots_archive;
+DROP TABLE rent_order_line_taxes_archive;
+DROP TABLE rent_order_invoices_archive;
+DROP TABLE rent_order_line_archive;
+DROP TABLE rent_order_archive;
+
+COMMIT;
@@ -22,7 +22,22 @@ GITHUB_USER = 'WE2BS'
 GITHUB_REPO = 'openerp-rent'
 
 import intervals
+import profiling
+import sequence
 import company
 import rent
 import product
-
+import partner
+import pricelist
+import repricing
+import metrics
+import bulk
+import export
+import renewal
+import archive
+import validation
+import analytics
+import lots
+import report_cache
+import batch_print
+import diagnostics
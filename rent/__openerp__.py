@@ -19,7 +19,7 @@
 
 {
     "name": "Rent",
-    "version": "0.4",
+    "version": "0.5",
     "author": "UIDE/WE2BS",
     "category": "Generic Modules/Sales & Purchases",
     "website": "https://github.com/thibautd/openerp-rent",
@@ -32,7 +32,9 @@
     "demo_xml": [],
     "update_xml": ['data/uoms.xml', 'data/intervals.xml', 'views/rent.xml', 'views/product.xml', 'views/menus.xml',
                    'views/sequence.xml', 'views/company.xml', 'workflow/rent.xml', 'security/ir.model.access.csv',
-                   'reports/reports.xml', 'data/cron.xml'],
+                   'reports/reports.xml', 'data/cron.xml', 'views/batch_print.xml',
+                   'views/renewal.xml', 'views/pricelist.xml',
+                   'views/analytics.xml', 'views/lots.xml'],
     "active": False,
     "test": [],
     "installable": True
@@ -0,0 +1,240 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+import hashlib
+import logging
+
+from osv import osv, fields
+from tools.translate import _
+
+from profiling import report_bugs
+from archive import table_exists
+
+_logger = logging.getLogger('rent')
+
+# The states of the orders whose products are booked.
+BOOKED_STATES = ('confirmed', 'ongoing', 'done')
+
+# Materialized views can be refreshed concurrently since PostgreSQL 9.4. With older versions, a table is used,
+# and filled again in the refresh transaction : the readers still see the old rows until it's committed.
+MATERIALIZED_VIEW_VERSION = 90400
+
+# The booked lines, of the current orders and of the archived ones (see rent.archive).
+BOOKINGS_QUERY = """
+        SELECT l.product_id, o.date_begin_rent AS date_begin, o.date_end_rent AS date_end, l.quantity,
+            EXTRACT(EPOCH FROM o.date_end_rent - o.date_begin_rent) / 86400.0 AS days,
+            CASE WHEN price_unity.id IS NULL OR order_unity.id IS NULL
+                OR price_unity.category_id <> order_unity.category_id THEN l.unit_price
+                ELSE l.unit_price * price_unity.factor / order_unity.factor END AS price,
+            COALESCE(l.discount, 0) AS discount,
+            %(rent_price)s AS factor
+        FROM %(lines)s l
+        JOIN %(orders)s o ON o.id = l.order_id
+        JOIN product_product product ON product.id = l.product_id
+        LEFT JOIN product_uom price_unity ON price_unity.id = product.rent_price_unity
+        LEFT JOIN product_uom order_unity ON order_unity.id = o.rent_duration_unity
+        WHERE l.product_type = 'rent' AND o.state IN %(states)s AND o.date_end_rent > o.date_begin_rent
+"""
+
+UTILIZATION_QUERY = """
+    WITH bookings AS (%(bookings)s),
+    booked AS (
+        SELECT product_id, month,
+            SUM(quantity * overlap) AS days_booked,
+            SUM(price * factor * (1 - discount / 100.0) * quantity * overlap / days) AS booked_revenue
+        FROM (
+            SELECT b.*, month.month::date AS month,
+                EXTRACT(EPOCH FROM LEAST(b.date_end, month.month + interval '1 month')
+                    - GREATEST(b.date_begin, month.month)) / 86400.0 AS overlap
+            FROM bookings b, generate_series(date_trunc('month', b.date_begin), b.date_end, interval '1 month')
+                AS month(month)
+            WHERE month.month < b.date_end
+        ) periods
+        GROUP BY product_id, month
+    ),
+    invoiced AS (
+        SELECT line.product_id, date_trunc('month', invoice.date_invoice)::date AS month,
+            SUM(CASE WHEN invoice.type = 'out_refund' THEN -line.price_subtotal ELSE line.price_subtotal END)
+                AS invoiced_revenue
+        FROM account_invoice_line line
+        JOIN account_invoice invoice ON invoice.id = line.invoice_id
+        WHERE invoice.state IN ('open', 'paid') AND line.product_id IS NOT NULL AND invoice.date_invoice IS NOT NULL
+            AND invoice.id IN (%(invoices)s)
+        GROUP BY line.product_id, date_trunc('month', invoice.date_invoice)
+    ),
+    fleet AS (
+        -- The units owned : the done moves between the internal locations and the others, in the product unity.
+        -- The shipping of the rent orders moves the products out, but they are still owned.
+        SELECT move.product_id, SUM(CASE WHEN destination.usage = 'internal' THEN 1 ELSE -1 END
+            * move.product_qty * product_unity.factor / move_unity.factor) AS units
+        FROM stock_move move
+        JOIN stock_location source ON source.id = move.location_id
+        JOIN stock_location destination ON destination.id = move.location_dest_id
+        JOIN product_product product ON product.id = move.product_id
+        JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+        JOIN product_uom product_unity ON product_unity.id = tmpl.uom_id
+        JOIN product_uom move_unity ON move_unity.id = move.product_uom
+        WHERE move.state = 'done' AND product.can_be_rent
+            AND (source.usage = 'internal') <> (destination.usage = 'internal')
+            AND (move.picking_id IS NULL OR move.picking_id NOT IN (%(pickings)s))
+        GROUP BY move.product_id
+    )
+    SELECT row_number() OVER (ORDER BY product_id, month)::integer AS id, stats.*,
+        CASE WHEN available_days > 0 THEN days_booked * 100.0 / available_days ELSE 0.0 END AS utilization
+    FROM (
+        SELECT COALESCE(booked.product_id, invoiced.product_id) AS product_id, tmpl.categ_id,
+            COALESCE(booked.month, invoiced.month) AS month,
+            to_char(COALESCE(booked.month, invoiced.month), 'YYYY-MM') AS month_name,
+            COALESCE(fleet.units, 0) AS units,
+            COALESCE(fleet.units, 0) * EXTRACT(DAY FROM COALESCE(booked.month, invoiced.month)
+                + interval '1 month' - interval '1 day') AS available_days,
+            COALESCE(booked.days_booked, 0) AS days_booked,
+            COALESCE(booked.booked_revenue, 0) AS booked_revenue,
+            COALESCE(invoiced.invoiced_revenue, 0) AS invoiced_revenue
+        FROM booked
+        FULL OUTER JOIN invoiced ON invoiced.product_id = booked.product_id AND invoiced.month = booked.month
+        JOIN product_product product ON product.id = COALESCE(booked.product_id, invoiced.product_id)
+        JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+        LEFT JOIN fleet ON fleet.product_id = product.id
+        WHERE product.can_be_rent
+    ) stats
+"""
+
+# (name, columns, unique) : the unique index is required to refresh the materialized view concurrently.
+UTILIZATION_INDEXES = [
+    ('rent_product_utilization_product_month_index', 'product_id, month', True),
+    ('rent_product_utilization_month_index', 'month', False),
+    ('rent_product_utilization_categ_id_index', 'categ_id', False),
+]
+
+class RentProductUtilization(osv.osv):
+
+    """
+    Utilization and revenue of the rentable products, by month. The rows are computed by a materialized view (see
+    UTILIZATION_QUERY), refreshed by a cron, so the analysis views read precomputed rows :
+
+        days_booked : The days booked by the confirmed, ongoing and done orders, archived ones included (quantity *
+            days of the month)
+        units : The units owned, from the done stock moves (the rent orders shipping excluded)
+        utilization : The days booked, in percentage of the days of the month of all the units owned
+        booked_revenue : The rent price of the booked days (before taxes and order discount)
+        invoiced_revenue : The amount of the confirmed invoices of the rent orders, by invoice date
+    """
+
+    def _get_query(self, cr):
+        rent_price = self.pool.get('rent.order.line')._get_export_rent_price_sql(cr, 1)
+        states = "('%s')" % "', '".join(BOOKED_STATES)
+        tables = [('rent_order', 'rent_order_line', 'rent_order_invoices')]
+        archives = ('rent_order_archive', 'rent_order_line_archive', 'rent_order_invoices_archive')
+        if [table for table in archives if table_exists(cr, table)] == list(archives):
+            tables.append(archives)
+        bookings, invoices, pickings = [], [], []
+        for orders, lines, orders_invoices in tables:
+            bookings.append(BOOKINGS_QUERY % {'orders' : orders, 'lines' : lines, 'states' : states,
+                'rent_price' : rent_price % {'price' : '1.0'}})
+            invoices.append('SELECT invoice_id FROM %s' % orders_invoices)
+            pickings.append('SELECT out_picking_id FROM %s WHERE out_picking_id IS NOT NULL' % orders)
+            pickings.append('SELECT in_picking_id FROM %s WHERE in_picking_id IS NOT NULL' % orders)
+        return UTILIZATION_QUERY % {'bookings' : ' UNION ALL '.join(bookings),
+            'invoices' : ' UNION ALL '.join(invoices), 'pickings' : ' UNION ALL '.join(pickings)}
+
+    def _get_relation_kind(self, cr):
+        cr.execute('SELECT relkind FROM pg_class WHERE relname = %s', (self._table,))
+        row = cr.fetchone()
+        return row and row[0] or None
+
+    def _create_relation(self, cr, query):
+        cr.execute('SHOW server_version_num')
+        if int(cr.fetchone()[0]) >= MATERIALIZED_VIEW_VERSION:
+            cr.execute('CREATE MATERIALIZED VIEW %s AS %s' % (self._table, query))
+            kind = 'MATERIALIZED VIEW'
+        else:
+            cr.execute('CREATE TABLE %s AS %s' % (self._table, query))
+            kind = 'TABLE'
+        for name, columns, unique in UTILIZATION_INDEXES:
+            cr.execute('CREATE %s INDEX %s ON %s (%s)' % (unique and 'UNIQUE' or '', name, self._table, columns))
+        # The query depends of the installed modules (see _get_export_rent_price_sql) and of the archive tables :
+        # its hash is kept to know when it must be created again.
+        cr.execute("COMMENT ON %s %s IS %%s" % (kind, self._table), (hashlib.sha1(query).hexdigest(),))
+
+    def _drop_relation(self, cr):
+        kind = self._get_relation_kind(cr)
+        if kind == 'm':
+            cr.execute('DROP MATERIALIZED VIEW %s' % self._table)
+        elif kind == 'v':
+            cr.execute('DROP VIEW %s' % self._table)
+        elif kind == 'r':
+            cr.execute('DROP TABLE %s' % self._table)
+
+    def init(self, cr):
+        self._drop_relation(cr)
+        self._create_relation(cr, self._get_query(cr))
+
+    @report_bugs
+    def refresh_utilization(self, cr, uid, context=None):
+
+        """
+        Computes the rows again. The materialized view is refreshed concurrently, so the readers are not blocked.
+        If the query has changed (a module modifying the prices has been installed, or the orders have been archived
+        for the first time), the view is created again. Only the administrator (and the cron) can refresh it.
+        """
+
+        if uid != 1:
+            raise osv.except_osv(_('Access Denied'),
+                _('Only the administrator can refresh the rent products utilization.'))
+        start = time.time()
+        query = self._get_query(cr)
+        cr.execute('SELECT obj_description(%s::regclass, %s)', (self._table, 'pg_class'))
+        if cr.fetchone()[0] != hashlib.sha1(query).hexdigest():
+            self._drop_relation(cr)
+            self._create_relation(cr, query)
+        elif self._get_relation_kind(cr) == 'm':
+            cr.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY %s' % self._table)
+        else:
+            cr.execute('DELETE FROM %s' % self._table)
+            cr.execute('INSERT INTO %s %s' % (self._table, query))
+        _logger.info('Refreshed the rent products utilization in %.2fs', time.time() - start)
+        return True
+
+    @report_bugs
+    def run_cron_refresh_utilization(self, cr, uid, context=None):
+        return self.refresh_utilization(cr, uid, context=context)
+
+    _name = 'rent.product.utilization'
+    _table = 'rent_product_utilization'
+    _description = 'Rent Products Utilization'
+    _auto = False
+    _rec_name = 'month_name'
+    _order = 'month desc, product_id'
+
+    _columns = {
+        'product_id' : fields.many2one('product.product', 'Product', readonly=True),
+        'categ_id' : fields.many2one('product.category', 'Product Category', readonly=True),
+        'month' : fields.date('Month', readonly=True),
+        'month_name' : fields.char('Month', size=7, readonly=True),
+        'units' : fields.float('Units owned', readonly=True, group_operator='avg'),
+        'available_days' : fields.float('Available days', readonly=True),
+        'days_booked' : fields.float('Days booked', readonly=True),
+        'utilization' : fields.float('Utilization (%)', digits=(16, 2), readonly=True, group_operator='avg'),
+        'booked_revenue' : fields.float('Booked revenue', readonly=True),
+        'invoiced_revenue' : fields.float('Invoiced revenue', readonly=True),
+    }
+
+RentProductUtilization()
@@ -0,0 +1,312 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import datetime
+
+from profiling import report_bugs
+
+from osv import osv, fields
+from tools import config
+from tools.translate import _
+from tools.misc import DEFAULT_SERVER_DATETIME_FORMAT
+
+_logger = logging.getLogger('rent')
+
+# The archive table of each table, and the indexes of the archive tables (primary keys excepted). The archive
+# tables have the same columns, but no constraints : the rows are only moved there, never modified.
+ARCHIVE_TABLES = {
+    'rent_order' : ('rent_order_archive', ['partner_id', 'date_begin_rent']),
+    'rent_order_line' : ('rent_order_line_archive', ['order_id']),
+    'rent_order_invoices' : ('rent_order_invoices_archive', ['rent_order_id']),
+    'rent_order_line_taxes' : ('rent_order_line_taxes_archive', ['rent_order_line_id']),
+    'rent_order_line_lots' : ('rent_order_line_lots_archive', ['rent_order_line_id']),
+}
+
+# Orders are moved by chunks of this size.
+ARCHIVE_CHUNK_SIZE = 1000
+
+def get_table_columns(cr, table):
+    cr.execute("""
+        SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum
+    """, (table,))
+    return cr.fetchall()
+
+def table_exists(cr, table):
+    cr.execute('SELECT 1 FROM pg_class WHERE relname = %s AND relkind = %s', (table, 'r'))
+    return bool(cr.fetchone())
+
+def sync_archive_table(cr, table):
+
+    """
+    Creates the archive table of the table if it doesn't exist, or adds it the columns added to the table since.
+    """
+
+    archive, indexed_columns = ARCHIVE_TABLES[table]
+    if not table_exists(cr, table):
+        return
+    if not table_exists(cr, archive):
+        cr.execute('CREATE TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS)' % (archive, table))
+        columns = [name for name, column_type in get_table_columns(cr, archive)]
+        if 'id' in columns:
+            cr.execute('ALTER TABLE "%s" ADD PRIMARY KEY (id)' % archive)
+        for column in indexed_columns:
+            cr.execute('CREATE INDEX "%s_%s_index" ON "%s" ("%s")' % (archive, column, archive, column))
+        _logger.info('Created the archive table %s', archive)
+        return
+    existing = set([name for name, column_type in get_table_columns(cr, archive)])
+    for name, column_type in get_table_columns(cr, table):
+        if name not in existing:
+            cr.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (archive, name, column_type))
+
+def move_rows(cr, source, target, where, params):
+    columns = ', '.join(['"%s"' % name for name, column_type in get_table_columns(cr, source)])
+    cr.execute('INSERT INTO "%s" (%s) SELECT %s FROM "%s" WHERE %s' % (target, columns, columns, source, where), params)
+    cr.execute('DELETE FROM "%s" WHERE %s' % (source, where), params)
+    return cr.rowcount
+
+class ArchiveMixin(object):
+
+    """
+    Read-only access to the archived records of a model : when the context contains 'rent_archive', search() and
+    read() use the archive table instead of the table of the model, and the records can't be modified.
+
+    Only the stored fields are read from the archive, the other function fields are False. The domains on x2many
+    fields still search the current records.
+    """
+
+    def _check_not_archive(self, context):
+        if context and context.get('rent_archive'):
+            raise osv.except_osv(_('Error'), _('The archived rent orders are read-only.'))
+
+    def _archive_search(self, cr, uid, args, offset=0, limit=None, order=None, context=None, count=False):
+        archive = ARCHIVE_TABLES[self._table][0]
+        query = self._where_calc(cr, uid, args, context=context)
+        self._apply_ir_rules(cr, uid, query, 'read', context=context)
+        order_by = self._generate_order_by(order, query)
+        from_clause, where_clause, params = query.get_sql()
+        from_clause = from_clause.replace('"%s"' % self._table, '"%s" "%s"' % (archive, self._table), 1)
+        where_clause = where_clause and 'WHERE %s' % where_clause or ''
+
+        if count:
+            cr.execute('SELECT COUNT("%s".id) FROM %s %s' % (self._table, from_clause, where_clause), params)
+            return cr.fetchone()[0]
+        cr.execute('SELECT "%s".id FROM %s %s %s %s %s' % (self._table, from_clause, where_clause, order_by,
+            limit and 'LIMIT %d' % int(limit) or '', offset and 'OFFSET %d' % int(offset) or ''), params)
+        return [row[0] for row in cr.fetchall()]
+
+    def _archive_read(self, cr, uid, ids, fields_to_read=None, context=None):
+        single = isinstance(ids, (int, long))
+        ids = single and [ids] or list(ids)
+        if not ids:
+            return []
+        archive = ARCHIVE_TABLES[self._table][0]
+        stored = set([name for name, column_type in get_table_columns(cr, archive)])
+        fields_to_read = [name for name in (fields_to_read or self._columns.keys()) if name in self._columns]
+
+        read_columns = [name for name in fields_to_read if name in stored]
+        cr.execute('SELECT %s FROM "%s" WHERE id IN %%s' % (
+            ', '.join(['"%s"' % name for name in ['id'] + read_columns]), archive), (tuple(ids),))
+        rows = dict((row['id'], row) for row in cr.dictfetchall())
+        if not rows:
+            return not single and [] or False
+
+        values = dict((res_id, {'id' : res_id}) for res_id in rows)
+        for name in fields_to_read:
+            column = self._columns[name]
+            if name in stored and column._type == 'many2one':
+                relation = self.pool.get(column._obj)
+                related_ids = list(set([row[name] for row in rows.values() if row[name]]))
+                names = dict(related_ids and relation.name_get(cr, uid, related_ids, context=context) or [])
+                for res_id, row in rows.items():
+                    values[res_id][name] = row[name] and (row[name], names.get(row[name], '')) or False
+            elif name in stored:
+                for res_id, row in rows.items():
+                    values[res_id][name] = row[name]
+            elif column._type == 'one2many' and getattr(self.pool.get(column._obj), '_table', None) in ARCHIVE_TABLES:
+                related_table = ARCHIVE_TABLES[self.pool.get(column._obj)._table][0]
+                cr.execute('SELECT "%s", id FROM "%s" WHERE "%s" IN %%s ORDER BY id' % (
+                    column._fields_id, related_table, column._fields_id), (tuple(rows),))
+                related = {}
+                for res_id, related_id in cr.fetchall():
+                    related.setdefault(res_id, []).append(related_id)
+                for res_id in rows:
+                    values[res_id][name] = related.get(res_id, [])
+            elif column._type == 'many2many' and column._rel in ARCHIVE_TABLES:
+                cr.execute('SELECT "%s", "%s" FROM "%s" WHERE "%s" IN %%s' % (column._id1, column._id2,
+                    ARCHIVE_TABLES[column._rel][0], column._id1), (tuple(rows),))
+                related = {}
+                for res_id, related_id in cr.fetchall():
+                    related.setdefault(res_id, []).append(related_id)
+                for res_id in rows:
+                    values[res_id][name] = related.get(res_id, [])
+            else:
+                for res_id in rows:
+                    values[res_id][name] = column._type in ('one2many', 'many2many') and [] or False
+
+        result = [values[res_id] for res_id in ids if res_id in values]
+        if single:
+            return result and result[0] or False
+        return result
+
+class RentOrderArchive(osv.osv, ArchiveMixin):
+
+    """
+    Archival of the old rent orders : the done and cancelled orders which ended more than 'rent_archive_days' days
+    ago (server configuration, 730 by default) are moved with their lines, taxes and invoices links to archive
+    tables, so the current tables and their indexes stay small. Use the 'rent_archive' context key to read them.
+    """
+
+    _inherit = 'rent.order'
+
+    def _auto_init(self, cr, context=None):
+        result = super(RentOrderArchive, self)._auto_init(cr, context)
+        sync_archive_table(cr, 'rent_order')
+        sync_archive_table(cr, 'rent_order_invoices')
+        return result
+
+    def _sync_archive_tables(self, cr):
+        for table in ('rent_order', 'rent_order_line', 'rent_order_invoices', 'rent_order_line_taxes',
+            'rent_order_line_lots'):
+            sync_archive_table(cr, table)
+
+    @report_bugs
+    def archive_orders(self, cr, uid, ids=None, days=None, context=None):
+
+        """
+        Moves the specified orders, or the done/cancelled orders which ended more than days ago, to the archive
+        tables. Only done and cancelled orders are archived. Returns the number of archived orders. Only the
+        administrator can archive orders.
+        """
+
+        if uid != 1:
+            raise osv.except_osv(_('Access Denied'), _('Only the administrator can archive rent orders.'))
+        if days is None:
+            days = int(config.get('rent_archive_days') or 730)
+        self._sync_archive_tables(cr)
+
+        if ids is None:
+            limit = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+            cr.execute("SELECT id FROM rent_order WHERE state IN ('done', 'cancelled') AND date_end_rent < %s "
+                "ORDER BY id", (limit,))
+        else:
+            cr.execute("SELECT id FROM rent_order WHERE state IN ('done', 'cancelled') AND id IN %s ORDER BY id",
+                (tuple(ids) or (0,),))
+        ids = [row[0] for row in cr.fetchall()]
+
+        for index in range(0, len(ids), ARCHIVE_CHUNK_SIZE):
+            chunk_ids = (tuple(ids[index:index+ARCHIVE_CHUNK_SIZE]),)
+            # The links first, because deleting the orders deletes them in cascade
+            move_rows(cr, 'rent_order_line_taxes', 'rent_order_line_taxes_archive',
+                'rent_order_line_id IN (SELECT id FROM rent_order_line WHERE order_id IN %s)', chunk_ids)
+            move_rows(cr, 'rent_order_line_lots', 'rent_order_line_lots_archive',
+                'rent_order_line_id IN (SELECT id FROM rent_order_line WHERE order_id IN %s)', chunk_ids)
+            move_rows(cr, 'rent_order_invoices', 'rent_order_invoices_archive', 'rent_order_id IN %s', chunk_ids)
+            move_rows(cr, 'rent_order_line', 'rent_order_line_archive', 'order_id IN %s', chunk_ids)
+            move_rows(cr, 'rent_order', 'rent_order_archive', 'id IN %s', chunk_ids)
+            _logger.info('Archived %d rent orders', min(index + ARCHIVE_CHUNK_SIZE, len(ids)))
+
+        return len(ids)
+
+    @report_bugs
+    def restore_orders(self, cr, uid, ids, context=None):
+
+        """
+        Moves archived orders back to the current tables. Returns the number of restored orders, which is less
+        than the number of ids if some of them aren't archived. Only the administrator can restore orders.
+        """
+
+        if uid != 1:
+            raise osv.except_osv(_('Access Denied'), _('Only the administrator can restore rent orders.'))
+        self._sync_archive_tables(cr)
+        restored = 0
+        for index in range(0, len(ids), ARCHIVE_CHUNK_SIZE):
+            chunk_ids = (tuple(ids[index:index+ARCHIVE_CHUNK_SIZE]),)
+            restored += move_rows(cr, 'rent_order_archive', 'rent_order', 'id IN %s', chunk_ids)
+            move_rows(cr, 'rent_order_line_archive', 'rent_order_line', 'order_id IN %s', chunk_ids)
+            move_rows(cr, 'rent_order_invoices_archive', 'rent_order_invoices', 'rent_order_id IN %s', chunk_ids)
+            move_rows(cr, 'rent_order_line_taxes_archive', 'rent_order_line_taxes',
+                'rent_order_line_id IN (SELECT id FROM rent_order_line WHERE order_id IN %s)', chunk_ids)
+            move_rows(cr, 'rent_order_line_lots_archive', 'rent_order_line_lots',
+                'rent_order_line_id IN (SELECT id FROM rent_order_line WHERE order_id IN %s)', chunk_ids)
+        return restored
+
+    @report_bugs
+    def run_cron_archive_orders(self, cr, uid, context=None):
+        return self.archive_orders(cr, uid, context=context)
+
+    def search(self, cr, uid, args, offset=0, limit=None, order=None, context=None, count=False):
+        if context and context.get('rent_archive'):
+            return self._archive_search(cr, uid, args, offset, limit, order, context, count)
+        return super(RentOrderArchive, self).search(cr, uid, args, offset, limit, order, context, count)
+
+    def read(self, cr, uid, ids, fields=None, context=None, load='_classic_read'):
+        if context and context.get('rent_archive'):
+            return self._archive_read(cr, uid, ids, fields, context)
+        return super(RentOrderArchive, self).read(cr, uid, ids, fields, context, load)
+
+    def create(self, cr, uid, vals, context=None):
+        self._check_not_archive(context)
+        return super(RentOrderArchive, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self._check_not_archive(context)
+        return super(RentOrderArchive, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self._check_not_archive(context)
+        return super(RentOrderArchive, self).unlink(cr, uid, ids, context=context)
+
+RentOrderArchive()
+
+class RentOrderLineArchive(osv.osv, ArchiveMixin):
+
+    _inherit = 'rent.order.line'
+
+    def _auto_init(self, cr, context=None):
+        result = super(RentOrderLineArchive, self)._auto_init(cr, context)
+        sync_archive_table(cr, 'rent_order_line')
+        sync_archive_table(cr, 'rent_order_line_taxes')
+        sync_archive_table(cr, 'rent_order_line_lots')
+        return result
+
+    def search(self, cr, uid, args, offset=0, limit=None, order=None, context=None, count=False):
+        if context and context.get('rent_archive'):
+            return self._archive_search(cr, uid, args, offset, limit, order, context, count)
+        return super(RentOrderLineArchive, self).search(cr, uid, args, offset, limit, order, context, count)
+
+    def read(self, cr, uid, ids, fields=None, context=None, load='_classic_read'):
+        if context and context.get('rent_archive'):
+            return self._archive_read(cr, uid, ids, fields, context)
+        return super(RentOrderLineArchive, self).read(cr, uid, ids, fields, context, load)
+
+    def create(self, cr, uid, vals, context=None):
+        self._check_not_archive(context)
+        return super(RentOrderLineArchive, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self._check_not_archive(context)
+        return super(RentOrderLineArchive, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self._check_not_archive(context)
+        return super(RentOrderLineArchive, self).unlink(cr, uid, ids, context=context)
+
+RentOrderLineArchive()
@@ -0,0 +1,253 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+import base64
+import logging
+import zipfile
+import threading
+import cStringIO
+import Queue
+
+import pooler
+
+from osv import osv, fields
+from tools import config
+from tools.translate import _
+
+from profiling import report_bugs
+
+from report_cache import render_report_cached
+
+try:
+    from pyPdf import PdfFileReader, PdfFileWriter
+except ImportError:
+    PdfFileReader = PdfFileWriter = None
+
+_logger = logging.getLogger('rent')
+
+OUTPUTS = (
+    ('zip', 'Zip archive (one document per order)'),
+    ('pdf', 'Merged PDF (PDF reports only)'),
+)
+
+MODES = (
+    ('download', 'Download now'),
+    ('attachment', 'Store as an attachment when done'),
+)
+
+def render_report(cr, uid, report_name, model, res_id, context=None):
+
+    """
+    Renders the report for one record, and returns a (content, format) tuple. The documents of records which can't
+    change anymore are read from the rendered reports cache.
+    """
+
+    return render_report_cached(cr, uid, pooler.get_pool(cr.dbname), report_name, model, res_id, context)
+
+def render_reports(dbname, uid, report_name, model, ids, workers=4, context=None):
+
+    """
+    Renders the report of each record in parallel, and returns a list of (id, content, format, error) tuples, in the
+    order of ids. Each worker uses its own cursor, because a cursor can't be shared between threads.
+
+    Threads are used instead of processes because the ORM and the cursors can't be forked safely, whereas the
+    conversion of aeroo reports is done by OpenOffice, outside of the server process.
+    """
+
+    tasks = Queue.Queue()
+    for index, res_id in enumerate(ids):
+        tasks.put((index, res_id))
+    results = [None] * len(ids)
+
+    def worker():
+        cr = pooler.get_db(dbname).cursor()
+        try:
+            while True:
+                try:
+                    index, res_id = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    content, format = render_report(cr, uid, report_name, model, res_id, dict(context or {}))
+                    results[index] = (res_id, content, format, None)
+                except Exception as e:
+                    _logger.exception('Unable to render report %s for %s,%d', report_name, model, res_id)
+                    results[index] = (res_id, None, None, e)
+                    cr.rollback()
+        finally:
+            cr.close()
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(workers, len(ids))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+def pack_documents(documents, output):
+
+    """
+    Packs the documents, a list of (filename, content, format) tuples, into a single file. Returns a
+    (content, extension) tuple. PDF documents are merged if the output is 'pdf' and pyPdf is available,
+    else a zip archive is built.
+    """
+
+    stream = cStringIO.StringIO()
+
+    if output == 'pdf' and PdfFileWriter is not None and all(format == 'pdf' for name, content, format in documents):
+        writer = PdfFileWriter()
+        for name, content, format in documents:
+            reader = PdfFileReader(cStringIO.StringIO(content))
+            for page in range(reader.getNumPages()):
+                writer.addPage(reader.getPage(page))
+        writer.write(stream)
+        return stream.getvalue(), 'pdf'
+
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    for name, content, format in documents:
+        archive.writestr('%s.%s' % (name, format), content)
+    archive.close()
+    return stream.getvalue(), 'zip'
+
+class RentOrderBatchPrint(osv.osv_memory):
+
+    """
+    This wizard prints a report for a lot of rent orders at once : documents are rendered in parallel, and
+    packed into a zip archive or a merged PDF. Big batches can be rendered in background and stored as an
+    attachment, to avoid client timeouts.
+    """
+
+    @report_bugs
+    def default_report_id(self, cr, uid, context=None):
+
+        """
+        Returns the first report available for rent orders.
+        """
+
+        report_ids = self.pool.get('ir.actions.report.xml').search(cr, uid, [('model', '=', 'rent.order')], limit=1)
+        return report_ids and report_ids[0] or False
+
+    def _build_file(self, cr, uid, dbname, report_name, order_ids, workers, output, context=None):
+
+        """
+        Renders and packs the documents of the orders. Returns (content, filename, errors).
+        """
+
+        references = dict((order['id'], order['reference']) for order in
+            self.pool.get('rent.order').read(cr, uid, order_ids, ['reference'], context=context))
+        results = render_reports(dbname, uid, report_name, 'rent.order', order_ids, workers, context)
+
+        documents = [(references[res_id], content, format) for res_id, content, format, error in results if not error]
+        errors = [references[res_id] for res_id, content, format, error in results if error]
+
+        content, extension = pack_documents(documents, output)
+        filename = '%s-%s.%s' % (report_name, time.strftime('%Y%m%d-%H%M%S'), extension)
+        return content, filename, errors
+
+    def _print_in_background(self, dbname, uid, report_name, order_ids, workers, output, context=None):
+        cr = pooler.get_db(dbname).cursor()
+        try:
+            content, filename, errors = self._build_file(
+                cr, uid, dbname, report_name, order_ids, workers, output, context)
+            attachment_id = self.pool.get('ir.attachment').create(cr, uid, {
+                'name' : filename,
+                'datas' : base64.encodestring(content),
+                'datas_fname' : filename,
+                'res_model' : 'res.users',
+                'res_id' : uid,
+            }, context=context)
+            message = _('The batch print "%s" of %d rent orders is done.') % (filename, len(order_ids))
+            if errors:
+                message += ' ' + _('These orders could not be printed: %s') % ', '.join(errors)
+            self.pool.get('res.log').create(cr, uid, {
+                'name' : message,
+                'res_model' : 'ir.attachment',
+                'res_id' : attachment_id,
+            }, context=context)
+            cr.commit()
+        except Exception:
+            _logger.exception('The batch print of %d rent orders failed', len(order_ids))
+            cr.rollback()
+        finally:
+            cr.close()
+
+    @report_bugs
+    def action_print(self, cr, uid, ids, context=None):
+
+        """
+        Prints the selected rent orders.
+        """
+
+        if context is None:
+            context = {}
+
+        wizard = self.browse(cr, uid, ids[0], context=context)
+        order_ids = context.get('active_ids', [])
+        if not order_ids:
+            raise osv.except_osv(_('Error'), _('You must select at least one rent order.'))
+
+        report_name = wizard.report_id.report_name
+        # Each rendering uses a database connection : the number of workers is limited by the server configuration
+        workers = max(1, min(wizard.workers, int(config.get('rent_batch_print_max_workers') or 4)))
+
+        if wizard.mode == 'attachment':
+            thread = threading.Thread(target=self._print_in_background,
+                args=(cr.dbname, uid, report_name, order_ids, workers, wizard.output, dict(context)))
+            thread.start()
+            self.write(cr, uid, ids, {'state' : 'background'}, context=context)
+            return True
+
+        content, filename, errors = self._build_file(
+            cr, uid, cr.dbname, report_name, order_ids, workers, wizard.output, context)
+        self.write(cr, uid, ids, {
+            'state' : 'done',
+            'data' : base64.encodestring(content),
+            'filename' : filename,
+            'errors' : ', '.join(errors),
+        }, context=context)
+        return True
+
+    _name = 'rent.order.batch.print'
+    _columns = {
+        'report_id' : fields.many2one('ir.actions.report.xml', 'Report', required=True,
+            domain=[('model', '=', 'rent.order')], help='The report to print for each selected rent order.'),
+        'output' : fields.selection(OUTPUTS, 'Output', required=True),
+        'mode' : fields.selection(MODES, 'Mode', required=True, help=
+            'Big batches should be stored as an attachment : you will be notified when the file is ready.'),
+        'workers' : fields.integer('Parallel renderings', required=True, help=
+            'How many documents are rendered at the same time, at most rent_batch_print_max_workers (server '
+            'configuration, 4 by default).'),
+        'state' : fields.selection((('draft', 'Draft'), ('background', 'Background'), ('done', 'Done')),
+            'State', readonly=True),
+        'data' : fields.binary('File', readonly=True),
+        'filename' : fields.char('File name', size=128, readonly=True),
+        'errors' : fields.text('Orders not printed', readonly=True),
+    }
+
+    _defaults = {
+        'report_id' : default_report_id,
+        'output' : 'zip',
+        'mode' : 'download',
+        'workers' : 4,
+        'state' : 'draft',
+    }
+
+RentOrderBatchPrint()
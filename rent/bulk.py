@@ -0,0 +1,443 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import datetime
+
+import netsvc
+
+from openlib.tools import *
+from profiling import report_bugs
+from sequence import REFERENCE_ALLOCATOR
+
+from osv import osv, fields
+from tools.translate import _
+from tools.misc import DEFAULT_SERVER_DATETIME_FORMAT
+
+_logger = logging.getLogger('rent')
+
+# Maximum number of rows updated by one query, see bulk_update().
+BULK_UPDATE_CHUNK_SIZE = 1000
+
+UNITY_NAMES = {'days' : 'Day', 'months' : 'Month', 'years' : 'Year'}
+
+class BulkImportError(Exception):
+    pass
+
+def bulk_insert(cr, uid, table, sequence, rows):
+
+    """
+    Inserts the rows (dictionaries of column values) into the table with one query, and returns their ids, in the
+    same order. The ids are taken from the sequence first, like the ORM does, so they are known for sure.
+    """
+
+    if not rows:
+        return []
+    cr.execute('SELECT nextval(%s) FROM generate_series(1, %s)', (sequence, len(rows)))
+    ids = [row[0] for row in cr.fetchall()]
+    columns = sorted(set().union(*rows))
+    values = []
+    for row_id, row in zip(ids, rows):
+        values.extend([row_id, uid, uid] + [row.get(column) for column in columns])
+    placeholders = '(%s)' % ', '.join(['%s'] * 3 + ["now() AT TIME ZONE 'UTC'"] * 2 + ['%s'] * len(columns))
+    cr.execute('INSERT INTO %s (id, create_uid, write_uid, create_date, write_date, %s) VALUES %s' % (
+        table, ', '.join(['"%s"' % column for column in columns]), ', '.join([placeholders] * len(rows))), values)
+    return ids
+
+def bulk_update(cr, table, column, cast, updates):
+
+    """
+    Sets the column of the rows from a list of (id, value) tuples, with one query by chunk of BULK_UPDATE_CHUNK_SIZE
+    rows. The cast is the SQL type of the values, for example 'float'.
+    """
+
+    for index in range(0, len(updates), BULK_UPDATE_CHUNK_SIZE):
+        chunk = updates[index:index+BULK_UPDATE_CHUNK_SIZE]
+        values = ', '.join(['(%%s::integer, %%s::%s)' % cast] * len(chunk))
+        cr.execute('UPDATE %s SET "%s" = v.value FROM (VALUES %s) AS v(id, value) WHERE %s.id = v.id' % (
+            table, column, values, table), [value for update in chunk for value in update])
+
+def get_stored_fields(model, trigger=None):
+
+    """
+    Returns the names of the stored function fields of the model. If trigger is specified, only the fields computed
+    again when the records of this model are modified are returned.
+    """
+
+    return sorted([name for name, column in model._columns.items() if isinstance(column, fields.function)
+        and column.store and (trigger is None or isinstance(column.store, dict) and trigger in column.store)])
+
+def bulk_update_lines(cr, uid, pool, column, cast, updates, order_ids, context=None):
+
+    """
+    Sets the column of the rent order lines from a list of (id, value) tuples (see bulk_update), then computes once
+    the stored fields of the orders which depend on their lines.
+    """
+
+    bulk_update(cr, 'rent_order_line', column, cast, updates)
+    if order_ids:
+        order_pool = pool.get('rent.order')
+        order_pool._store_set_values(cr, uid, list(order_ids), get_stored_fields(order_pool, 'rent.order.line'),
+            context)
+
+def format_datetime(value, name):
+    if not value:
+        return value
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+    try:
+        return to_datetime(value).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+    except ValueError:
+        raise BulkImportError(_('Invalid date for %s: %s') % (name, value))
+
+def get_error_message(error):
+    if isinstance(error, osv.except_osv):
+        return error.value
+    return getattr(error, 'pgerror', None) or str(error)
+
+class RentOrderBulk(osv.osv):
+
+    """
+    Bulk import of rent orders : the partners, addresses, products, taxes and unities of a chunk of orders are
+    resolved with a few set-based queries, the orders and their lines are inserted with one query per table, and
+    the stored fields are computed once for the whole chunk.
+    """
+
+    _inherit = 'rent.order'
+
+    @report_bugs
+    def bulk_import(self, cr, uid, orders, chunk_size=500, context=None):
+
+        """
+        Imports rent orders from an iterable of dictionaries, which can be a generator reading a file. Each order
+        dictionary can contain these keys :
+
+            partner_id or partner_ref : The customer, by id or by reference (required)
+            date_begin_rent, rent_duration, rent_duration_unity (id, or 'Day', 'Month', 'Year')
+            reference, date_created, date_out_shipping, date_in_shipping, rent_invoice_period, shop_id,
+            salesman, discount, fiscal_position, description, notes : Optional, like in the form
+            lines : A list of dictionaries, with these keys :
+                product_id or product_code : The product, by id or by internal reference (required)
+                quantity, product_type, unit_price, discount, description, notes, tax_ids : Optional, the
+                default values are the ones set by on_product_changed(). The production lots can't be imported,
+                assign them to the created orders afterwards.
+
+        The addresses and the fiscal position are set like on_client_changed() does, and the return date defaults
+        to the rent end date. Returns a dictionary with these keys :
+
+            ids : The ids of the created orders
+            errors : A list of dictionaries (index, reference, message) for the orders which were not created. The
+                     index is the position of the order in the iterable.
+        """
+
+        self.pool.get('ir.model.access').check(cr, uid, self._name, 'create')
+        result = {'ids' : [], 'errors' : []}
+        chunk = []
+
+        for index, order in enumerate(orders):
+            chunk.append((index, order))
+            if len(chunk) >= chunk_size:
+                self._bulk_import_chunk(cr, uid, chunk, result, context=context)
+                chunk = []
+        if chunk:
+            self._bulk_import_chunk(cr, uid, chunk, result, context=context)
+
+        _logger.info('Imported %d rent orders, %d errors', len(result['ids']), len(result['errors']))
+        return result
+
+    def _bulk_resolve(self, cr, uid, orders, context=None):
+
+        """
+        Reads everything needed to build the values of a chunk of orders, with one query per kind of object.
+        """
+
+        partner_refs = set([order['partner_ref'] for order in orders if order.get('partner_ref')])
+        product_codes = set([line['product_code'] for order in orders for line in order.get('lines', [])
+            if line.get('product_code')])
+
+        resolved = {'partner_refs' : {}, 'product_codes' : {}}
+        if partner_refs:
+            cr.execute('SELECT ref, id FROM res_partner WHERE ref IN %s AND active ORDER BY id DESC',
+                (tuple(partner_refs),))
+            resolved['partner_refs'] = dict(cr.fetchall())
+        if product_codes:
+            cr.execute('SELECT default_code, id FROM product_product WHERE default_code IN %s AND active '
+                'ORDER BY id DESC', (tuple(product_codes),))
+            resolved['product_codes'] = dict(cr.fetchall())
+
+        partner_ids = set([order['partner_id'] for order in orders if order.get('partner_id')])
+        partner_ids.update(resolved['partner_refs'].values())
+        product_ids = set([line['product_id'] for order in orders for line in order.get('lines', [])
+            if line.get('product_id')])
+        product_ids.update(resolved['product_codes'].values())
+
+        # Ids given by the caller may not exist
+        partner_ids = partner_ids and self._bulk_existing_ids(cr, 'res_partner', partner_ids) or []
+        product_ids = product_ids and self._bulk_existing_ids(cr, 'product_product', product_ids) or []
+        resolved['partners'] = dict((partner['id'], partner) for partner in self.pool.get('res.partner').read(
+            cr, uid, partner_ids, ['property_account_position'], context=context))
+        resolved['addresses'] = self.pool.get('res.partner').get_rent_addresses(cr, uid, partner_ids, context=context)
+        resolved['products'] = dict((product['id'], product) for product in self.pool.get('product.product').read(
+            cr, uid, product_ids, ['name', 'type', 'can_be_rent', 'sale_ok', 'rent_price', 'list_price', 'taxes_id'],
+            context=context))
+
+        resolved['unities'] = unities = self.get_duration_unities(cr, uid, context=context)
+        resolved['unity_names'] = dict((UNITY_NAMES[keyword], unity_id) for unity_id, keyword in unities.items())
+        cr.execute('SELECT interval_id, duration_id FROM rent_interval_not_allowed_durations')
+        resolved['not_allowed'] = set(cr.fetchall())
+        cr.execute('SELECT id, company_id FROM sale_shop')
+        resolved['shops'] = dict(cr.fetchall())
+        resolved['defaults'] = self.default_get(cr, uid, ['date_created', 'date_begin_rent', 'rent_duration',
+            'rent_duration_unity', 'rent_invoice_period', 'shop_id', 'discount', 'salesman'], context=context)
+        return resolved
+
+    def _bulk_existing_ids(self, cr, table, ids):
+        cr.execute('SELECT id FROM %s WHERE id IN %%s' % table, (tuple(ids),))
+        return [row[0] for row in cr.fetchall()]
+
+    def _bulk_order_values(self, cr, uid, order, resolved, context=None):
+
+        """
+        Returns the columns values of an order (and its lines, as a list in 'lines'). Raises BulkImportError if the
+        order is not valid. The messages are the ones of the constraints.
+        """
+
+        defaults = resolved['defaults']
+
+        partner_id = order.get('partner_id') or resolved['partner_refs'].get(order.get('partner_ref'))
+        if partner_id not in resolved['partners']:
+            raise BulkImportError(_('Unknown customer: %s') % (order.get('partner_id') or order.get('partner_ref')))
+        addresses = resolved['addresses'].get(partner_id) or {}
+        if not addresses.get('default'):
+            raise BulkImportError(_('You must define a least one default address for this client.'))
+        fiscal_position = resolved['partners'][partner_id]['property_account_position']
+
+        unity_id = order.get('rent_duration_unity') or defaults.get('rent_duration_unity')
+        unity_id = resolved['unity_names'].get(unity_id, unity_id)
+        if unity_id not in resolved['unities']:
+            raise BulkImportError(_('Unknown duration unity: %s') % unity_id)
+
+        interval_id = order.get('rent_invoice_period') or defaults.get('rent_invoice_period')
+        if (interval_id, unity_id) in resolved['not_allowed']:
+            raise BulkImportError(_("You can't use this duration unity with this invoicing period !"))
+
+        shop_id = order.get('shop_id') or defaults.get('shop_id')
+        if shop_id not in resolved['shops']:
+            raise BulkImportError(_('Unknown shop: %s') % shop_id)
+
+        date_created = format_datetime(order.get('date_created') or defaults.get('date_created'), 'date_created')
+        date_begin = format_datetime(order.get('date_begin_rent') or defaults.get('date_begin_rent'), 'date_begin_rent')
+        if not date_begin:
+            raise BulkImportError(_('The rent begin date is required.'))
+        if date_begin < date_created:
+            raise BulkImportError(_('The begin date must later than the order date.'))
+
+        discount = order.get('discount', defaults.get('discount')) or 0.0
+        if not 0 <= discount <= 100:
+            raise BulkImportError(_('Discount must be a value between 0 and 100.'))
+
+        values = {
+            'reference' : order.get('reference') or '/',
+            'state' : 'draft',
+            'date_created' : date_created,
+            'date_begin_rent' : date_begin,
+            'rent_duration' : order.get('rent_duration') or defaults.get('rent_duration'),
+            'rent_duration_unity' : unity_id,
+            'rent_invoice_period' : interval_id,
+            'salesman' : order.get('salesman', defaults.get('salesman')) or None,
+            'shop_id' : shop_id,
+            'company_id' : resolved['shops'][shop_id],
+            'partner_id' : partner_id,
+            'partner_order_address_id' : addresses['default'],
+            'partner_invoice_address_id' : addresses.get('invoice') or addresses['default'],
+            'partner_shipping_address_id' : addresses.get('delivery') or addresses['default'],
+            'fiscal_position' : order.get('fiscal_position') or (fiscal_position and fiscal_position[0]) or None,
+            'discount' : discount,
+            'description' : order.get('description'),
+            'notes' : order.get('notes'),
+            'date_out_shipping' : format_datetime(order.get('date_out_shipping'), 'date_out_shipping') or date_begin,
+            'date_in_shipping' : format_datetime(order.get('date_in_shipping'), 'date_in_shipping'),
+            'lines' : [self._bulk_line_values(cr, uid, line, resolved, context=context)
+                       for line in order.get('lines', [])],
+        }
+        return values
+
+    def _bulk_line_values(self, cr, uid, line, resolved, context=None):
+        product_id = line.get('product_id') or resolved['product_codes'].get(line.get('product_code'))
+        product = resolved['products'].get(product_id)
+        if not product:
+            raise BulkImportError(_('Unknown product: %s') % (line.get('product_id') or line.get('product_code')))
+
+        product_type = line.get('product_type') or (product['can_be_rent'] and 'rent' or 'service')
+        if (product_type == 'rent' and not product['can_be_rent']) or (product_type == 'service' and
+            (product['type'] != 'service' or not product['sale_ok'])):
+            raise BulkImportError(_("You can't use this product type with this product. "
+                "Check that the product is marked for rent or for sale. Moreover, "
+                "Service products must be declared as 'Service' in the product view."))
+
+        unit_price = line.get('unit_price') or (product_type == 'rent' and product['rent_price'] or product['list_price'])
+        if not unit_price > 0:
+            raise BulkImportError(_('The price must be superior to 0.'))
+        discount = line.get('discount') or 0.0
+        if not 0 <= discount <= 100:
+            raise BulkImportError(_('Discount must be a value between 0 and 100.'))
+
+        values = {
+            'description' : line.get('description') or product['name'],
+            'product_id' : product_id,
+            'product_type' : product_type,
+            'quantity' : line.get('quantity') or 1,
+            'discount' : discount,
+            'unit_price' : unit_price,
+            'notes' : line.get('notes'),
+            'tax_ids' : line.get('tax_ids', product['taxes_id']),
+        }
+        if 'coeff' in line:
+            values['coeff'] = line['coeff']
+        return values
+
+    def _bulk_import_chunk(self, cr, uid, chunk, result, context=None):
+        resolved = self._bulk_resolve(cr, uid, [order for index, order in chunk], context=context)
+
+        valid = []
+        references = {}
+        for index, order in chunk:
+            try:
+                values = self._bulk_order_values(cr, uid, order, resolved, context=context)
+            except BulkImportError as e:
+                result['errors'].append({'index' : index, 'reference' : order.get('reference') or '',
+                    'message' : e.args[0]})
+                continue
+            if values['reference'] != '/':
+                references.setdefault(values['reference'], []).append(index)
+            valid.append((index, values))
+
+        # The references must be unique, in the file and in the database
+        duplicates = set([reference for reference, indexes in references.items() if len(indexes) > 1])
+        if references:
+            cr.execute('SELECT reference FROM rent_order WHERE reference IN %s', (tuple(references),))
+            duplicates.update([row[0] for row in cr.fetchall()])
+        if duplicates:
+            for index, values in valid:
+                if values['reference'] in duplicates:
+                    result['errors'].append({'index' : index, 'reference' : values['reference'],
+                        'message' : _('Rent Order reference must be unique !')})
+            valid = [(index, values) for index, values in valid if values['reference'] not in duplicates]
+
+        if not valid:
+            return
+
+        # If the chunk can't be inserted at once, each order is inserted alone to find the faulty ones
+        cr.execute('SAVEPOINT rent_bulk_import')
+        try:
+            ids = self._bulk_create_orders(cr, uid, [values for index, values in valid], context=context)
+        except Exception:
+            cr.execute('ROLLBACK TO SAVEPOINT rent_bulk_import')
+        else:
+            cr.execute('RELEASE SAVEPOINT rent_bulk_import')
+            result['ids'].extend(ids)
+            return
+
+        for index, values in valid:
+            cr.execute('SAVEPOINT rent_bulk_import')
+            try:
+                ids = self._bulk_create_orders(cr, uid, [values], context=context)
+            except Exception as e:
+                cr.execute('ROLLBACK TO SAVEPOINT rent_bulk_import')
+                result['errors'].append({'index' : index, 'reference' : values['reference'],
+                    'message' : get_error_message(e)})
+            else:
+                cr.execute('RELEASE SAVEPOINT rent_bulk_import')
+                result['ids'].extend(ids)
+
+    @report_bugs
+    def _bulk_create_orders(self, cr, uid, orders, context=None):
+
+        """
+        Creates rent orders from a list of dictionaries of columns values, each one containing the values of its
+        lines in 'lines' (the taxes ids of a line are in 'tax_ids'). The values are not checked : they must be
+        valid. The reference ('/' or missing), the company, the end date and the return date are set if missing.
+
+        The orders, the lines and the taxes are inserted with one query each, the stored fields are computed once,
+        and the workflow of each order is created. Returns the ids of the orders, in the same order.
+        """
+
+        line_pool = self.pool.get('rent.order.line')
+
+        if [order for order in orders if not order.get('company_id')]:
+            cr.execute('SELECT id, company_id FROM sale_shop')
+            shops = dict(cr.fetchall())
+            for order in orders:
+                order['company_id'] = order.get('company_id') or shops[order['shop_id']]
+
+        missing = [(index, order['date_begin_rent'], order['rent_duration'], order['rent_duration_unity'],
+            order['company_id']) for index, order in enumerate(orders) if not order.get('date_end_rent')]
+        if missing:
+            end_dates = self.compute_end_dates(cr, uid, missing, context=context)
+            for index, end_date in end_dates.items():
+                orders[index]['date_end_rent'] = end_date
+
+        for order in orders:
+            order['date_in_shipping'] = order.get('date_in_shipping') or order['date_end_rent']
+            if order.get('reference', '/') == '/':
+                order['reference'] = REFERENCE_ALLOCATOR.get(cr, uid, 'rent.order', context=context)
+
+        line_pool._prepare_bulk_lines(cr, uid, orders, context=context)
+
+        order_ids = bulk_insert(cr, uid, self._table, self._sequence,
+            [dict([(key, value) for key, value in order.items() if key != 'lines']) for order in orders])
+
+        lines, taxes = [], []
+        for order_id, order in zip(order_ids, orders):
+            for line in order.get('lines', []):
+                lines.append(dict([(key, value) for key, value in line.items() if key != 'tax_ids'],
+                    order_id=order_id))
+                taxes.append(line.get('tax_ids') or [])
+        line_ids = bulk_insert(cr, uid, line_pool._table, line_pool._sequence, lines)
+
+        taxes = [(line_id, tax_id) for line_id, tax_ids in zip(line_ids, taxes) for tax_id in tax_ids]
+        if taxes:
+            cr.execute('INSERT INTO rent_order_line_taxes (rent_order_line_id, tax_id) VALUES %s' %
+                ', '.join(['(%s, %s)'] * len(taxes)), [value for tax in taxes for value in tax])
+
+        # The end date and the company are already set, only the fields which depend on the lines are computed
+        self._store_set_values(cr, uid, order_ids, get_stored_fields(self, 'rent.order.line'), context)
+
+        wkf_service = netsvc.LocalService('workflow')
+        for order_id in order_ids:
+            wkf_service.trg_create(uid, self._name, order_id, cr)
+
+        return order_ids
+
+RentOrderBulk()
+
+class RentOrderLineBulk(osv.osv):
+
+    _inherit = 'rent.order.line'
+
+    def _prepare_bulk_lines(self, cr, uid, orders, context=None):
+
+        """
+        Called by rent.order._bulk_create_orders() before the lines are inserted. Modules which add required
+        columns to the lines can set their values here.
+        """
+
+        pass
+
+RentOrderLineBulk()
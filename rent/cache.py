@@ -0,0 +1,113 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+import threading
+
+_MISSING = object()
+
+class RegistryCache(object):
+
+    """
+    A small thread-safe cache used by the rent module to avoid reading the same rows again and again.
+
+    Entries are scoped by database name, because there is one registry (pool) per database in OpenERP. Entries
+    can expire after 'timeout' seconds, and each database can be bounded to 'size' entries. When the limit is
+    reached, the least recently used entries are evicted first.
+    """
+
+    def __init__(self, timeout=None, size=None):
+        self.timeout = timeout
+        self.size = size
+        self._lock = threading.RLock()
+        self._databases = {}
+
+    def _entries(self, dbname):
+        return self._databases.setdefault(dbname, {})
+
+    def get(self, dbname, key, default=None):
+
+        """
+        Returns the cached value of key, or default if it's missing or expired.
+        """
+
+        self._lock.acquire()
+        try:
+            entries = self._entries(dbname)
+            entry = entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, created, _used = entry
+            now = time.time()
+            if self.timeout is not None and now - created > self.timeout:
+                del entries[key]
+                return default
+            entries[key] = (value, created, now)
+            return value
+        finally:
+            self._lock.release()
+
+    def get_many(self, dbname, keys):
+
+        """
+        Returns a dictionary containing the cached values of the keys which are present in the cache.
+        """
+
+        result = {}
+        for key in keys:
+            value = self.get(dbname, key, _MISSING)
+            if value is not _MISSING:
+                result[key] = value
+        return result
+
+    def set(self, dbname, key, value):
+
+        """
+        Stores value for key, evicting the least recently used entries if the cache is full.
+        """
+
+        self._lock.acquire()
+        try:
+            entries = self._entries(dbname)
+            now = time.time()
+            entries[key] = (value, now, now)
+            if self.size is not None and len(entries) > self.size:
+                # We evict a tenth of the cache at once to avoid sorting the entries on each insertion
+                by_usage = sorted(entries.items(), key=lambda item: item[1][2])
+                for old_key, _entry in by_usage[:max(1, len(entries) - self.size + self.size // 10)]:
+                    del entries[old_key]
+        finally:
+            self._lock.release()
+
+    def invalidate(self, dbname, keys=None):
+
+        """
+        Removes the specified keys of the cache of this database. If keys is None, the whole database is cleared.
+        """
+
+        self._lock.acquire()
+        try:
+            if keys is None:
+                self._databases.pop(dbname, None)
+                return
+            entries = self._entries(dbname)
+            for key in keys:
+                entries.pop(key, None)
+        finally:
+            self._lock.release()
@@ -19,6 +19,15 @@
 
 from osv import osv, fields
 
+from openlib.tools import *
+from profiling import report_bugs
+
+from cache import RegistryCache
+
+# Parsed configurations of the companies, indexed by company id. The timeout lets the servers sharing a database
+# see the modifications done by the others.
+CONFIG_CACHE = RegistryCache(timeout=300)
+
 DEFAULT_BEGIN = (
     ('today', 'Today'),
     ('tomorrow_morning', 'Tomorrow (Morning)'),
@@ -26,12 +35,70 @@ DEFAULT_BEGIN = (
     ('empty', 'Empty'),
 )
 
+class RentConfiguration(object):
+
+    """
+    The rent configuration of a company, with already parsed values :
+
+        company_id : The id of the company
+        morning_begin : The day begin, as a datetime.time object
+        afternoon_begin : The afternoon begin, as a datetime.time object
+        afternoon_end : The afternoon end, as a datetime.time object
+        default_begin : The default begin of new rent orders, one of the DEFAULT_BEGIN values
+    """
+
+    def __init__(self, company_id, morning_begin, afternoon_begin, afternoon_end, default_begin):
+        self.company_id = company_id
+        self.morning_begin = morning_begin
+        self.afternoon_begin = afternoon_begin
+        self.afternoon_end = afternoon_end
+        self.default_begin = default_begin
+
 class Company(osv.osv):
 
     """
     These fields are used in the comptation of an order duration.
     """
 
+    def __init__(self, pool, cr):
+        # The registry is being (re)loaded, the company rows may have been updated meanwhile.
+        CONFIG_CACHE.invalidate(cr.dbname)
+        super(Company, self).__init__(pool, cr)
+
+    @report_bugs
+    def get_rent_config(self, cr, uid, company_id=None, context=None):
+
+        """
+        Returns the RentConfiguration of the company. If company_id is not specified, the company of the user is used.
+        Configurations are cached until a company is modified.
+        """
+
+        if not company_id:
+            company_id = self.pool.get('res.users').read(cr, uid, uid, ['company_id'], context=context)['company_id'][0]
+
+        config = CONFIG_CACHE.get(cr.dbname, company_id)
+        if config is None:
+            company = self.read(cr, uid, company_id, ['rent_morning_begin', 'rent_afternoon_begin',
+                'rent_afternoon_end', 'rent_default_begin'], context=context)
+            config = RentConfiguration(company_id,
+                to_time(company['rent_morning_begin']),
+                to_time(company['rent_afternoon_begin']),
+                to_time(company['rent_afternoon_end']),
+                company['rent_default_begin'])
+            CONFIG_CACHE.set(cr.dbname, company_id, config)
+
+        return config
+
+    def write(self, cr, uid, ids, vals, context=None):
+        result = super(Company, self).write(cr, uid, ids, vals, context=context)
+        CONFIG_CACHE.invalidate(cr.dbname)
+        return result
+
+    def unlink(self, cr, uid, ids, context=None):
+        result = super(Company, self).unlink(cr, uid, ids, context=context)
+        CONFIG_CACHE.invalidate(cr.dbname)
+        return result
+
     _inherit = 'res.company'
     _columns = {
         'rent_morning_begin' : fields.time('Day begin', required=True, help=
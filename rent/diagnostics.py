@@ -0,0 +1,238 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import re
+import sys
+import logging
+import threading
+
+from osv import osv
+from tools import config
+
+from profiling import PROFILER, CursorProbe
+
+_logger = logging.getLogger('rent')
+
+# A query shape executed more often than this from the same line is reported as a probable N+1 pattern.
+DEFAULT_THRESHOLD = 10
+
+# The queries are attributed to the first frame of these modules, the others (ORM, openlib) are skipped.
+SITE_MODULES = ('rent', 'rent_rtz')
+SKIPPED_MODULES = ('rent.profiling', 'rent.diagnostics')
+
+SHAPE_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+SHAPES_CACHE = {}
+
+def get_query_shape(query):
+
+    """
+    Returns the normalized form of a query : literals are replaced by '?', lists of values by '(...)', and
+    whitespaces are collapsed. Two queries which only differ by their parameters have the same shape.
+    """
+
+    shape = SHAPES_CACHE.get(query)
+    if shape is None:
+        shape = query.strip()
+        for pattern, replacement in SHAPE_PATTERNS:
+            shape = pattern.sub(replacement, shape)
+        if len(SHAPES_CACHE) > 10000:
+            SHAPES_CACHE.clear()
+        SHAPES_CACHE[query] = shape
+    return shape
+
+def get_call_site(depth=2):
+
+    """
+    Returns the (module, line, function) of the first frame of the rent modules in the current stack, or None.
+    """
+
+    frame = sys._getframe(depth)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.split('.')[0] in SITE_MODULES and module not in SKIPPED_MODULES:
+            return (module, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+class QueryCounter(object):
+
+    """
+    Counts the executed queries per call site, and per query shape for each call site.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.queries = 0
+        self.sites = {}
+        self.shapes = {}
+        self._lock = threading.Lock()
+
+    def record(self, query):
+        site = get_call_site()
+        shape = get_query_shape(query)
+        self._lock.acquire()
+        try:
+            self.queries += 1
+            self.sites[site] = self.sites.get(site, 0) + 1
+            self.shapes[(site, shape)] = self.shapes.get((site, shape), 0) + 1
+        finally:
+            self._lock.release()
+
+    def get_report(self, limit=20):
+
+        """
+        Returns a dictionary with these keys :
+
+            queries : The total number of queries
+            sites : The call sites which executed the most queries, as a list of dictionaries (site, count)
+            repeated : The query shapes executed more than threshold times from the same call site, as a list
+                       of dictionaries (site, shape, count). They are most likely executed in a loop.
+        """
+
+        def format_site(site):
+            return site and '%s:%d (%s)' % site or 'unknown'
+
+        self._lock.acquire()
+        try:
+            sites = sorted(self.sites.items(), key=lambda item: -item[1])
+            repeated = sorted([(key, count) for key, count in self.shapes.items() if count >= self.threshold],
+                key=lambda item: -item[1])
+            queries = self.queries
+        finally:
+            self._lock.release()
+
+        return {
+            'queries' : queries,
+            'sites' : [{'site' : format_site(site), 'count' : count} for site, count in sites[:limit]],
+            'repeated' : [{'site' : format_site(site), 'shape' : shape, 'count' : count}
+                          for (site, shape), count in repeated],
+        }
+
+    def log_report(self):
+        report = self.get_report()
+        lines = ['%d queries' % report['queries']]
+        for item in report['sites']:
+            lines.append('%8d  %s' % (item['count'], item['site']))
+        _logger.info('Rent SQL diagnostics:\n%s', '\n'.join(lines))
+        for item in report['repeated']:
+            _logger.warning('Probable N+1 queries: %d times from %s: %s', item['count'], item['site'], item['shape'])
+        return report
+
+class SqlDiagnostics(object):
+
+    """
+    A diagnostics session. Either a cursor is wrapped explicitly, which is handy in tests :
+
+        diagnostics = SqlDiagnostics()
+        order_pool.get_totals(diagnostics.wrap(cr), uid, ids, None, None, context)
+        report = diagnostics.stop()
+
+    or the session is started, and the queries of all the calls of the rent methods are recorded until it's
+    stopped. It can also be used as a context manager.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.counter = QueryCounter(threshold)
+        self._previous = None
+
+    def wrap(self, cr):
+        return CursorProbe(cr, self.counter)
+
+    def start(self):
+        self._previous = (PROFILER.enabled, PROFILER.counter)
+        PROFILER.counter = self.counter
+        PROFILER.enabled = True
+        return self
+
+    def stop(self, log=True):
+
+        """
+        Stops the session, and returns its report (see QueryCounter.get_report()).
+        """
+
+        if self._previous is not None:
+            PROFILER.enabled, PROFILER.counter = self._previous
+            self._previous = None
+        if log:
+            return self.counter.log_report()
+        return self.counter.get_report()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+# The session started by the server methods or the configuration file
+SESSION = None
+
+if config.get('rent_sql_diagnostics'):
+    SESSION = SqlDiagnostics(int(config.get('rent_sql_diagnostics_threshold') or DEFAULT_THRESHOLD)).start()
+
+class RentProfilingDiagnostics(osv.osv):
+
+    """
+    Adds the SQL diagnostics to the rent profiler. They can also be started from the configuration file with
+    'rent_sql_diagnostics = True' (and optionally 'rent_sql_diagnostics_threshold').
+    """
+
+    _inherit = 'rent.profiling'
+
+    def start_diagnostics(self, cr, uid, threshold=DEFAULT_THRESHOLD, context=None):
+        global SESSION
+        self._check_admin(uid)
+        if SESSION is not None:
+            SESSION.stop(log=False)
+        SESSION = SqlDiagnostics(threshold).start()
+        return True
+
+    def get_diagnostics(self, cr, uid, log=False, context=None):
+
+        """
+        Returns the report of the current diagnostics session, without stopping it.
+        """
+
+        self._check_admin(uid)
+        if SESSION is None:
+            return False
+        if log:
+            return SESSION.counter.log_report()
+        return SESSION.counter.get_report()
+
+    def stop_diagnostics(self, cr, uid, context=None):
+
+        """
+        Stops the current diagnostics session, logs its report and returns it.
+        """
+
+        global SESSION
+        self._check_admin(uid)
+        if SESSION is None:
+            return False
+        report, SESSION = SESSION.stop(), None
+        return report
+
+RentProfilingDiagnostics()
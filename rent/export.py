@@ -0,0 +1,265 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import csv
+import json
+import logging
+import cStringIO
+
+from osv import osv
+from tools import config
+from tools.translate import _
+
+from profiling import report_bugs
+
+_logger = logging.getLogger('rent')
+
+# The exported columns of the orders and of the lines, as (name, SQL expression) tuples. The prices of the lines
+# are computed in SQL, like get_prices() does.
+ORDER_COLUMNS = [
+    ('order_id', 'o.id'),
+    ('reference', 'o.reference'),
+    ('state', 'o.state'),
+    ('description', 'o.description'),
+    ('partner', 'partner.name'),
+    ('partner_ref', 'partner.ref'),
+    ('date_created', 'o.date_created'),
+    ('date_begin_rent', 'o.date_begin_rent'),
+    ('date_end_rent', 'o.date_end_rent'),
+    ('rent_duration', 'o.rent_duration'),
+    ('rent_duration_unity', 'unity.name'),
+    ('date_out_shipping', 'o.date_out_shipping'),
+    ('date_in_shipping', 'o.date_in_shipping'),
+    ('discount', 'o.discount'),
+    ('total', 'o.total'),
+    ('total_taxes', 'o.total_taxes'),
+    ('total_with_taxes', 'o.total_with_taxes'),
+    ('total_with_discount', 'o.total_with_discount'),
+    ('total_taxes_with_discount', 'o.total_taxes_with_discount'),
+    ('total_with_taxes_with_discount', 'o.total_with_taxes_with_discount'),
+    ('invoices', 'invoices.numbers'),
+    ('invoiced_rate', 'CASE WHEN invoices.count > 0 THEN invoices.confirmed * 100.0 / invoices.count ELSE 0.0 END'),
+    ('out_picking_state', 'out_picking.state'),
+    ('in_picking_state', 'in_picking.state'),
+]
+
+LINE_COLUMNS = [
+    ('line_id', 'l.id'),
+    ('line_description', 'l.description'),
+    ('product_code', 'product.default_code'),
+    ('product_type', 'l.product_type'),
+    ('quantity', 'l.quantity'),
+    ('unit_price', 'l.unit_price'),
+    ('line_discount', 'l.discount'),
+    ('real_unit_price', '%(real_unit_price)s'),
+    ('duration_unit_price', '%(duration_unit_price)s'),
+    ('line_price', '(%(duration_unit_price)s) * l.quantity'),
+    ('taxes', 'taxes.names'),
+]
+
+FORMATS = ('csv', 'jsonl')
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if value is None:
+        return ''
+    return value
+
+class RentOrderExport(osv.osv):
+
+    """
+    Streaming export of the rent orders and their lines. The orders are read by pages, using the id as a key (which
+    stays fast on big tables, unlike OFFSET), and the prices and invoices are computed by the queries, so the memory
+    used doesn't depend on the number of exported orders.
+    """
+
+    _inherit = 'rent.order'
+
+    def _export_ids_pages(self, cr, uid, domain, page_size, context=None):
+        query = self._where_calc(cr, uid, domain or [], context=context)
+        self._apply_ir_rules(cr, uid, query, 'read', context=context)
+        from_clause, where_clause, where_params = query.get_sql()
+        last_id = 0
+        while True:
+            cr.execute('SELECT "rent_order".id FROM %s WHERE (%s) AND "rent_order".id > %%s '
+                'ORDER BY "rent_order".id LIMIT %d' % (from_clause, where_clause or 'TRUE', page_size),
+                list(where_params) + [last_id])
+            ids = [row[0] for row in cr.fetchall()]
+            if not ids:
+                return
+            yield ids
+            last_id = ids[-1]
+
+    def _export_orders_page(self, cr, uid, ids, context=None):
+        cr.execute("""
+            SELECT %s
+            FROM rent_order o
+            JOIN res_partner partner ON partner.id = o.partner_id
+            LEFT JOIN product_uom unity ON unity.id = o.rent_duration_unity
+            LEFT JOIN stock_picking out_picking ON out_picking.id = o.out_picking_id
+            LEFT JOIN stock_picking in_picking ON in_picking.id = o.in_picking_id
+            LEFT JOIN (
+                SELECT rel.rent_order_id, COUNT(*) AS count,
+                    SUM(CASE WHEN invoice.state IN ('open', 'paid') THEN 1 ELSE 0 END) AS confirmed,
+                    array_to_string(array_agg(COALESCE(invoice.number, invoice.name, '')), ' ') AS numbers
+                FROM rent_order_invoices rel JOIN account_invoice invoice ON invoice.id = rel.invoice_id
+                WHERE rel.rent_order_id IN %%s
+                GROUP BY rel.rent_order_id
+            ) invoices ON invoices.rent_order_id = o.id
+            WHERE o.id IN %%s
+            ORDER BY o.id
+        """ % ', '.join([expression for name, expression in ORDER_COLUMNS]), (tuple(ids), tuple(ids)))
+        return cr.fetchall()
+
+    def _export_lines_page(self, cr, uid, ids, context=None):
+        # The unit price of rented products is the line unit price converted from the product rent price unity into
+        # the order duration unity (see product.uom._compute_price), the one of services is the line unit price.
+        converted = ("CASE WHEN price_unity.id IS NULL OR order_unity.id IS NULL OR l.unit_price = 0 "
+            "OR price_unity.category_id <> order_unity.category_id THEN l.unit_price "
+            "ELSE l.unit_price * price_unity.factor / order_unity.factor END")
+        rent_price = self.pool.get('rent.order.line')._get_export_rent_price_sql(cr, uid, context=context)
+        prices = {
+            'real_unit_price' : "CASE WHEN l.product_type = 'rent' THEN %s ELSE l.unit_price END" % converted,
+            'duration_unit_price' : "CASE WHEN l.product_type = 'rent' THEN %s ELSE l.unit_price END "
+                "* (1 - COALESCE(l.discount, 0) / 100.0)" % (rent_price % {'price' : converted}),
+        }
+        cr.execute("""
+            SELECT l.order_id, %s
+            FROM rent_order_line l
+            JOIN rent_order o ON o.id = l.order_id
+            JOIN product_product product ON product.id = l.product_id
+            LEFT JOIN product_uom price_unity ON price_unity.id = product.rent_price_unity
+            LEFT JOIN product_uom order_unity ON order_unity.id = o.rent_duration_unity
+            LEFT JOIN (
+                SELECT rel.rent_order_line_id, array_to_string(array_agg(tax.name), ', ') AS names
+                FROM rent_order_line_taxes rel JOIN account_tax tax ON tax.id = rel.tax_id
+                JOIN rent_order_line line ON line.id = rel.rent_order_line_id
+                WHERE line.order_id IN %%s
+                GROUP BY rel.rent_order_line_id
+            ) taxes ON taxes.rent_order_line_id = l.id
+            WHERE l.order_id IN %%s
+            ORDER BY l.order_id, l.id
+        """ % ', '.join([expression % prices for name, expression in LINE_COLUMNS]), (tuple(ids), tuple(ids)))
+        lines = {}
+        for row in cr.fetchall():
+            lines.setdefault(row[0], []).append(row[1:])
+        return lines
+
+    @report_bugs
+    def _iter_export(self, cr, uid, domain=None, with_lines=True, page_size=1000, context=None):
+
+        """
+        Yields the exported orders matching the domain, ordered by id, as dictionaries. If with_lines is True,
+        each one contains its lines (also dictionaries) in 'lines'. See ORDER_COLUMNS and LINE_COLUMNS for the keys.
+        """
+
+        order_names = [name for name, expression in ORDER_COLUMNS]
+        line_names = [name for name, expression in LINE_COLUMNS]
+        for ids in self._export_ids_pages(cr, uid, domain, page_size, context=context):
+            lines = with_lines and self._export_lines_page(cr, uid, ids, context=context) or {}
+            for row in self._export_orders_page(cr, uid, ids, context=context):
+                order = dict(zip(order_names, row))
+                if with_lines:
+                    order['lines'] = [dict(zip(line_names, line)) for line in lines.get(row[0], [])]
+                yield order
+
+    @report_bugs
+    def _iter_export_file(self, cr, uid, format='csv', domain=None, with_lines=True, page_size=1000, context=None):
+
+        """
+        Yields the content of an export file, one page of orders at a time, as UTF-8 strings. The formats are :
+
+            csv : One row per line, the columns of the order are repeated on each of its lines (an order without
+                  lines has one row, with empty lines columns)
+            jsonl : One JSON object per order, its lines are in 'lines'
+        """
+
+        if format not in FORMATS:
+            raise osv.except_osv(_('Error'), _('Unknown export format: %s') % format)
+
+        order_names = [name for name, expression in ORDER_COLUMNS]
+        line_names = with_lines and [name for name, expression in LINE_COLUMNS] or []
+        stream = cStringIO.StringIO()
+        writer = csv.writer(stream)
+        if format == 'csv':
+            writer.writerow(order_names + line_names)
+
+        count = 0
+        for order in self._iter_export(cr, uid, domain, with_lines, page_size, context=context):
+            if format == 'jsonl':
+                stream.write(json.dumps(order, default=str))
+                stream.write('\n')
+            else:
+                order_row = [encode(order[name]) for name in order_names]
+                for line in order.get('lines') or [dict.fromkeys(line_names)]:
+                    writer.writerow(order_row + [encode(line[name]) for name in line_names])
+            count += 1
+            if count % page_size == 0:
+                yield stream.getvalue()
+                stream.seek(0)
+                stream.truncate()
+
+        if stream.tell():
+            yield stream.getvalue()
+        _logger.info('Exported %d rent orders', count)
+
+    @report_bugs
+    def export_to_file(self, cr, uid, path, format='csv', domain=None, with_lines=True, page_size=1000,
+        context=None):
+
+        """
+        Writes the export to a file of the server (see _iter_export_file), and returns True. Only the administrator
+        can export, and the path is relative to the 'rent_export_dir' directory of the server configuration.
+        """
+
+        if uid != 1:
+            raise osv.except_osv(_('Access Denied'), _('Only the administrator can export rent orders to a file.'))
+        directory = config.get('rent_export_dir')
+        if not directory:
+            raise osv.except_osv(_('Error'), _("The 'rent_export_dir' option is not set in the server configuration."))
+        if os.path.isabs(path) or '..' in path.replace('\\', '/').split('/'):
+            raise osv.except_osv(_('Error'), _('The export path must be relative, without "..": %s') % path)
+
+        output = open(os.path.join(directory, path), 'wb')
+        try:
+            for data in self._iter_export_file(cr, uid, format, domain, with_lines, page_size, context=context):
+                output.write(data)
+        finally:
+            output.close()
+        return True
+
+RentOrderExport()
+
+class RentOrderLineExport(osv.osv):
+
+    _inherit = 'rent.order.line'
+
+    def _get_export_rent_price_sql(self, cr, uid, context=None):
+
+        """
+        Returns the SQL expression of the price of a rented product for the whole duration, like get_rent_price()
+        does. '%(price)s' is the unit price, converted into the order duration unity. The line is aliased as 'l',
+        and the order as 'o'.
+        """
+
+        return '(%(price)s) * o.rent_duration'
+
+RentOrderLineExport()
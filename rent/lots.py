@@ -0,0 +1,324 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+
+import psycopg2
+
+from osv import osv, fields
+from tools.translate import _
+
+from profiling import report_bugs
+
+_logger = logging.getLogger('rent')
+
+# Modifying these fields of an order modifies the occupancy of its units.
+OCCUPANCY_FIELDS = ('state', 'date_begin_rent', 'date_out_shipping', 'date_in_shipping', 'rent_duration',
+    'rent_duration_unity')
+
+def create_index(cr, name, table, definition):
+    cr.execute('SELECT indexname FROM pg_indexes WHERE indexname = %s', (name,))
+    if not cr.fetchone():
+        cr.execute('CREATE INDEX %s ON %s %s' % (name, table, definition))
+
+class RentUnitOccupancy(osv.osv):
+
+    """
+    The periods during which the tracked units (production lots or serial numbers) are rented : from the
+    shipping to the return of the order, or its rent dates if the shipping dates are not set. The rows are computed
+    from the lots of the rent order lines (see rent.order._sync_unit_occupancy), the cancelled orders are ignored.
+
+    Both lookups are index scans : the free units of a product are its lots without an overlapping period, and the
+    location of a unit is the destination of its last done move.
+
+    With PostgreSQL 9.2 and the btree_gist extension, an exclusion constraint prevents two overlapping periods of
+    the same unit, even if they're written by concurrent transactions.
+    """
+
+    def _has_exclusion_constraint(self, cr):
+        # The result is kept on this registry instance, like rent.order._has_range_types
+        if getattr(self, '_exclusion_constraint', None) is None:
+            cr.execute("SELECT 1 FROM pg_constraint WHERE conname = 'rent_unit_occupancy_no_overlap'")
+            self._exclusion_constraint = bool(cr.fetchone())
+        return self._exclusion_constraint
+
+    def _init_exclusion_constraint(self, cr):
+        if self._has_exclusion_constraint(cr) or not self.pool.get('rent.order')._has_range_types(cr):
+            return
+        # The btree_gist extension provides the gist operator class of the integers, used by prodlot_id. Creating
+        # it needs enough privileges, and the constraint can't be added if some units are already rented twice.
+        cr.execute('SAVEPOINT rent_unit_occupancy_exclusion')
+        try:
+            cr.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+            # LEAST/GREATEST avoid an invalid range error if the dates are inverted on a row
+            cr.execute("ALTER TABLE rent_unit_occupancy ADD CONSTRAINT rent_unit_occupancy_no_overlap "
+                       "EXCLUDE USING gist (prodlot_id WITH =, "
+                       "tsrange(LEAST(date_begin, date_end), GREATEST(date_begin, date_end)) WITH &&)")
+            cr.execute('RELEASE SAVEPOINT rent_unit_occupancy_exclusion')
+        except Exception:
+            cr.execute('ROLLBACK TO SAVEPOINT rent_unit_occupancy_exclusion')
+            _logger.warning("The rent units occupancy exclusion constraint can't be created, the production lots "
+                            "will be locked instead. Run 'CREATE EXTENSION btree_gist' as a superuser, check that "
+                            "no unit is rented twice and update the module to enable it.")
+        self._exclusion_constraint = None
+
+    def _auto_init(self, cr, context=None):
+        result = super(RentUnitOccupancy, self)._auto_init(cr, context=context)
+        create_index(cr, 'rent_unit_occupancy_prodlot_dates_index', self._table, '(prodlot_id, date_begin, date_end)')
+        create_index(cr, 'rent_unit_occupancy_product_dates_index', self._table, '(product_id, date_begin, date_end)')
+        create_index(cr, 'stock_production_lot_rent_product_index', 'stock_production_lot', '(product_id)')
+        self._init_exclusion_constraint(cr)
+        return result
+
+    @report_bugs
+    def get_free_units(self, cr, uid, product_id, date_begin, date_end, context=None):
+
+        """
+        Returns the ids of the lots of the product which are not rented between the two dates.
+        """
+
+        cr.execute("""
+            SELECT lot.id FROM stock_production_lot lot
+            WHERE lot.product_id = %s AND NOT EXISTS (
+                SELECT 1 FROM rent_unit_occupancy occupancy
+                WHERE occupancy.prodlot_id = lot.id AND occupancy.date_begin < %s AND occupancy.date_end > %s
+            )
+            ORDER BY lot.id
+        """, (product_id, date_end, date_begin))
+        return [row[0] for row in cr.fetchall()]
+
+    @report_bugs
+    def get_unit_location(self, cr, uid, prodlot_id, context=None):
+
+        """
+        Returns a dictionary with these keys :
+
+            location_id : The location where the unit is, from its last done move, as a (id, name) tuple, or False
+            order_id : The rent order which rents it now, as a (id, name) tuple, or False
+        """
+
+        result = {'location_id' : False, 'order_id' : False}
+        cr.execute("""
+            SELECT location_dest_id FROM stock_move
+            WHERE prodlot_id = %s AND state = 'done'
+            ORDER BY date DESC, id DESC LIMIT 1
+        """, (prodlot_id,))
+        row = cr.fetchone()
+        if row:
+            result['location_id'] = self.pool.get('stock.location').name_get(cr, uid, [row[0]], context=context)[0]
+        cr.execute("""
+            SELECT order_id FROM rent_unit_occupancy
+            WHERE prodlot_id = %s
+                AND date_begin <= (now() AT TIME ZONE 'UTC') AND date_end > (now() AT TIME ZONE 'UTC')
+            ORDER BY date_begin DESC LIMIT 1
+        """, (prodlot_id,))
+        row = cr.fetchone()
+        if row:
+            result['order_id'] = self.pool.get('rent.order').name_get(cr, uid, [row[0]], context=context)[0]
+        return result
+
+    _name = 'rent.unit.occupancy'
+    _rec_name = 'prodlot_id'
+    _order = 'date_begin'
+
+    _columns = {
+        'prodlot_id' : fields.many2one('stock.production.lot', 'Production Lot', required=True, readonly=True,
+            ondelete='CASCADE'),
+        'product_id' : fields.many2one('product.product', 'Product', required=True, readonly=True,
+            ondelete='CASCADE'),
+        'order_id' : fields.many2one('rent.order', 'Rent Order', required=True, readonly=True, select=True,
+            ondelete='CASCADE'),
+        'line_id' : fields.many2one('rent.order.line', 'Rent Order Line', required=True, readonly=True,
+            ondelete='CASCADE'),
+        'date_begin' : fields.datetime('Begin', required=True, readonly=True),
+        'date_end' : fields.datetime('End', required=True, readonly=True),
+    }
+
+RentUnitOccupancy()
+
+class RentOrderLots(osv.osv):
+
+    _inherit = 'rent.order'
+
+    def _sync_unit_occupancy(self, cr, uid, ids, context=None):
+
+        """
+        Computes again the occupancy of the units of the orders, and checks that no unit is rented twice at the same
+        time. Without the exclusion constraint (see rent.unit.occupancy), the lots are locked until the end of the
+        transaction, so two transactions can't rent the same unit.
+
+        The orders created by renew_orders() and bulk_import() have no lots (the lots of the renewed orders are not
+        copied, like in copy_data()), so they have no occupancy to compute.
+        """
+
+        if not ids:
+            return
+        ids = tuple(ids)
+        if not self.pool.get('rent.unit.occupancy')._has_exclusion_constraint(cr):
+            cr.execute("""
+                SELECT id FROM stock_production_lot WHERE id IN (
+                    SELECT rel.prodlot_id FROM rent_order_line_lots rel
+                    JOIN rent_order_line l ON l.id = rel.rent_order_line_id
+                    WHERE l.order_id IN %s
+                )
+                ORDER BY id FOR UPDATE
+            """, (ids,))
+        cr.execute('DELETE FROM rent_unit_occupancy WHERE order_id IN %s', (ids,))
+        cr.execute('SAVEPOINT rent_unit_occupancy')
+        try:
+            cr.execute("""
+                INSERT INTO rent_unit_occupancy (prodlot_id, product_id, order_id, line_id, date_begin, date_end)
+                SELECT rel.prodlot_id, l.product_id, o.id, l.id, COALESCE(o.date_out_shipping, o.date_begin_rent),
+                    COALESCE(o.date_in_shipping, o.date_end_rent)
+                FROM rent_order_line_lots rel
+                JOIN rent_order_line l ON l.id = rel.rent_order_line_id
+                JOIN rent_order o ON o.id = l.order_id
+                WHERE o.id IN %s AND o.state <> 'cancelled'
+                    AND COALESCE(o.date_in_shipping, o.date_end_rent) IS NOT NULL
+            """, (ids,))
+        except psycopg2.IntegrityError:
+            # Violation of the exclusion constraint
+            cr.execute('ROLLBACK TO SAVEPOINT rent_unit_occupancy')
+            raise osv.except_osv(_('Error'), _('A unit of these orders is already rented during this period.'))
+        cr.execute('RELEASE SAVEPOINT rent_unit_occupancy')
+        cr.execute("""
+            SELECT lot.name FROM rent_unit_occupancy occupancy
+            JOIN rent_unit_occupancy other ON other.prodlot_id = occupancy.prodlot_id AND other.id <> occupancy.id
+                AND other.date_begin < occupancy.date_end AND other.date_end > occupancy.date_begin
+            JOIN stock_production_lot lot ON lot.id = occupancy.prodlot_id
+            WHERE occupancy.order_id IN %s LIMIT 1
+        """, (ids,))
+        row = cr.fetchone()
+        if row:
+            raise osv.except_osv(_('Error'), _('The unit %s is already rented during this period.') % row[0])
+
+    def write(self, cr, uid, ids, vals, context=None):
+        result = super(RentOrderLots, self).write(cr, uid, ids, vals, context=context)
+        if set(vals) & set(OCCUPANCY_FIELDS):
+            self._sync_unit_occupancy(cr, uid, isinstance(ids, (int, long)) and [ids] or ids, context=context)
+        return result
+
+    def restore_orders(self, cr, uid, ids, context=None):
+        result = super(RentOrderLots, self).restore_orders(cr, uid, ids, context=context)
+        self._sync_unit_occupancy(cr, uid, ids, context=context)
+        return result
+
+RentOrderLots()
+
+class RentOrderLineLots(osv.osv):
+
+    """
+    High-value products can be tracked by unit : the production lots (or serial numbers) of the rented units are
+    assigned to the line, and each of them gets its own out move.
+    """
+
+    _inherit = 'rent.order.line'
+
+    def _get_order_ids(self, cr, ids):
+        cr.execute('SELECT DISTINCT order_id FROM rent_order_line WHERE id IN %s', (tuple(ids),))
+        return [row[0] for row in cr.fetchall()]
+
+    def get_out_moves_values(self, cr, uid, line, values, context=None):
+
+        """
+        One move of one unit is created for each lot, the quantity without lots is moved by a last move.
+        """
+
+        moves_values = super(RentOrderLineLots, self).get_out_moves_values(cr, uid, line, values, context=context)
+        if not line.prodlot_ids:
+            return moves_values
+        result = []
+        for move_values in moves_values:
+            for lot in line.prodlot_ids:
+                result.append(dict(move_values, prodlot_id=lot.id, product_qty=1, product_uos_qty=1))
+            remaining = move_values['product_qty'] - len(line.prodlot_ids)
+            if remaining > 0:
+                result.append(dict(move_values, product_qty=remaining, product_uos_qty=remaining))
+        return result
+
+    def copy_data(self, cr, uid, id, default=None, context=None):
+        # The units of the copy can't be the same, if they're rented at the same time
+        default = dict(default or {}, prodlot_ids=[])
+        return super(RentOrderLineLots, self).copy_data(cr, uid, id, default, context=context)
+
+    def check_prodlots(self, cr, uid, ids, context=None):
+
+        """
+        The lots must be lots of the product of the line, and there can't be more lots than the quantity.
+        """
+
+        if not ids:
+            return True
+        cr.execute("""
+            SELECT l.id FROM rent_order_line l
+            JOIN rent_order_line_lots rel ON rel.rent_order_line_id = l.id
+            JOIN stock_production_lot lot ON lot.id = rel.prodlot_id
+            WHERE l.id IN %s
+            GROUP BY l.id, l.quantity
+            HAVING COUNT(*) > l.quantity OR bool_or(lot.product_id <> l.product_id)
+            LIMIT 1
+        """, (tuple(ids),))
+        return not cr.fetchone()
+
+    def create(self, cr, uid, vals, context=None):
+        line_id = super(RentOrderLineLots, self).create(cr, uid, vals, context=context)
+        if vals.get('prodlot_ids'):
+            self.pool.get('rent.order')._sync_unit_occupancy(cr, uid, self._get_order_ids(cr, [line_id]),
+                context=context)
+        return line_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        # The line may be moved to another order
+        order_ids = 'prodlot_ids' in vals and ids and self._get_order_ids(cr, ids) or []
+        result = super(RentOrderLineLots, self).write(cr, uid, ids, vals, context=context)
+        if order_ids:
+            self.pool.get('rent.order')._sync_unit_occupancy(cr, uid, list(set(order_ids +
+                self._get_order_ids(cr, ids))), context=context)
+        return result
+
+    _columns = {
+        'prodlot_ids' : fields.many2many('stock.production.lot', 'rent_order_line_lots', 'rent_order_line_id',
+            'prodlot_id', 'Production Lots', readonly=True, states={'draft' : [('readonly', False)]}, help=
+            'The production lots (or serial numbers) of the rented units.'),
+    }
+
+    _constraints = [
+        (check_prodlots, "The production lots must be lots of the product, and there can't be more lots than the "
+            "quantity.", ['prodlot_ids']),
+    ]
+
+RentOrderLineLots()
+
+class StockMoveLots(osv.osv):
+
+    """
+    The last done move of a unit gives its location (see rent.unit.occupancy.get_unit_location).
+    """
+
+    _inherit = 'stock.move'
+
+    def _auto_init(self, cr, context=None):
+        result = super(StockMoveLots, self)._auto_init(cr, context=context)
+        create_index(cr, 'stock_move_rent_prodlot_done_index', 'stock_move',
+            "(prodlot_id, date) WHERE state = 'done' AND prodlot_id IS NOT NULL")
+        return result
+
+StockMoveLots()
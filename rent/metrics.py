@@ -0,0 +1,230 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+
+from osv import osv
+from tools import config
+
+_logger = logging.getLogger('rent')
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def format_labels(labels, extra=None):
+    items = list(labels) + (extra and [extra] or [])
+    if not items:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in items])
+
+class Counter(object):
+
+    """
+    A value which only increases, like the number of created invoices.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + value
+        finally:
+            self._lock.release()
+
+    def export(self):
+        self._lock.acquire()
+        try:
+            values = self.values.items()
+        finally:
+            self._lock.release()
+        return ['%s%s %s' % (self.name, format_labels(labels), repr(float(value))) for labels, value in values]
+
+class Histogram(object):
+
+    """
+    Counts the observed values (durations for example) in buckets, and keeps their sum and their count.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        self._lock.acquire()
+        try:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+        finally:
+            self._lock.release()
+
+    def export(self):
+        self._lock.acquire()
+        try:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        finally:
+            self._lock.release()
+        lines = []
+        for labels, counts, total in values:
+            cumulated = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulated += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(labels, ('le', bucket)), cumulated))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(labels), repr(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(labels), cumulated))
+        return lines
+
+    def time(self, **labels):
+
+        """
+        Returns a decorator which observes the duration of each call of the decorated method. If the first argument
+        is a cursor, the database name is added to the labels.
+        """
+
+        def decorator(function):
+            def wrapper(self_, *args, **kwargs):
+                start = time.time()
+                try:
+                    return function(self_, *args, **kwargs)
+                finally:
+                    db = args and getattr(args[0], 'dbname', None)
+                    if db:
+                        self.observe(time.time() - start, db=db, **labels)
+                    else:
+                        self.observe(time.time() - start, **labels)
+            wrapper.__name__ = function.__name__
+            wrapper.__doc__ = function.__doc__
+            wrapper.__module__ = function.__module__
+            return wrapper
+        return decorator
+
+class MetricsRegistry(object):
+
+    """
+    Holds the metrics of the process, and exports them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def export(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.export())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+INVOICES_CREATED = REGISTRY.counter('rent_invoices_created_total', 'Invoices created by the invoices cron.')
+ORDERS_STARTED = REGISTRY.counter('rent_orders_started_total', 'Service-only rent orders started by the cron.')
+ORDERS_STOPPED = REGISTRY.counter('rent_orders_stopped_total', 'Service-only rent orders stopped by the cron.')
+PICKINGS_CREATED = REGISTRY.counter('rent_pickings_created_total', 'Pickings created for rent orders.')
+TOTALS_COMPUTED = REGISTRY.counter('rent_totals_computed_total', 'Rent orders whose stored totals were computed.')
+CRON_DURATION = REGISTRY.histogram('rent_cron_duration_seconds', 'Duration of the rent crons runs.')
+ONCHANGE_DURATION = REGISTRY.histogram('rent_onchange_duration_seconds', 'Duration of the rent onchange methods.',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        content = REGISTRY.export()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        _logger.debug('Metrics request: ' + format, *args)
+
+HTTP_SERVER = None
+
+def start_http_server(port, host='127.0.0.1'):
+
+    """
+    Serves the metrics on http://host:port/metrics, from a daemon thread. It is started once per process.
+    """
+
+    global HTTP_SERVER
+    if HTTP_SERVER is not None:
+        return HTTP_SERVER
+    try:
+        HTTP_SERVER = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    except Exception:
+        _logger.exception('Unable to serve the rent metrics on %s:%d', host, port)
+        return None
+    thread = threading.Thread(target=HTTP_SERVER.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    _logger.info('Serving the rent metrics on http://%s:%d/metrics', host, port)
+    return HTTP_SERVER
+
+if config.get('rent_metrics_port'):
+    start_http_server(int(config.get('rent_metrics_port')), config.get('rent_metrics_host') or '127.0.0.1')
+
+class RentMetrics(osv.osv):
+
+    """
+    Exposes the rent metrics in the Prometheus text format, for the scrapers which use XML-RPC. They can also be
+    served over HTTP with the 'rent_metrics_port' (and 'rent_metrics_host') options of the configuration file.
+    """
+
+    def export(self, cr, uid, context=None):
+        return REGISTRY.export()
+
+    _name = 'rent.metrics'
+    _auto = False
+    _columns = {}
+
+RentMetrics()
@@ -0,0 +1,122 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from osv import osv, fields
+
+from openlib.orm import *
+from profiling import report_bugs
+
+from cache import RegistryCache
+
+# The resolved addresses of each partner are kept for a short time only: the cache is invalidated when an address
+# is modified by this server, but other servers using the same database can't notify us.
+ADDRESSES_CACHE = RegistryCache(timeout=60, size=20000)
+
+# Maximum number of partners resolved by one query.
+ADDRESSES_CHUNK_SIZE = 1000
+
+class Partner(osv.osv, ExtendedOsv):
+
+    _inherit = 'res.partner'
+
+    @report_bugs
+    def get_rent_addresses(self, cr, uid, ids, context=None):
+
+        """
+        Returns the addresses used by rent orders for the specified partners. The result is a dictionary containing
+        partners ids as keys, and a dictionary as value with these keys :
+
+            default : The id of the first default address of the partner, or False
+            invoice : The id of the first invoice address of the partner, or False
+            delivery : The id of the first delivery address of the partner, or False
+
+        Only the first address of each type is fetched, with one query for all the partners.
+        """
+
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+
+        result = ADDRESSES_CACHE.get_many(cr.dbname, ids)
+        missing_ids = list(set(ids) - set(result))
+
+        for index in range(0, len(missing_ids), ADDRESSES_CHUNK_SIZE):
+            chunk_ids = missing_ids[index:index+ADDRESSES_CHUNK_SIZE]
+            chunk_result = dict((partner_id, {'default' : False, 'invoice' : False, 'delivery' : False})
+                for partner_id in chunk_ids)
+            cr.execute("""
+                SELECT DISTINCT ON (partner_id, type) partner_id, type, id
+                FROM res_partner_address
+                WHERE partner_id IN %s AND type IN ('default', 'invoice', 'delivery') AND active
+                ORDER BY partner_id, type, id
+            """, (tuple(chunk_ids),))
+            for partner_id, address_type, address_id in cr.fetchall():
+                chunk_result[partner_id][address_type] = address_id
+            for partner_id, addresses in chunk_result.items():
+                ADDRESSES_CACHE.set(cr.dbname, partner_id, addresses)
+            result.update(chunk_result)
+
+        # We return copies, the callers must not be able to modify the cached values
+        return dict((partner_id, dict(addresses)) for partner_id, addresses in result.items())
+
+Partner()
+
+class PartnerAddress(osv.osv):
+
+    """
+    Addresses are indexed by partner and type, and modifications invalidate the rent addresses cache.
+    """
+
+    _inherit = 'res.partner.address'
+
+    def _auto_init(self, cr, context=None):
+        result = super(PartnerAddress, self)._auto_init(cr, context=context)
+        cr.execute("SELECT indexname FROM pg_indexes WHERE indexname = 'res_partner_address_rent_partner_type_index'")
+        if not cr.fetchone():
+            cr.execute('CREATE INDEX res_partner_address_rent_partner_type_index '
+                       'ON res_partner_address (partner_id, type, id)')
+        return result
+
+    def _invalidate_rent_addresses(self, cr, ids):
+        if not ids:
+            return
+        cr.execute('SELECT DISTINCT partner_id FROM res_partner_address WHERE id IN %s AND partner_id IS NOT NULL',
+            (tuple(ids),))
+        ADDRESSES_CACHE.invalidate(cr.dbname, [row[0] for row in cr.fetchall()])
+
+    def create(self, cr, uid, vals, context=None):
+        address_id = super(PartnerAddress, self).create(cr, uid, vals, context=context)
+        self._invalidate_rent_addresses(cr, [address_id])
+        return address_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        # Invalidate both the old partners and the new ones, in the case of the address moved
+        self._invalidate_rent_addresses(cr, ids)
+        result = super(PartnerAddress, self).write(cr, uid, ids, vals, context=context)
+        self._invalidate_rent_addresses(cr, ids)
+        return result
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self._invalidate_rent_addresses(cr, ids)
+        return super(PartnerAddress, self).unlink(cr, uid, ids, context=context)
+
+PartnerAddress()
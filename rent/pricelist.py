@@ -0,0 +1,448 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+from osv import osv, fields
+from tools.misc import DEFAULT_SERVER_DATE_FORMAT
+
+from profiling import report_bugs
+from cache import RegistryCache
+
+# The compiled pricelists, indexed by pricelist id. The timeout lets the servers sharing a database see the
+# modifications done by the others.
+PRICELISTS_CACHE = RegistryCache(timeout=300)
+
+# Maximum number of products read by one query when pricing.
+PRICING_CHUNK_SIZE = 1000
+
+# The unit prices of the lines are displayed with 2 digits : a price typed by the user is compared to the pricelist
+# prices with this precision.
+PRICE_DIGITS = 2
+
+class CompiledRule(object):
+
+    """
+    The in-memory form of a pricelist rule. Dates are strings (YYYY-MM-DD), so they are compared as is.
+    """
+
+    def __init__(self, rule_id, min_quantity, date_start, date_end, price_type, fixed_price, discount, surcharge):
+        self.rule_id = rule_id
+        self.price_type = price_type or 'formula'
+        self.min_quantity = min_quantity or 0
+        self.date_start = date_start or None
+        self.date_end = date_end or None
+        self.fixed_price = fixed_price or 0.0
+        self.discount = discount or 0.0
+        self.surcharge = surcharge or 0.0
+
+    def matches(self, quantity, date):
+        # If quantity is None, the rule matches any quantity
+        if quantity is not None and quantity < self.min_quantity:
+            return False
+        if self.date_start and date < self.date_start:
+            return False
+        if self.date_end and date > self.date_end:
+            return False
+        return True
+
+    def compute(self, price):
+        if self.price_type == 'fixed':
+            return self.fixed_price
+        return price * (1 - self.discount / 100.0) + self.surcharge
+
+class CompiledPricelist(object):
+
+    """
+    The rules of a pricelist, indexed by product, by product category, and the ones which apply to all products.
+    The rules of each index are sorted by sequence, then by decreasing minimum quantity, so the first matching rule
+    is the one to use. The parents of the categories (as a dictionary of ids) are used to find the rules of the
+    child categories.
+    """
+
+    def __init__(self, pricelist_id, rules, parents=None):
+        self.pricelist_id = pricelist_id
+        self.parents = parents or {}
+        self.products = {}
+        self.categories = {}
+        self.default = []
+        for sequence, product_id, categ_id, rule in sorted(rules, key=lambda item: (item[0], -item[3].min_quantity,
+            item[3].rule_id)):
+            if product_id:
+                self.products.setdefault(product_id, []).append(rule)
+            elif categ_id:
+                self.categories.setdefault(categ_id, []).append(rule)
+            else:
+                self.default.append(rule)
+
+    def iter_rules(self, product_id, categ_id, quantity, date):
+
+        """
+        Yields the matching rules of a product, in the order they are used : the rules of the product first, then
+        the ones of its category, then the ones of the parents of its category, then the ones without product and
+        category. If quantity is None, the minimum quantities are ignored.
+        """
+
+        for rule in self.products.get(product_id, ()):
+            if rule.matches(quantity, date):
+                yield rule
+        if self.categories:
+            while categ_id:
+                for rule in self.categories.get(categ_id, ()):
+                    if rule.matches(quantity, date):
+                        yield rule
+                categ_id = self.parents.get(categ_id)
+        for rule in self.default:
+            if rule.matches(quantity, date):
+                yield rule
+
+    def get_price(self, product_id, categ_id, price, quantity, date):
+
+        """
+        Returns the price given by the first matching rule. The rules giving a price which is not positive (with a
+        negative surcharge for example) are ignored, because the rent order lines refuse it.
+        """
+
+        for rule in self.iter_rules(product_id, categ_id, quantity, date):
+            rule_price = rule.compute(price)
+            if rule_price > 0:
+                return rule_price
+        return price
+
+    def get_prices(self, product_id, categ_id, price, date):
+
+        """
+        Returns the prices the pricelist can give to the product at this date, whatever the quantity, the price
+        of the product included.
+        """
+
+        return set([price] + [rule_price for rule_price in [rule.compute(price) for rule in
+            self.iter_rules(product_id, categ_id, None, date)] if rule_price > 0])
+
+class RentPricelist(osv.osv):
+
+    """
+    A rent pricelist gives the rent price of the products for the customers who use it, depending of the product
+    (or its category), the rented quantity and the rent begin date. The prices are expressed in the product rent
+    price unity, like the unit price of the rent order lines.
+
+    The rules of a pricelist are compiled once (see CompiledPricelist), so pricing many lines only needs one query
+    to read the products.
+    """
+
+    def __init__(self, pool, cr):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        super(RentPricelist, self).__init__(pool, cr)
+
+    @report_bugs
+    def get_compiled_pricelist(self, cr, uid, pricelist_id, context=None):
+
+        """
+        Returns the CompiledPricelist of the pricelist. Pricelists are compiled once, and kept in memory until one of
+        them (or a product category) is modified.
+        """
+
+        compiled = PRICELISTS_CACHE.get(cr.dbname, pricelist_id)
+        if compiled is not None:
+            return compiled
+
+        cr.execute("""
+            SELECT rule.id, rule.sequence, rule.product_id, rule.categ_id, rule.min_quantity, rule.date_start,
+                rule.date_end, rule.price_type, rule.fixed_price, rule.price_discount, rule.price_surcharge
+            FROM rent_pricelist_rule rule
+            JOIN rent_pricelist pricelist ON pricelist.id = rule.pricelist_id
+            WHERE rule.pricelist_id = %s AND pricelist.active
+        """, (pricelist_id,))
+        rules = [(sequence, product_id, categ_id, CompiledRule(rule_id, min_quantity, date_start, date_end,
+            price_type, fixed_price, discount, surcharge)) for rule_id, sequence, product_id, categ_id, min_quantity,
+            date_start, date_end, price_type, fixed_price, discount, surcharge in cr.fetchall()]
+
+        parents = {}
+        if [rule for rule in rules if rule[2] and not rule[1]]:
+            cr.execute('SELECT id, parent_id FROM product_category WHERE parent_id IS NOT NULL')
+            parents = dict(cr.fetchall())
+
+        compiled = CompiledPricelist(pricelist_id, rules, parents)
+        PRICELISTS_CACHE.set(cr.dbname, pricelist_id, compiled)
+        return compiled
+
+    @report_bugs
+    def get_partner_pricelists(self, cr, uid, partner_ids, context=None):
+
+        """
+        Returns the rent pricelist of the partners, as a dictionary with partners ids as keys, and pricelists ids
+        (or False) as values.
+        """
+
+        partner_ids = list(set(partner_ids) - set([False, None]))
+        if not partner_ids:
+            return {}
+        cr.execute('SELECT id, rent_pricelist_id FROM res_partner WHERE id IN %s', (tuple(partner_ids),))
+        return dict((partner_id, pricelist_id or False) for partner_id, pricelist_id in cr.fetchall())
+
+    @report_bugs
+    def get_rent_prices(self, cr, uid, items, context=None):
+
+        """
+        Returns the rent prices of a list of items, in the same order. Each item is a (pricelist_id, product_id,
+        quantity, date) tuple : if pricelist_id is False, the rent price of the product is returned. The date is
+        the rent begin date (only the date part is used), today if False.
+
+        The products are read with one query by chunk of PRICING_CHUNK_SIZE, the rest is done in memory.
+        """
+
+        product_ids = list(set([item[1] for item in items]))
+        products = {}
+        for index in range(0, len(product_ids), PRICING_CHUNK_SIZE):
+            cr.execute("""
+                SELECT product.id, product.rent_price, tmpl.categ_id FROM product_product product
+                JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+                WHERE product.id IN %s
+            """, (tuple(product_ids[index:index+PRICING_CHUNK_SIZE]),))
+            products.update((product_id, (rent_price or 0.0, categ_id)) for product_id, rent_price, categ_id
+                in cr.fetchall())
+
+        today = time.strftime(DEFAULT_SERVER_DATE_FORMAT)
+        compiled = {}
+        prices = []
+        for pricelist_id, product_id, quantity, date in items:
+            rent_price, categ_id = products.get(product_id, (0.0, False))
+            if not pricelist_id:
+                prices.append(rent_price)
+                continue
+            if pricelist_id not in compiled:
+                compiled[pricelist_id] = self.get_compiled_pricelist(cr, uid, pricelist_id, context=context)
+            prices.append(compiled[pricelist_id].get_price(
+                product_id, categ_id, rent_price, quantity or 0, date and date[:10] or today))
+        return prices
+
+    @report_bugs
+    def get_possible_rent_prices(self, cr, uid, pricelist_id, product_id, date, context=None):
+
+        """
+        Returns the set of the rent prices the pricelist can give to the product at this date (today if False),
+        whatever the quantity. The rent price of the product is included.
+        """
+
+        cr.execute("""
+            SELECT product.rent_price, tmpl.categ_id FROM product_product product
+            JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+            WHERE product.id = %s
+        """, (product_id,))
+        rent_price, categ_id = cr.fetchone() or (0.0, False)
+        compiled = self.get_compiled_pricelist(cr, uid, pricelist_id, context=context)
+        return compiled.get_prices(product_id, categ_id, rent_price or 0.0,
+            date and date[:10] or time.strftime(DEFAULT_SERVER_DATE_FORMAT))
+
+    def create(self, cr, uid, vals, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(RentPricelist, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(RentPricelist, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(RentPricelist, self).unlink(cr, uid, ids, context=context)
+
+    _name = 'rent.pricelist'
+
+    _columns = {
+        'name' : fields.char('Name', size=64, required=True, translate=True),
+        'active' : fields.boolean('Active', help='If unchecked, the customers using this pricelist pay the '
+            'rent price of the products.'),
+        'rule_ids' : fields.one2many('rent.pricelist.rule', 'pricelist_id', 'Rules'),
+    }
+
+    _defaults = {
+        'active' : True,
+    }
+
+RentPricelist()
+
+class RentPricelistRule(osv.osv):
+
+    """
+    A rule of a rent pricelist. The rule price is the fixed price, or the rent price of the product with the
+    discount and the surcharge applied, depending on the price type.
+    """
+
+    def _auto_init(self, cr, context=None):
+        cr.execute("""
+            SELECT 1 FROM pg_attribute attribute JOIN pg_class class ON class.oid = attribute.attrelid
+            WHERE class.relname = %s AND attribute.attname = 'price_type'
+        """, (self._table,))
+        migrate = not cr.fetchone()
+        result = super(RentPricelistRule, self)._auto_init(cr, context=context)
+        if migrate:
+            # The rules were using the fixed price when it was set
+            cr.execute("UPDATE rent_pricelist_rule SET price_type = 'fixed' WHERE fixed_price > 0")
+        return result
+
+    def create(self, cr, uid, vals, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(RentPricelistRule, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(RentPricelistRule, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(RentPricelistRule, self).unlink(cr, uid, ids, context=context)
+
+    _name = 'rent.pricelist.rule'
+    _order = 'sequence, min_quantity desc, id'
+    _rec_name = 'sequence'
+
+    _columns = {
+        'pricelist_id' : fields.many2one('rent.pricelist', 'Pricelist', required=True, select=True,
+            ondelete='CASCADE'),
+        'sequence' : fields.integer('Sequence', help='The first matching rule is used. The rules of a product are '
+            'used before the ones of a category, which are used before the others.'),
+        'product_id' : fields.many2one('product.product', 'Product', ondelete='CASCADE', help=
+            'If set, this rule is only used for this product.'),
+        'categ_id' : fields.many2one('product.category', 'Product Category', ondelete='CASCADE', help=
+            'If set, this rule is only used for the products of this category.'),
+        'min_quantity' : fields.integer('Minimum Quantity', help='The rule is used when at least this quantity '
+            'is rented.'),
+        'date_start' : fields.date('Start Date', help='If set, the rule is used for the rents beginning after '
+            'this date.'),
+        'date_end' : fields.date('End Date', help='If set, the rule is used for the rents beginning before '
+            'this date.'),
+        'price_type' : fields.selection([('formula', 'Discount and surcharge'), ('fixed', 'Fixed price')],
+            'Price Type', required=True, help='With a fixed price, the fixed price is used. Otherwise, the discount '
+            'and the surcharge are applied to the rent price of the product : if the result is not positive, the '
+            'rule is ignored.'),
+        'fixed_price' : fields.float('Fixed Price', help='The price used by the fixed price rules, expressed in the '
+            'rent price unity of the product.'),
+        'price_discount' : fields.float('Discount (%)', digits=(16, 2)),
+        'price_surcharge' : fields.float('Surcharge', help='Added to the rent price after the discount.'),
+    }
+
+    _defaults = {
+        'sequence' : 10,
+        'min_quantity' : 0,
+        'price_type' : 'formula',
+    }
+
+    _sql_constraints = [
+        ('valid_dates', 'check(date_start IS NULL OR date_end IS NULL OR date_start <= date_end)',
+            'The start date must be before the end date.'),
+        ('valid_discount', 'check(price_discount IS NULL OR price_discount < 100)',
+            'The discount must be lower than 100.'),
+        ('valid_fixed_price', "check(price_type <> 'fixed' OR fixed_price > 0)", 'The fixed price must be positive.'),
+    ]
+
+RentPricelistRule()
+
+class ProductCategoryPricelist(osv.osv):
+
+    """
+    The compiled pricelists use the parents of the categories, they are compiled again when a category is modified.
+    """
+
+    _inherit = 'product.category'
+
+    def create(self, cr, uid, vals, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(ProductCategoryPricelist, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(ProductCategoryPricelist, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        PRICELISTS_CACHE.invalidate(cr.dbname)
+        return super(ProductCategoryPricelist, self).unlink(cr, uid, ids, context=context)
+
+ProductCategoryPricelist()
+
+class PartnerPricelist(osv.osv):
+
+    _inherit = 'res.partner'
+
+    _columns = {
+        'rent_pricelist_id' : fields.many2one('rent.pricelist', 'Rent Pricelist', ondelete='SET NULL', help=
+            'The pricelist used to compute the rent prices of this customer.'),
+    }
+
+PartnerPricelist()
+
+class RentOrderLinePricelist(osv.osv):
+
+    """
+    The unit price of the rented products is taken from the pricelist of the customer, when the product or the
+    quantity is modified. The view must pass the customer and the rent begin date in the context ('partner_id' and
+    'date_begin_rent').
+    """
+
+    _inherit = 'rent.order.line'
+
+    def _get_pricelist_id(self, cr, uid, context=None):
+        if not context or not context.get('partner_id'):
+            return False
+        return self.pool.get('rent.pricelist').get_partner_pricelists(
+            cr, uid, [context['partner_id']], context=context).get(context['partner_id'])
+
+    def _get_pricelist_unit_price(self, cr, uid, product_id, quantity, context=None):
+        pricelist_id = product_id and self._get_pricelist_id(cr, uid, context=context)
+        if not pricelist_id:
+            return None
+        return self.pool.get('rent.pricelist').get_rent_prices(cr, uid, [(pricelist_id, product_id, quantity,
+            context.get('date_begin_rent'))], context=context)[0]
+
+    def _is_pricelist_price(self, cr, uid, product_id, unit_price, context=None):
+        # True if the price is one of the prices the pricelist gives to the product, so it wasn't typed by the user
+        pricelist_id = self._get_pricelist_id(cr, uid, context=context)
+        if not pricelist_id:
+            return False
+        prices = self.pool.get('rent.pricelist').get_possible_rent_prices(cr, uid, pricelist_id, product_id,
+            context.get('date_begin_rent'), context=context)
+        return round(unit_price or 0.0, PRICE_DIGITS) in set([round(price, PRICE_DIGITS) for price in prices])
+
+    @report_bugs
+    def on_product_changed(self, cr, uid, ids, product_id, quantity, context=None):
+        result = super(RentOrderLinePricelist, self).on_product_changed(cr, uid, ids, product_id, quantity, context)
+        if result and result['value'].get('product_type') == 'rent':
+            unit_price = self._get_pricelist_unit_price(cr, uid, product_id, quantity, context=context)
+            if unit_price is not None:
+                result['value']['unit_price'] = unit_price
+        return result
+
+    @report_bugs
+    def on_quantity_changed(self, cr, uid, ids, product_id, quantity, unit_price=None, context=None):
+
+        """
+        The price of the new quantity replaces the unit price, unless it has been typed by the user : it's only
+        replaced if it's the rent price of the product or another price of the pricelist.
+        """
+
+        result = super(RentOrderLinePricelist, self).on_quantity_changed(cr, uid, ids, product_id, quantity,
+            unit_price, context=context)
+        if result and self.pool.get('product.product').read(cr, uid, product_id, ['can_be_rent'],
+            context=context)['can_be_rent']:
+            new_price = self._get_pricelist_unit_price(cr, uid, product_id, quantity, context=context)
+            if new_price is not None and (unit_price is None or
+                self._is_pricelist_price(cr, uid, product_id, unit_price, context=context)):
+                result['value']['unit_price'] = new_price
+        return result
+
+RentOrderLinePricelist()
@@ -23,7 +23,7 @@ from osv import osv, fields
 from tools.translate import _
 
 from openlib.orm import *
-from openlib.github import report_bugs
+from profiling import report_bugs
 
 _logger = logging.getLogger('rent')
 
@@ -36,13 +36,23 @@ class Product(osv.osv, ExtendedOsv):
         We check that the rent price is neither empty or 0 if the product can be rent.
         """
 
-        products = self.filter(ids)
+        return not self.get_invalid_rent_price_ids(cr, uid, ids, context=context)
 
-        for product in products:
-            if product.can_be_rent:
-                if not product.rent_price or product.rent_price <= 0:
-                    return False
-        return True
+    @report_bugs
+    def get_invalid_rent_price_ids(self, cr, uid, ids=None, context=None):
+
+        """
+        Returns the ids of the rentable products (all of them if ids is None) without a positive rent price, with
+        one query.
+        """
+
+        if ids is not None and not ids:
+            return []
+        cr.execute("""
+            SELECT id FROM product_product
+            WHERE can_be_rent AND (rent_price IS NULL OR rent_price <= 0) %s ORDER BY id
+        """ % (ids is not None and 'AND id IN %s' or ''), ids is not None and (tuple(ids),) or ())
+        return [row[0] for row in cr.fetchall()]
 
     @report_bugs
     def default_price_unity(self, cr, uid, context=None):
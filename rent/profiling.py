@@ -0,0 +1,305 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+import pstats
+import logging
+import cProfile
+import threading
+
+from osv import osv
+from tools import config
+from sql_db import Cursor
+from tools.translate import _
+
+from openlib.github import report_bugs as github_report_bugs
+
+_logger = logging.getLogger('rent')
+
+class CursorProbe(object):
+
+    """
+    Wraps a cursor to count the executed queries and the fetched rows. Everything else is delegated to the cursor.
+    If a counter is given (see diagnostics.QueryCounter), each query is also recorded by it.
+    """
+
+    def __init__(self, cursor, counter=None):
+        self._cursor = cursor
+        self.counter = counter
+        self.queries = 0
+        self.rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, query, *args, **kwargs):
+        self.queries += 1
+        if self.counter is not None:
+            self.counter.record(query)
+        return self._cursor.execute(query, *args, **kwargs)
+
+    def _count(self, rows):
+        self.rows += len(rows)
+        return rows
+
+    def _count_one(self, row):
+        if row is not None:
+            self.rows += 1
+        return row
+
+    def fetchone(self):
+        return self._count_one(self._cursor.fetchone())
+
+    def fetchall(self):
+        return self._count(self._cursor.fetchall())
+
+    def fetchmany(self, *args, **kwargs):
+        return self._count(self._cursor.fetchmany(*args, **kwargs))
+
+    def dictfetchone(self):
+        return self._count_one(self._cursor.dictfetchone())
+
+    def dictfetchall(self):
+        return self._count(self._cursor.dictfetchall())
+
+    def dictfetchmany(self, *args, **kwargs):
+        return self._count(self._cursor.dictfetchmany(*args, **kwargs))
+
+def is_cursor(value):
+    # No attribute lookup : on a browse record, it would read the database and log a warning
+    return isinstance(value, (Cursor, CursorProbe))
+
+class Profiler(object):
+
+    """
+    Records the calls count, the wall time, the SQL queries count and the fetched rows count of the rent methods.
+    Counts are inclusive : a method calling another one also counts the queries of the called method.
+
+    When disabled, the only overhead of a decorated method is one attribute lookup.
+
+    A cProfile.Profile can only profile one thread, so each thread has its own, and they are merged when dumped.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cprofile_method = None
+        self.cprofiles = {}
+        self.cprofile_threads = set()
+        self.counter = None
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def enable(self, cprofile_method=None):
+
+        """
+        Enables the profiling. If cprofile_method is specified ('rent.order.get_totals' for example), the calls of
+        this method are also profiled with cProfile.
+        """
+
+        self._lock.acquire()
+        try:
+            self.cprofile_method = cprofile_method
+            self.cprofiles = {}
+        finally:
+            self._lock.release()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.stats = {}
+            self.cprofiles = {}
+        finally:
+            self._lock.release()
+
+    def record(self, name, seconds, queries, rows):
+        self._lock.acquire()
+        try:
+            stats = self.stats.setdefault(name, {'calls' : 0, 'seconds' : 0.0, 'max_seconds' : 0.0,
+                                                 'queries' : 0, 'rows' : 0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['queries'] += queries
+            stats['rows'] += rows
+        finally:
+            self._lock.release()
+
+    def cprofile_call(self, function, obj, args, kwargs):
+
+        """
+        Calls the function with the cProfile.Profile of the current thread. Recursive calls are already profiled.
+        """
+
+        thread_id = threading.current_thread().ident
+        self._lock.acquire()
+        try:
+            if thread_id in self.cprofile_threads:
+                profile = None
+            else:
+                profile = self.cprofiles.setdefault(thread_id, cProfile.Profile())
+                self.cprofile_threads.add(thread_id)
+        finally:
+            self._lock.release()
+        if profile is None:
+            return function(obj, *args, **kwargs)
+        try:
+            return profile.runcall(function, obj, *args, **kwargs)
+        finally:
+            self._lock.acquire()
+            try:
+                self.cprofile_threads.discard(thread_id)
+            finally:
+                self._lock.release()
+
+    def call(self, function, obj, args, kwargs):
+        name = '%s.%s' % (getattr(obj, '_name', obj.__class__.__name__), function.__name__)
+        probe = None
+        # The cursor is the first argument after self, like in all the OpenERP methods
+        if args and is_cursor(args[0]):
+            probe = args[0]
+            if not isinstance(probe, CursorProbe):
+                probe = CursorProbe(probe, self.counter)
+                args = (probe,) + tuple(args[1:])
+        queries, rows = probe and probe.queries or 0, probe and probe.rows or 0
+
+        start = time.time()
+        try:
+            if name == self.cprofile_method:
+                return self.cprofile_call(function, obj, args, kwargs)
+            return function(obj, *args, **kwargs)
+        finally:
+            self.record(name, time.time() - start,
+                probe and probe.queries - queries or 0, probe and probe.rows - rows or 0)
+
+    def get_stats(self):
+
+        """
+        Returns the recorded statistics as a list of dictionaries, sorted by total time.
+        """
+
+        self._lock.acquire()
+        try:
+            result = [dict(stats, method=name) for name, stats in self.stats.items()]
+        finally:
+            self._lock.release()
+        for stats in result:
+            stats['avg_ms'] = stats['seconds'] * 1000.0 / stats['calls']
+        return sorted(result, key=lambda stats: -stats['seconds'])
+
+    def log_summary(self, limit=20):
+        lines = ['%-50s %8s %10s %10s %10s %10s' % ('Method', 'Calls', 'Total (s)', 'Avg (ms)', 'Queries', 'Rows')]
+        for stats in self.get_stats()[:limit]:
+            lines.append('%-50s %8d %10.3f %10.3f %10d %10d' % (stats['method'], stats['calls'], stats['seconds'],
+                stats['avg_ms'], stats['queries'], stats['rows']))
+        _logger.info('Rent profiling summary:\n%s', '\n'.join(lines))
+
+    def dump_cprofile(self, path):
+
+        """
+        Writes the cProfile statistics of the profiled method to path, merged for all the threads. They can be read
+        with the pstats module. The calls which are running are not included.
+        """
+
+        # The lock keeps the profiles from being used while their statistics are read
+        self._lock.acquire()
+        try:
+            profiles = [profile for thread_id, profile in self.cprofiles.items()
+                        if thread_id not in self.cprofile_threads]
+            stats = profiles and pstats.Stats(*profiles) or None
+        finally:
+            self._lock.release()
+        if stats is None:
+            return False
+        stats.dump_stats(path)
+        return True
+
+PROFILER = Profiler()
+
+if config.get('rent_profiling'):
+    PROFILER.enable(config.get('rent_profiling_cprofile_method') or None)
+
+def report_bugs(function):
+
+    """
+    Replaces openlib.github.report_bugs for the rent methods : the method is wrapped by the original decorator, and
+    then profiled when the profiling is enabled.
+    """
+
+    reported = github_report_bugs(function)
+
+    def wrapper(self, *args, **kwargs):
+        if not PROFILER.enabled:
+            return reported(self, *args, **kwargs)
+        return PROFILER.call(reported, self, args, kwargs)
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    wrapper.__module__ = function.__module__
+    return wrapper
+
+class RentProfiling(osv.osv):
+
+    """
+    Exposes the rent profiler. It can be enabled from the configuration file with 'rent_profiling = True' (and
+    optionally 'rent_profiling_cprofile_method = rent.order.get_totals'), or by calling enable().
+    """
+
+    def _check_admin(self, uid):
+        if uid != 1:
+            raise osv.except_osv(_('Access Denied'), _('Only the administrator can use the rent profiler.'))
+
+    def enable(self, cr, uid, cprofile_method=None, context=None):
+        self._check_admin(uid)
+        PROFILER.enable(cprofile_method)
+        return True
+
+    def disable(self, cr, uid, context=None):
+        self._check_admin(uid)
+        PROFILER.disable()
+        return True
+
+    def reset(self, cr, uid, context=None):
+        self._check_admin(uid)
+        PROFILER.reset()
+        return True
+
+    def get_stats(self, cr, uid, log=False, context=None):
+
+        """
+        Returns the statistics of the rent methods, sorted by total time. If log is True, a summary is also logged.
+        """
+
+        self._check_admin(uid)
+        if log:
+            PROFILER.log_summary()
+        return PROFILER.get_stats()
+
+    def dump_cprofile(self, cr, uid, path, context=None):
+        self._check_admin(uid)
+        return PROFILER.dump_cprofile(path)
+
+    _name = 'rent.profiling'
+    _auto = False
+    _columns = {}
+
+RentProfiling()
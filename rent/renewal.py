@@ -0,0 +1,256 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import math
+import logging
+import datetime
+
+from dateutil.relativedelta import relativedelta
+
+from openlib.tools import *
+from profiling import report_bugs
+
+from osv import osv, fields
+from tools import config
+from tools.translate import _
+from tools.misc import DEFAULT_SERVER_DATETIME_FORMAT
+
+_logger = logging.getLogger('rent')
+
+# These columns are not copied from the renewed orders, they are set by the renewal or left empty.
+RENEWAL_EXCLUDED_COLUMNS = ('reference', 'state', 'date_created', 'date_begin_rent', 'date_out_shipping',
+    'date_in_shipping', 'out_picking_id', 'in_picking_id', 'renewal_id')
+
+# Orders are renewed by chunks of this size.
+RENEWAL_CHUNK_SIZE = 200
+
+def get_copied_columns(model, excluded=()):
+
+    """
+    Returns the names of the columns of the model which are stored as is in its table (no function fields, and
+    no x2many fields), including the ones added by the modules which inherit it.
+    """
+
+    return sorted([name for name, column in model._columns.items() if column._classic_write
+        and not isinstance(column, fields.function) and name not in excluded])
+
+class RentOrderRenewal(osv.osv):
+
+    """
+    Renewal of rent orders : a successor order is created for each renewed order, with the same customer, lines
+    and duration, starting when the renewed order ends. The orders marked as 'Renew automatically' are renewed
+    by a cron, some days before their end.
+    """
+
+    _inherit = 'rent.order'
+
+    def _shift_dates(self, order, delta, now):
+        # The successor begins one duration later. Orders renewed late are shifted again, to begin after now : the
+        # number of durations is estimated from their average length (months and years have no fixed length), then
+        # corrected by one step at most.
+        dates = [to_datetime(order[name]) for name in ('date_begin_rent', 'date_out_shipping', 'date_in_shipping')]
+        steps = 1
+        if dates[0] + delta < now:
+            length = (delta.days + delta.months * 30.436875 + delta.years * 365.2425) * 86400
+            elapsed = now - dates[0]
+            steps = max(1, int(math.ceil((elapsed.days * 86400 + elapsed.seconds) / length)))
+            if dates[0] + delta * steps < now:
+                steps += 1
+            elif steps > 1 and dates[0] + delta * (steps - 1) >= now:
+                steps -= 1
+        return [(date + delta * steps).strftime(DEFAULT_SERVER_DATETIME_FORMAT) for date in dates]
+
+    @report_bugs
+    def renew_orders(self, cr, uid, ids, reprice=False, context=None):
+
+        """
+        Creates the successors of the specified orders, and returns a dictionary containing the ids of the renewed
+        orders as keys, and the ids of their successors as values. Orders which already have a successor are
+        ignored. If reprice is True, the unit prices of the lines are computed again, with the rent pricelist of the
+        customer (see rent.pricelist.get_rent_prices) for rented products.
+
+        The orders and their lines are read with one query each, and created with rent.order._bulk_create_orders().
+        The production lots of the lines are not copied, so the units must be assigned to the successors again.
+        """
+
+        if not ids:
+            return {}
+        # The orders and lines are read and created in SQL, the access rights are checked here
+        access_pool = self.pool.get('ir.model.access')
+        access_pool.check(cr, uid, self._name, 'create')
+        access_pool.check(cr, uid, 'rent.order.line', 'create')
+
+        line_pool = self.pool.get('rent.order.line')
+        pricelist_pool = self.pool.get('rent.pricelist')
+        order_columns = get_copied_columns(self, RENEWAL_EXCLUDED_COLUMNS)
+        line_columns = get_copied_columns(line_pool, ('order_id',))
+        unities = self.get_duration_unities(cr, uid, context=context)
+        now = datetime.datetime.now()
+        result = {}
+
+        for index in range(0, len(ids), RENEWAL_CHUNK_SIZE):
+            chunk_ids = tuple(ids[index:index+RENEWAL_CHUNK_SIZE])
+
+            cr.execute('SELECT id, reference, date_begin_rent, date_out_shipping, date_in_shipping, %s FROM rent_order '
+                'WHERE id IN %%s AND renewal_id IS NULL ORDER BY id' % ', '.join(order_columns), (chunk_ids,))
+            orders = cr.dictfetchall()
+            if not orders:
+                continue
+            order_ids = tuple([order['id'] for order in orders])
+
+            cr.execute('SELECT id, %s FROM rent_order_line WHERE order_id IN %%s ORDER BY id'
+                % ', '.join(line_columns + ['order_id']), (order_ids,))
+            lines = cr.dictfetchall()
+            cr.execute("""
+                SELECT rel.rent_order_line_id, rel.tax_id FROM rent_order_line_taxes rel
+                JOIN rent_order_line line ON line.id = rel.rent_order_line_id
+                WHERE line.order_id IN %s
+            """, (order_ids,))
+            taxes = {}
+            for line_id, tax_id in cr.fetchall():
+                taxes.setdefault(line_id, []).append(tax_id)
+
+            dates = {}
+            for order in orders:
+                if order['rent_duration_unity'] not in unities:
+                    raise osv.except_osv(_('Error'), _('Unknown duration unity with id %s') % order['rent_duration_unity'])
+                if order['rent_duration'] <= 0:
+                    raise osv.except_osv(_('Error'),
+                        _("The rent order %s can't be renewed, its duration is not positive.") % order['reference'])
+                delta = relativedelta(**{unities[order['rent_duration_unity']] : order['rent_duration']})
+                dates[order['id']] = self._shift_dates(order, delta, now)
+
+            prices = {}
+            if reprice and lines:
+                # Rented products are priced with the pricelist of the customer, at the successor begin date
+                cr.execute("""
+                    SELECT product.id, tmpl.list_price FROM product_product product
+                    JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id WHERE product.id IN %s
+                """, (tuple(set([line['product_id'] for line in lines])),))
+                list_prices = dict(cr.fetchall())
+                partners = dict((order['id'], order['partner_id']) for order in orders)
+                pricelists = pricelist_pool.get_partner_pricelists(cr, uid, partners.values(), context=context)
+                rent_lines = [line for line in lines if line['product_type'] == 'rent']
+                prices = dict(zip([line['id'] for line in rent_lines], pricelist_pool.get_rent_prices(cr, uid,
+                    [(pricelists.get(partners[line['order_id']]), line['product_id'], line['quantity'],
+                      dates[line['order_id']][0]) for line in rent_lines], context=context)))
+                prices.update((line['id'], list_prices.get(line['product_id'])) for line in lines
+                    if line['product_type'] != 'rent')
+
+            orders_lines = {}
+            for line in lines:
+                values = dict([(name, line[name]) for name in line_columns])
+                values['tax_ids'] = taxes.get(line['id'], [])
+                if prices.get(line['id']):
+                    values['unit_price'] = prices[line['id']]
+                orders_lines.setdefault(line['order_id'], []).append(values)
+
+            successors = []
+            for order in orders:
+                values = dict([(name, order[name]) for name in order_columns])
+                values['date_begin_rent'], values['date_out_shipping'], values['date_in_shipping'] = dates[order['id']]
+                values.update({
+                    'reference' : '/',
+                    'state' : 'draft',
+                    'date_created' : now.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                    'lines' : orders_lines.get(order['id'], []),
+                })
+                successors.append(values)
+
+            successor_ids = self._bulk_create_orders(cr, uid, successors, context=context)
+            renewals = zip(order_ids, successor_ids)
+            cr.execute("""
+                UPDATE rent_order SET renewal_id = v.renewal_id
+                FROM (VALUES %s) AS v(id, renewal_id)
+                WHERE rent_order.id = v.id
+            """ % ', '.join(['(%s::integer, %s::integer)'] * len(renewals)),
+                [value for renewal in renewals for value in renewal])
+            result.update(dict(renewals))
+
+        _logger.info('Renewed %d rent orders', len(result))
+        return result
+
+    @report_bugs
+    def run_cron_renew_orders(self, cr, uid, context=None):
+
+        """
+        Renews the ongoing or done orders marked as 'Renew automatically' which end in less than
+        'rent_renewal_days' days (server configuration, 30 by default). Orders without a positive duration are
+        ignored.
+        """
+
+        days = int(config.get('rent_renewal_days') or 30)
+        limit = (datetime.datetime.now() + datetime.timedelta(days=days)).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cr.execute("""
+            SELECT id FROM rent_order
+            WHERE auto_renew AND renewal_id IS NULL AND state IN ('ongoing', 'done') AND date_end_rent <= %s
+                AND rent_duration > 0
+            ORDER BY id
+        """, (limit,))
+        ids = [row[0] for row in cr.fetchall()]
+
+        # Each chunk is renewed in a savepoint : a faulty order only blocks its chunk
+        count = 0
+        for index in range(0, len(ids), RENEWAL_CHUNK_SIZE):
+            chunk_ids = ids[index:index+RENEWAL_CHUNK_SIZE]
+            cr.execute('SAVEPOINT rent_renewal')
+            try:
+                count += len(self.renew_orders(cr, uid, chunk_ids, context=context))
+            except Exception:
+                cr.execute('ROLLBACK TO SAVEPOINT rent_renewal')
+                _logger.exception('Unable to renew the rent orders %s', chunk_ids)
+            else:
+                cr.execute('RELEASE SAVEPOINT rent_renewal')
+        return count
+
+    @report_bugs
+    def on_renew_clicked(self, cr, uid, ids, context=None):
+
+        """
+        Called when the user clicks on 'Renew' : the successor is opened.
+        """
+
+        renewals = self.renew_orders(cr, uid, ids, context=context)
+        if not renewals:
+            raise osv.except_osv(_('Error'), _('This rent order has already been renewed.'))
+        return {
+            'name' : _('Rent Order'),
+            'view_type' : 'form',
+            'view_mode' : 'form,tree',
+            'res_model' : 'rent.order',
+            'res_id' : renewals.values()[0],
+            'type' : 'ir.actions.act_window',
+        }
+
+    def copy(self, cr, uid, id, default=None, context=None):
+        default = dict(default or {}, renewal_id=False)
+        return super(RentOrderRenewal, self).copy(cr, uid, id, default, context=context)
+
+    _columns = {
+        'auto_renew' : fields.boolean('Renew automatically', help=
+            'If checked, a new rent order with the same lines is created automatically before the end of this one.'),
+        'renewal_id' : fields.many2one('rent.order', 'Renewed by', readonly=True, ondelete='SET NULL', help=
+            'The rent order created when this one was renewed.'),
+    }
+
+    _defaults = {
+        'auto_renew' : False,
+    }
+
+RentOrderRenewal()
@@ -29,7 +29,10 @@ from dateutil.relativedelta import *
 # https://github.com/WE2BS/openerp-openlib
 from openlib.orm import *
 from openlib.tools import *
-from openlib.github import report_bugs
+from profiling import report_bugs
+from metrics import (INVOICES_CREATED, ORDERS_STARTED, ORDERS_STOPPED, PICKINGS_CREATED, TOTALS_COMPUTED,
+    CRON_DURATION, ONCHANGE_DURATION)
+from sequence import REFERENCE_ALLOCATOR
 
 from osv import osv, fields
 from tools.translate import _
@@ -58,6 +61,7 @@ class RentOrder(osv.osv, ExtendedOsv):
     # sale.order because there were a lot of useless things for a Rent Order.
 
     @report_bugs
+    @ONCHANGE_DURATION.time(method='on_client_changed')
     def on_client_changed(self, cr, uid, ids, client_id):
 
         """
@@ -68,18 +72,19 @@ class RentOrder(osv.osv, ExtendedOsv):
         result = {}
         client = self.get(client_id, _object='res.partner')
 
-        for address in client.address:
-            
-            if address.type == 'default':
-                result = {
-                    'partner_order_address_id' : address.id,
-                    'partner_invoice_address_id' : address.id,
-                    'partner_shipping_address_id' : address.id,
-                }
-            elif address.type == 'invoice':
-                result['partner_invoice_address_id'] = address.id
-            elif address.type == 'delivery':
-                result['partner_shipping_address_id'] = address.id
+        # Only the first address of each type is fetched, instead of browsing all the client addresses.
+        addresses = self.pool.get('res.partner').get_rent_addresses(cr, uid, [client_id])[client_id]
+
+        if addresses['default']:
+            result = {
+                'partner_order_address_id' : addresses['default'],
+                'partner_invoice_address_id' : addresses['default'],
+                'partner_shipping_address_id' : addresses['default'],
+            }
+        if addresses['invoice']:
+            result['partner_invoice_address_id'] = addresses['invoice']
+        if addresses['delivery']:
+            result['partner_shipping_address_id'] = addresses['delivery']
 
         if not result:
             raise osv.except_osv (
@@ -91,6 +96,7 @@ class RentOrder(osv.osv, ExtendedOsv):
         return { 'value' : result }
 
     @report_bugs
+    @ONCHANGE_DURATION.time(method='on_duration_changed')
     def on_duration_changed(self, cr, uid, ids, rent_begin, duration, duration_unity_id, shop_id, context=None):
 
         """
@@ -101,21 +107,15 @@ class RentOrder(osv.osv, ExtendedOsv):
         if not rent_begin or not duration or not duration_unity_id:
             return {}
         
-        day_unity = self.get(category_id__name='Duration', name='Day', _object='product.uom')
-        month_unity = self.get(category_id__name='Duration', name='Month', _object='product.uom')
-        year_unity = self.get(category_id__name='Duration', name='Year', _object='product.uom')
+        unities = self.get_duration_unities(cr, uid, context=context)
 
         # Converts the order duration (expressed in days/month/years) into the days duration
-        if duration_unity_id == day_unity.id:
-            delta = relativedelta(days=duration)
-        elif duration_unity_id == month_unity.id:
-            delta = relativedelta(months=duration)
-        elif duration_unity_id == year_unity.id:
-            delta = relativedelta(years=duration)
-        else:
+        if duration_unity_id not in unities:
             raise osv.except_osv(_("Error"), "Unknown duration unity with id %d" % duration_unity_id)
+        delta = relativedelta(**{unities[duration_unity_id] : duration})
 
-        company = self.get(shop_id, _object='sale.shop').company_id
+        company_id = self.pool.get('sale.shop').read(cr, uid, shop_id, ['company_id'])['company_id'][0]
+        config = self.pool.get('res.company').get_rent_config(cr, uid, company_id)
 
         # Depending of the widget, the begin date can be a date or a datetime
         try:
@@ -129,7 +129,7 @@ class RentOrder(osv.osv, ExtendedOsv):
         end = (begin + delta) - relativedelta(days=1)# We remove 1 day to set the return date the same day that the rent end date
         # 'end' can be a datetime or a date object, depending of the widget.
         end = datetime.datetime.combine(end.date() if isinstance(end, datetime.datetime) else end,
-            to_time(company.rent_afternoon_end))
+            config.afternoon_end)
         end = end.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
 
         return {'value' : {'date_in_shipping' : end}}
@@ -228,8 +228,8 @@ class RentOrder(osv.osv, ExtendedOsv):
         """
 
         orders = self.filter(orders_ids)
-        move_pool, picking_pool = map(
-            self.pool.get, ('stock.move', 'stock.picking'))
+        move_pool, picking_pool, line_pool = map(
+            self.pool.get, ('stock.move', 'stock.picking', 'rent.order.line'))
         workflow = netsvc.LocalService("workflow")
 
         for order in orders:
@@ -267,9 +267,10 @@ class RentOrder(osv.osv, ExtendedOsv):
                         'address_id' : order.partner_shipping_address_id.id,
                         'company_id' : order.company_id.id,
                     })
+                    PICKINGS_CREATED.inc(db=cr.dbname, type='out')
 
                 # Out move: Stock -> Client
-                move_pool.create(cr, uid, {
+                moves_values = line_pool.get_out_moves_values(cr, uid, line, {
                     'name': line.description,
                     'picking_id': out_picking_id,
                     'product_id': line.product_id.id,
@@ -284,6 +285,8 @@ class RentOrder(osv.osv, ExtendedOsv):
                     'location_dest_id' : customer_output_id,
                     'state': 'draft',
                 })
+                for move_values in moves_values:
+                    move_pool.create(cr, uid, move_values)
 
             # Confirm picking orders
             if out_picking_id:
@@ -326,6 +329,8 @@ class RentOrder(osv.osv, ExtendedOsv):
                 'address_id' : order.partner_shipping_address_id.id,
                 'company_id' : order.company_id.id,
             })
+            PICKINGS_CREATED.inc(db=cr.dbname, type='in')
+
             for line in order.out_picking_id.move_lines:
                 move_pool.create(cr, uid, {
                     'name': line.name,
@@ -340,6 +345,7 @@ class RentOrder(osv.osv, ExtendedOsv):
                     'address_id': line.address_id.id,
                     'location_id': line.location_dest_id.id,
                     'location_dest_id' : line.location_id.id,
+                    'prodlot_id' : line.prodlot_id.id,
                     'state': 'draft',
                 })
             
@@ -449,6 +455,70 @@ class RentOrder(osv.osv, ExtendedOsv):
         lines = self.filter(ids, _object='rent.order.line')
         return [line.order_id.id for line in lines]
 
+    @report_bugs
+    def get_duration_unities(self, cr, uid, context=None):
+
+        """
+        Returns a dictionary containing the ids of the Day, Month and Year unities of the Duration UoM category
+        as keys, and the corresponding relativedelta keyword ('days', 'months' or 'years') as value.
+        """
+
+        cr.execute("""
+            SELECT uom.id, uom.name FROM product_uom uom
+            JOIN product_uom_categ categ ON categ.id = uom.category_id
+            WHERE categ.name = 'Duration' AND uom.name IN ('Day', 'Month', 'Year')
+        """)
+        keywords = {'Day' : 'days', 'Month' : 'months', 'Year' : 'years'}
+        return dict((uom_id, keywords[name]) for uom_id, name in cr.fetchall())
+
+    @report_bugs
+    def compute_end_dates(self, cr, uid, rows, context=None):
+
+        """
+        Computes the end dates of orders from a list of (id, date_begin_rent, rent_duration, rent_duration_unity,
+        company_id) tuples. Returns a dictionary with ids as keys, and end dates (server format) as values.
+
+        Orders are grouped by (duration unity, duration, company) : the delta and the end time are resolved once per
+        group, and each distinct begin date of a group is computed only once.
+        """
+
+        unities = self.get_duration_unities(cr, uid, context=context)
+        company_pool = self.pool.get('res.company')
+        groups = {}
+        result = {}
+
+        for order_id, date_begin, duration, unity_id, company_id in rows:
+            groups.setdefault((unity_id, duration, company_id), []).append((order_id, date_begin))
+
+        for (unity_id, duration, company_id), orders in groups.items():
+
+            if unity_id not in unities:
+                raise osv.except_osv(_("Error"), "Unknown duration unity with id %s" % unity_id)
+
+            end_time = company_pool.get_rent_config(cr, uid, company_id, context=context).afternoon_end
+            delta = relativedelta(**{unities[unity_id] : duration})
+            ends = {}
+
+            for order_id, date_begin in orders:
+                begin = to_datetime(date_begin).date()
+                if begin not in ends:
+                    # Remove one day to have a more realistic duration: In the case of a 1 day duration
+                    # we except the customer to bring the products the same day, not tomorrow.
+                    end = (begin + delta) - relativedelta(days=1)
+                    ends[begin] = datetime.datetime.combine(end, end_time).strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+                result[order_id] = ends[begin]
+
+        return result
+
+    def _read_end_date_rows(self, cr, where, params, limit=None):
+        # The company is read from the shop, because the stored company_id may not be computed yet
+        cr.execute("""
+            SELECT o.id, o.date_begin_rent, o.rent_duration, o.rent_duration_unity, s.company_id
+            FROM rent_order o JOIN sale_shop s ON s.id = o.shop_id
+            WHERE %s ORDER BY o.id %s
+        """ % (where, limit and 'LIMIT %d' % limit or ''), params)
+        return cr.fetchall()
+
     @report_bugs
     def get_end_date(self, cr, uid, ids, field_name, arg, context=None):
 
@@ -456,37 +526,56 @@ class RentOrder(osv.osv, ExtendedOsv):
         Returns the rent order end date, based on the duration and the company configuration
         """
 
-        orders = self.filter(ids)
-        result = {}
+        if not ids:
+            return {}
 
-        for order in orders:
+        rows = self._read_end_date_rows(cr, 'o.id IN %s', (tuple(ids),))
+        return self.compute_end_dates(cr, uid, rows, context=context)
 
-            begin = to_datetime(order.date_begin_rent)
-            duration = order.rent_duration
-            
-            day_unity = self.get(category_id__name='Duration', name='Day', _object='product.uom')
-            month_unity = self.get(category_id__name='Duration', name='Month', _object='product.uom')
-            year_unity = self.get(category_id__name='Duration', name='Year', _object='product.uom')
-            
-            # Converts the order duration (expressed in days/month/years) into the days duration
-            if order.rent_duration_unity.id == day_unity.id:
-                delta = relativedelta(days=duration)
-            elif order.rent_duration_unity.id == month_unity.id:
-                delta = relativedelta(months=duration)
-            elif order.rent_duration_unity.id == year_unity.id:
-                delta = relativedelta(years=duration)
+    @report_bugs
+    def recompute_end_dates(self, cr, uid, ids=None, chunk_size=5000, context=None):
+
+        """
+        Recomputes and stores the end date of the specified orders, or of all orders if ids is None. This must be
+        used after a migration or a Duration UoM change, instead of triggering the function field for each order.
+
+        Orders are processed by chunks of chunk_size, using the id as a key to paginate, and each chunk is written
+        with a single UPDATE query. Returns the number of updated orders.
+        """
+
+        last_id = 0
+        offset = 0
+        count = 0
+
+        while True:
+            if ids is None:
+                rows = self._read_end_date_rows(cr, 'o.id > %s', (last_id,), limit=chunk_size)
             else:
-                raise osv.except_osv(_("Error"), "Unknown duration unity: %s" % order.rent_duration_unity.name)
+                chunk_ids = ids[offset:offset+chunk_size]
+                offset += chunk_size
+                if not chunk_ids:
+                    break
+                rows = self._read_end_date_rows(cr, 'o.id IN %s', (tuple(chunk_ids),))
+                if not rows:
+                    continue
+            if not rows:
+                break
 
-            # Remove one day to have a more realistic duration: In the case of a 1 day duration
-            # we except the customer to bring the products the same day, not tomorrow.
-            end = (begin + delta) - relativedelta(days=1)
-            end = datetime.datetime.combine(end.date(), to_time(order.company_id.rent_afternoon_end))
-            end = end.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+            end_dates = self.compute_end_dates(cr, uid, rows, context=context)
+            values = []
+            for order_id, end_date in end_dates.items():
+                values.extend([order_id, end_date])
+            cr.execute("""
+                UPDATE rent_order SET date_end_rent = v.date_end_rent
+                FROM (VALUES %s) AS v(id, date_end_rent)
+                WHERE rent_order.id = v.id
+            """ % ', '.join(['(%s::integer, %s::timestamp)'] * len(end_dates)), values)
 
-            result[order.id] = end
+            last_id = rows[-1][0]
+            count += len(rows)
+            _logger.info('Recomputed the end date of %d rent orders', count)
 
-        return result
+        return count
 
     @report_bugs
     def get_invoiced_rate(self, cr, uid, ids, fields_name, arg, context=None):
@@ -496,6 +585,17 @@ class RentOrder(osv.osv, ExtendedOsv):
         """
 
         orders = self.filter(ids)
+        # The taxes of the lines, mapped by the fiscal position of their order, by (fiscal position, taxes) key
+        mapped_taxes = {}
+        def get_line_taxes(key):
+            if key not in mapped_taxes:
+                line_taxes = [taxes[tax_id] for tax_id in key[1]]
+                if key[0]:
+                    line_taxes = tax_pool.browse(cr, uid, fiscal_position_pool.map_tax(cr, uid,
+                        fiscal_positions[key[0]], line_taxes, context=context), context=context)
+                mapped_taxes[key] = line_taxes
+            return mapped_taxes[key]
+
         result = {}
 
         for order in orders:
@@ -518,6 +618,7 @@ class RentOrder(osv.osv, ExtendedOsv):
         result = {}
         tax_pool, fiscal_position_pool = map(self.pool.get, ['account.tax', 'account.fiscal.position'])
         orders = self.filter(ids)
+        TOTALS_COMPUTED.inc(len(ids), db=cr.dbname)
 
         for order in orders:
 
@@ -568,6 +669,142 @@ class RentOrder(osv.osv, ExtendedOsv):
 
         return result
 
+    @report_bugs
+    def get_report_snapshots(self, cr, uid, ids, context=None):
+
+        """
+        Returns a flat, precomputed snapshot of each order, used by the reports instead of walking the browse
+        graph. The result is a dictionary with ids as keys. Each snapshot contains the order values (read as
+        usual), and these keys :
+
+            partner : The values of the customer
+            company : The name, the currency symbol and the address values of the company
+            addresses : A dictionary with 'order', 'invoice' and 'shipping' keys, containing the address values
+            dates : The order dates, formatted in the customer language
+            lines : The lines values, with the product, UoM and taxes names, the taxes amounts and the computed
+                prices
+            taxes : The tax summary, a list of dictionaries with 'name', 'base' and 'amount' keys
+
+        The address values contain the name of the country ('country'). Each model is read once for all the orders,
+        whatever the number of orders and lines, and the taxes are computed once by set of taxes of each order.
+        """
+
+        tax_pool, fiscal_position_pool = map(self.pool.get, ['account.tax', 'account.fiscal.position'])
+        line_pool = self.pool.get('rent.order.line')
+
+        orders = self.read(cr, uid, ids, ['reference', 'description', 'state', 'notes', 'date_created',
+            'date_begin_rent', 'date_end_rent', 'date_out_shipping', 'date_in_shipping', 'rent_duration',
+            'rent_duration_unity', 'partner_id', 'partner_order_address_id', 'partner_invoice_address_id',
+            'partner_shipping_address_id', 'fiscal_position', 'discount', 'rent_line_ids', 'total', 'total_taxes',
+            'total_with_taxes', 'total_with_discount', 'total_taxes_with_discount', 'total_with_taxes_with_discount',
+            'total_products_buy_price', 'total_products_sell_price', 'company_id', 'salesman'], context=context)
+
+        def read_by_id(model, ids, fields):
+            ids = list(set(ids) - set([False]))
+            return dict((values['id'], values) for values in
+                self.pool.get(model).read(cr, uid, ids, fields, context=context))
+
+        lines = read_by_id('rent.order.line', sum([order['rent_line_ids'] for order in orders], []),
+            line_pool._get_report_fields(cr, uid, context=context))
+        products = read_by_id('product.product', [line['product_id'][0] for line in lines.values()],
+            ['default_code', 'name'])
+        partners = read_by_id('res.partner', [order['partner_id'][0] for order in orders], ['name', 'ref', 'lang'])
+        addresses = read_by_id('res.partner.address', sum([[order[field] and order[field][0] for field in
+            ('partner_order_address_id', 'partner_invoice_address_id', 'partner_shipping_address_id')]
+            for order in orders], []), ['name', 'street', 'street2', 'zip', 'city', 'country_id', 'phone', 'email'])
+
+        companies = read_by_id('res.company', [order['company_id'] and order['company_id'][0] for order in orders],
+            ['name', 'partner_id', 'currency_id'])
+        currencies = read_by_id('res.currency', [company['currency_id'] and company['currency_id'][0]
+            for company in companies.values()], ['symbol'])
+        # The address of a company is the first address of its partner
+        address_pool = self.pool.get('res.partner.address')
+        company_addresses = {}
+        company_partner_ids = list(set([company['partner_id'][0] for company in companies.values()
+            if company['partner_id']]))
+        for address in address_pool.read(cr, uid, company_partner_ids and address_pool.search(cr, uid,
+            [('partner_id', 'in', company_partner_ids)], context=context) or [], ['partner_id', 'street', 'street2',
+            'zip', 'city', 'country_id'], context=context):
+            company_addresses.setdefault(address['partner_id'][0], address)
+        for address in addresses.values() + company_addresses.values():
+            address['country'] = address['country_id'] and address['country_id'][1] or ''
+
+        lang_pool = self.pool.get('res.lang')
+        lang_ids = lang_pool.search(cr, uid, [('code', 'in', list(set([p['lang'] for p in partners.values()])))])
+        langs = dict((lang['code'], lang) for lang in
+            lang_pool.read(cr, uid, lang_ids, ['code', 'date_format', 'time_format'], context=context))
+
+        taxes = dict((tax.id, tax) for tax in tax_pool.browse(cr, uid,
+            list(set(sum([line['tax_ids'] for line in lines.values()], []))), context=context))
+        fiscal_positions = dict((position.id, position) for position in fiscal_position_pool.browse(cr, uid,
+            list(set([order['fiscal_position'][0] for order in orders if order['fiscal_position']])), context=context))
+
+        result = {}
+
+        for order in orders:
+
+            partner = partners[order['partner_id'][0]]
+            lang = langs.get(partner['lang'])
+            date_format = lang and lang['date_format'] or '%m/%d/%Y'
+            datetime_format = date_format + ' ' + (lang and lang['time_format'] or '%H:%M:%S')
+
+            snapshot = dict(order)
+            snapshot['partner'] = partner
+            company = companies.get(order['company_id'] and order['company_id'][0], {})
+            snapshot['company'] = dict.fromkeys(['street', 'street2', 'zip', 'city', 'country'], '')
+            snapshot['company'].update(company_addresses.get(company.get('partner_id') and company['partner_id'][0],
+                {}))
+            snapshot['company'].update(name=company.get('name') or '', currency_symbol=company.get('currency_id')
+                and currencies[company['currency_id'][0]]['symbol'] or '')
+            snapshot['addresses'] = dict((key, addresses.get(order[field] and order[field][0], {}))
+                for key, field in (('order', 'partner_order_address_id'), ('invoice', 'partner_invoice_address_id'),
+                                   ('shipping', 'partner_shipping_address_id')))
+            snapshot['dates'] = {}
+            for field in ('date_created', 'date_begin_rent', 'date_end_rent', 'date_out_shipping', 'date_in_shipping'):
+                value = order[field] and to_datetime(order[field])
+                snapshot['dates'][field] = value and value.strftime(datetime_format) or ''
+                snapshot['dates'][field + '_date'] = value and value.strftime(date_format) or ''
+
+            snapshot['lines'] = []
+            tax_groups = {}
+
+            for line_id in order['rent_line_ids']:
+
+                line = dict(lines[line_id])
+                product = products[line['product_id'][0]]
+                line['product_code'] = product['default_code'] or ''
+                line['product_name'] = product['name']
+                line['uom'] = line['product_id_uom'] and line['product_id_uom'][1] or ''
+
+                key = (order['fiscal_position'] and order['fiscal_position'][0], tuple(sorted(line['tax_ids'])))
+                line_taxes = get_line_taxes(key)
+                line['taxes'] = ', '.join([tax.name for tax in line_taxes])
+                line['tax_amounts'] = [tax.amount for tax in line_taxes]
+                tax_groups.setdefault(key, []).append(line)
+
+                snapshot['lines'].append(line)
+
+            tax_summary = {}
+            for key, group in tax_groups.items():
+                line_taxes = get_line_taxes(key)
+                if [tax for tax in line_taxes if tax.type != 'percent' or tax.child_ids]:
+                    items = [(line['duration_unit_price'], line['quantity']) for line in group]
+                else:
+                    # Percent taxes are proportional to the price : the lines are computed at once
+                    items = [(sum([line['duration_unit_price'] * line['quantity'] for line in group]), 1)]
+                for price, quantity in items:
+                    prices = tax_pool.compute_all(cr, uid, line_taxes, price, quantity)
+                    for tax in prices['taxes']:
+                        summary = tax_summary.setdefault(tax['name'],
+                            {'name' : tax['name'], 'base' : 0.0, 'amount' : 0.0})
+                        summary['base'] += prices['total']
+                        summary['amount'] += tax.get('amount', 0.0)
+
+            snapshot['taxes'] = sorted(tax_summary.values(), key=lambda tax: tax['name'])
+            result[order['id']] = snapshot
+
+        return result
+
     @report_bugs
     def get_invoice_comment(self, cr, uid, order, date, current, max, period_begin, period_end):
 
@@ -837,20 +1074,20 @@ class RentOrder(osv.osv, ExtendedOsv):
         """
 
         now = datetime.datetime.now()
-        company = self.get(uid, _object='res.users').company_id
+        config = self.pool.get('res.company').get_rent_config(cr, uid, context=context)
 
-        rent_afternoon_begin = to_time(company.rent_afternoon_begin)
-        rent_morning_begin = to_time(company.rent_morning_begin)
+        rent_afternoon_begin = config.afternoon_begin
+        rent_morning_begin = config.morning_begin
 
-        if company.rent_default_begin == 'today':
+        if config.default_begin == 'today':
             # If we are in the morning, we set the begin at afternoon, else, we set the begin to now
             if now.time() < rent_afternoon_begin:
                 begin = datetime.datetime.combine(now.date(), rent_afternoon_begin)
             else:
                 begin = now
-        elif company.rent_default_begin == 'tomorrow_morning':
+        elif config.default_begin == 'tomorrow_morning':
             begin = datetime.datetime.combine(now.date()+datetime.timedelta(days=1), rent_morning_begin)
-        elif company.rent_default_begin == 'tomorrow_after':
+        elif config.default_begin == 'tomorrow_after':
             begin = datetime.datetime.combine(now.date()+datetime.timedelta(days=1), rent_afternoon_begin)
         else:
             return False
@@ -898,17 +1135,22 @@ class RentOrder(osv.osv, ExtendedOsv):
         """
 
         wkf_service = netsvc.LocalService("workflow")
+        start = time.time()
         
         # Orders that need to be started (moved to ongoing state)
         for order in self.filter(is_service_only=True, date_begin_rent__le=datetime.datetime.now(), state='confirmed'):
             wkf_service.trg_validate(uid, 'rent.order', order.id, 'on_force_start_clicked', cr)
+            ORDERS_STARTED.inc(db=cr.dbname)
             _logger.info('Started Rent Order %s' % order.reference)
 
         # Orders that need to be stopped
         for order in self.filter(is_service_only=True, date_end_rent__le=datetime.datetime.now(), state='ongoing'):
             wkf_service.trg_validate(uid, 'rent.order', order.id, 'on_force_stop_clicked', cr)
+            ORDERS_STOPPED.inc(db=cr.dbname)
             _logger.info('Stopped Rent Order %s.' % order.reference)
 
+        CRON_DURATION.observe(time.time() - start, db=cr.dbname, cron='start_stop_rents')
+
     @report_bugs
     def run_cron_make_invoices(self, cr, uid, context=None):
 
@@ -916,6 +1158,7 @@ class RentOrder(osv.osv, ExtendedOsv):
         This cron make invoices that have to be done.
         """
 
+        start = time.time()
         orders = self.filter(Q(state='ongoing')|Q(state='confirmed'))
         orders_invoices_data = self.get_invoices_data(cr, uid, orders, context)
 
@@ -943,9 +1186,145 @@ class RentOrder(osv.osv, ExtendedOsv):
 
                     invoice_id = self.get_invoice_at(cr, uid, order, invoice_data)
                     self.write(cr, uid, order.id, {'invoices_ids' : [(4, invoice_id)]})
+                    INVOICES_CREATED.inc(db=cr.dbname)
 
+        CRON_DURATION.observe(time.time() - start, db=cr.dbname, cron='make_invoices')
         _logger.debug('Finished rent orders invoice generation')
 
+    def _has_range_types(self, cr):
+        # Range types (tsrange) are available since PostgreSQL 9.2. The result is kept on this registry instance.
+        if getattr(self, '_range_types', None) is None:
+            cr.execute('SHOW server_version_num')
+            self._range_types = int(cr.fetchone()[0]) >= 90200
+        return self._range_types
+
+    def _has_trigrams(self, cr):
+        # The pg_trgm extension provides the similarity() function and the gin_trgm_ops operator class
+        if getattr(self, '_trigrams', None) is None:
+            cr.execute("SELECT 1 FROM pg_opclass WHERE opcname = 'gin_trgm_ops'")
+            self._trigrams = bool(cr.fetchone())
+        return self._trigrams
+
+    def _init_trigram_indexes(self, cr):
+        if not self._has_trigrams(cr):
+            # Creating the extension needs PostgreSQL 9.1 and enough privileges, we don't fail if it's not possible
+            cr.execute('SAVEPOINT rent_pg_trgm')
+            try:
+                cr.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                cr.execute('RELEASE SAVEPOINT rent_pg_trgm')
+            except Exception:
+                cr.execute('ROLLBACK TO SAVEPOINT rent_pg_trgm')
+                _logger.warning("The pg_trgm extension is not available, rent orders name search won't be indexed. "
+                                "Run 'CREATE EXTENSION pg_trgm' as a superuser and update the module to enable it.")
+                return
+            self._trigrams = None
+            if not self._has_trigrams(cr):
+                return
+        for index, table, column in (
+            ('rent_order_reference_trgm_index', 'rent_order', 'reference'),
+            ('rent_order_description_trgm_index', 'rent_order', 'description'),
+            ('res_partner_name_trgm_index', 'res_partner', 'name')):
+            cr.execute('SELECT indexname FROM pg_indexes WHERE indexname = %s', (index,))
+            if not cr.fetchone():
+                cr.execute('CREATE INDEX %s ON %s USING gin (%s gin_trgm_ops)' % (index, table, column))
+
+    def _auto_init(self, cr, context=None):
+        result = super(RentOrder, self)._auto_init(cr, context=context)
+        self._init_trigram_indexes(cr)
+        cr.execute("SELECT indexname FROM pg_indexes WHERE indexname = 'rent_order_shipping_period_index'")
+        if not cr.fetchone():
+            if self._has_range_types(cr):
+                # LEAST/GREATEST avoid an invalid range error if the dates are inverted on a row
+                cr.execute("CREATE INDEX rent_order_shipping_period_index ON rent_order USING gist "
+                           "(tsrange(LEAST(date_out_shipping, date_in_shipping), "
+                           "GREATEST(date_out_shipping, date_in_shipping), '[]'))")
+            else:
+                cr.execute('CREATE INDEX rent_order_shipping_period_index '
+                           'ON rent_order (date_out_shipping, date_in_shipping)')
+        return result
+
+    def _get_overlap_clause(self, cr, begin, end, alias='rent_order'):
+        # Returns the (clause, params) used to select orders whose shipping period overlaps [begin, end].
+        # The clause must match the expression of rent_order_shipping_period_index.
+        if self._has_range_types(cr):
+            clause = ("tsrange(LEAST(%(alias)s.date_out_shipping, %(alias)s.date_in_shipping), "
+                      "GREATEST(%(alias)s.date_out_shipping, %(alias)s.date_in_shipping), '[]') "
+                      "&& tsrange(%%s, %%s, '[]')") % {'alias' : alias}
+            return clause, (begin, end)
+        clause = '%(alias)s.date_out_shipping <= %%s AND %(alias)s.date_in_shipping >= %%s' % {'alias' : alias}
+        return clause, (end, begin)
+
+    @report_bugs
+    def search_overlapping(self, cr, uid, begin, end, args=None, offset=0, limit=None, order=None, context=None):
+
+        """
+        Returns the ids of the rent orders whose shipping period (from the shipping date to the return date)
+        overlaps the period [begin, end]. Bounds are included. The search can be restricted with a usual domain.
+        """
+
+        domain = [('shipping_period_overlaps', '=', (begin, end))] + (args or [])
+        return self.search(cr, uid, domain, offset=offset, limit=limit, order=order, context=context)
+
+    def _search_overlaps(self, cr, uid, obj, name, args, context=None):
+
+        """
+        Implements the ('shipping_period_overlaps', '=', (begin, end)) domain operator.
+        """
+
+        # The sub-query is executed by the main search query, the ids are not fetched
+        domain = []
+        for field_name, operator, value in args:
+            if operator != '=' or not isinstance(value, (list, tuple)) or len(value) != 2:
+                raise osv.except_osv(_('Error'),
+                    _("The shipping period must be searched with ('%s', '=', (begin, end)).") % field_name)
+            clause, params = self._get_overlap_clause(cr, value[0], value[1])
+            domain.append(('id', 'inselect', ('SELECT id FROM rent_order WHERE ' + clause, params)))
+        return domain
+
+    def _get_overlaps(self, cr, uid, ids, field_name, arg, context=None):
+        # This field is only used to search, it has no value
+        return dict.fromkeys(ids, False)
+
+    def name_search(self, cr, uid, name='', args=None, operator='ilike', context=None, limit=100):
+
+        """
+        Searches rent orders by reference, description or customer name. With the pg_trgm extension, the search
+        uses the trigram indexes and the results are ranked by similarity, the references starting with the
+        searched text first.
+        """
+
+        if not name or operator != 'ilike':
+            return super(RentOrder, self).name_search(cr, uid, name, args, operator, context=context, limit=limit)
+
+        query = self._where_calc(cr, uid, args or [], context=context)
+        self._apply_ir_rules(cr, uid, query, 'read', context=context)
+        from_clause, where_clause, where_params = query.get_sql()
+
+        pattern = '%%%s%%' % name
+        if self._has_trigrams(cr):
+            rank = ('"rent_order".reference ILIKE %s DESC, GREATEST(similarity("rent_order".reference, %s), '
+                    'similarity(COALESCE("rent_order".description, \'\'), %s), '
+                    '(SELECT similarity(name, %s) FROM res_partner WHERE id = "rent_order".partner_id)) DESC')
+            rank_params = ['%s%%' % name, name, name, name]
+        else:
+            rank = '"rent_order".reference ILIKE %s DESC, "rent_order".reference'
+            rank_params = ['%s%%' % name]
+
+        cr.execute("""
+            SELECT "rent_order".id FROM %s
+            WHERE (%s) AND (
+                "rent_order".reference ILIKE %%s
+                OR "rent_order".description ILIKE %%s
+                OR "rent_order".partner_id IN (SELECT id FROM res_partner WHERE name ILIKE %%s))
+            ORDER BY %s, "rent_order".id DESC
+            %s
+        """ % (from_clause, where_clause or 'TRUE', rank, limit and 'LIMIT %d' % limit or ''),
+            list(where_params) + [pattern, pattern, pattern] + rank_params)
+
+        ids = [row[0] for row in cr.fetchall()]
+        ranks = dict((order_id, index) for index, order_id in enumerate(ids))
+        return sorted(self.name_get(cr, uid, ids, context=context), key=lambda item: ranks[item[0]])
+
     @report_bugs
     def check_period_and_unity(self, cr, uid, ids, context=None):
 
@@ -954,16 +1333,44 @@ class RentOrder(osv.osv, ExtendedOsv):
             Day is a not a valid duration unity for a Month invoicing.
         """
 
-        for order in self.filter(ids):
-            if order.rent_duration_unity in order.rent_invoice_period.not_allowed_duration_unities:
-                return False
-        return True
+        return not self.get_invalid_period_and_unity_ids(cr, uid, ids, context=context)
+
+    @report_bugs
+    def get_invalid_period_and_unity_ids(self, cr, uid, ids=None, context=None):
+
+        """
+        Returns the ids of the orders (all of them if ids is None) whose duration unity is not allowed with their
+        invoicing period, with one query.
+        """
+
+        if ids is not None and not ids:
+            return []
+        cr.execute("""
+            SELECT o.id FROM rent_order o
+            JOIN rent_interval_not_allowed_durations not_allowed
+                ON not_allowed.interval_id = o.rent_invoice_period AND not_allowed.duration_id = o.rent_duration_unity
+            %s ORDER BY o.id
+        """ % (ids is not None and 'WHERE o.id IN %s' or ''), ids is not None and (tuple(ids),) or ())
+        return [row[0] for row in cr.fetchall()]
+
+    @report_bugs
+    def create(self, cr, uid, vals, context=None):
+
+        """
+        The reference is taken from the rent order sequence only now, so opening a new form or duplicating an
+        order doesn't consume a number. The numbers are reserved by blocks (see sequence.ReferenceAllocator).
+        """
+
+        if vals.get('reference', '/') == '/':
+            vals = dict(vals, reference=REFERENCE_ALLOCATOR.get(cr, uid, 'rent.order', context=context) or '/')
+        return super(RentOrder, self).create(cr, uid, vals, context=context)
 
     @report_bugs
     def copy(self, cr, uid, id, default=None, context=None):
 
         """
-        We have to generate a new reference when we copy the object.
+        We have to generate a new reference when we copy the object : it's set to '/' here, and the number is
+        given by create().
         """
 
         if not default:
@@ -974,7 +1381,7 @@ class RentOrder(osv.osv, ExtendedOsv):
             'invoices_ids': [],
             'out_picking_id': False,
             'in_picking_id' : False,
-            'reference': self.pool.get('ir.sequence').get(cr, uid, 'rent.order'),
+            'reference': '/',
         })
         
         return super(RentOrder, self).copy(cr, uid, id, default, context=context)
@@ -1059,6 +1466,10 @@ class RentOrder(osv.osv, ExtendedOsv):
             'The picking object which handle Client->Stock moves.', ondelete='RESTRICT'),
         'description' : fields.char('Object', size=255, help=
             'A small description of the rent order. Used in the report.'),
+        'shipping_period_overlaps' : fields.function(_get_overlaps, fnct_search=_search_overlaps, method=True,
+            type='boolean', string='Shipping period overlaps', help=
+            "Search only field, use ('shipping_period_overlaps', '=', (begin, end)) to find the orders whose "
+            "shipping period overlaps this period."),
         'is_service_only' : fields.function(is_service_only, method=True, type="boolean", string="Is service only", help=
             "True if the rent order only rent services products.", store={
                 'rent.order.line' : (get_order_from_lines, ['product_id'], 10),
@@ -1116,9 +1527,8 @@ class RentOrder(osv.osv, ExtendedOsv):
             'draft',
         'salesman': # Default salesman is the curent user
             lambda self, cr, uid, context: uid,
-        'reference': # The ref sequence is defined in sequence.xml (Default: RENTXXXXXXX)
-            lambda self, cr, uid, context:
-                self.pool.get('ir.sequence').get(cr, uid, 'rent.order'),
+        'reference': # The ref sequence is defined in sequence.xml (Default: RENTXXXXXXX), see create()
+            '/',
         'rent_duration' : 1,
         'rent_duration_unity' : default_duration_unity,
         'rent_invoice_period' : default_invoice_period,
@@ -1143,7 +1553,8 @@ class RentOrderLine(osv.osv, ExtendedOsv):
     """
 
     @report_bugs
-    def on_product_changed(self, cr, uid, ids, product_id, quantity):
+    @ONCHANGE_DURATION.time(method='on_product_changed')
+    def on_product_changed(self, cr, uid, ids, product_id, quantity, context=None):
 
         """
         This method is called when the product changed :
@@ -1174,10 +1585,11 @@ class RentOrderLine(osv.osv, ExtendedOsv):
         return {'value' : result, 'warning' : warning}
 
     @report_bugs
-    def on_quantity_changed(self, cr, uid, ids, product_id, quantity):
+    def on_quantity_changed(self, cr, uid, ids, product_id, quantity, unit_price=None, context=None):
 
         """
-        Checks the new quantity on product quantity changed.
+        Checks the new quantity on product quantity changed. The unit price is the current one, the modules which
+        compute the price from the quantity use it.
         """
 
         result = {}
@@ -1189,6 +1601,21 @@ class RentOrderLine(osv.osv, ExtendedOsv):
         warning = self.check_product_quantity(cr, uid, product, quantity)
         return {'value' : result, 'warning' : warning}
 
+    def _get_report_fields(self, cr, uid, context=None):
+        # The fields of the lines read by rent.order.get_report_snapshots()
+        return ['description', 'product_id', 'product_type', 'product_id_uom', 'quantity', 'discount', 'notes',
+            'tax_ids', 'unit_price', 'real_unit_price', 'duration_unit_price', 'line_price']
+
+    @report_bugs
+    def get_out_moves_values(self, cr, uid, line, values, context=None):
+
+        """
+        Returns the list of the values of the out moves of the line. The values passed are the ones of one move
+        for the whole quantity.
+        """
+
+        return [values]
+
     @report_bugs
     def get_order_price(self, line):
 
@@ -1228,7 +1655,7 @@ class RentOrderLine(osv.osv, ExtendedOsv):
                 # We convert the unit price of the product expressed in a unity (Day, Month, etc) into the unity
                 # of the rent order. A unit price of 1€/Day will become a unit price of 30€/Month.
                 converted_price = self.pool.get('product.uom')._compute_price(cr, uid,
-                    line.product_id.rent_price_unity.id, line.product_id.rent_price, line.order_id.rent_duration_unity.id)
+                    line.product_id.rent_price_unity.id, line.unit_price, line.order_id.rent_duration_unity.id)
                 real_unit_price = converted_price
                 duration_unit_price = self.get_rent_price(line, converted_price)
             else:
@@ -1300,15 +1727,27 @@ class RentOrderLine(osv.osv, ExtendedOsv):
         a service product it it's marked as 'Service' or at least, sellable.
         """
 
-        lines = self.filter(ids)
+        return not self.get_invalid_product_type_ids(cr, uid, ids, context=context)
 
-        for line in lines:
-            if line.product_type == 'rent' and not line.product_id.can_be_rent:
-                return False
-            elif line.product_type == 'service':
-                if line.product_id.type != 'service' or not line.product_id.sale_ok:
-                    return False
-        return True
+    @report_bugs
+    def get_invalid_product_type_ids(self, cr, uid, ids=None, context=None):
+
+        """
+        Returns the ids of the lines (all of them if ids is None) whose product can't be used with their product
+        type, with one query.
+        """
+
+        if ids is not None and not ids:
+            return []
+        cr.execute("""
+            SELECT l.id FROM rent_order_line l
+            JOIN product_product product ON product.id = l.product_id
+            JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+            WHERE ((l.product_type = 'rent' AND NOT COALESCE(product.can_be_rent, False))
+                OR (l.product_type = 'service' AND (tmpl.type <> 'service' OR NOT COALESCE(tmpl.sale_ok, False))))
+            %s ORDER BY l.id
+        """ % (ids is not None and 'AND l.id IN %s' or ''), ids is not None and (tuple(ids),) or ())
+        return [row[0] for row in cr.fetchall()]
 
     @report_bugs
     def check_product_quantity(self, cr, uid, product, quantity):
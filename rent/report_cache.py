@@ -0,0 +1,294 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import base64
+import hashlib
+import logging
+import tempfile
+import threading
+
+import netsvc
+import pooler
+import tools
+
+from osv import osv
+from tools import config
+from report_aeroo.report_aeroo import Aeroo_report
+
+from profiling import report_bugs
+
+_logger = logging.getLogger('rent')
+
+# Records in these states never change, their rendered documents can be cached.
+CACHEABLE_STATES = {
+    'rent.order' : ('done', 'cancelled'),
+    'account.invoice' : ('open', 'paid'),
+}
+
+class ReportCache(object):
+
+    """
+    A content-addressed store of rendered reports on disk. Documents are keyed by the database, the report,
+    the record id, the record write date, the hash of the template and the language, so a modified record or
+    template is rendered again. The store is bounded to max_size bytes : the least recently used documents are removed first.
+
+    The directory and the size (in megabytes) can be configured with the 'rent_report_cache_dir' and
+    'rent_report_cache_size' options of the server configuration file.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+        self._template_hashes = {}
+
+    def _path(self, key, format):
+        return os.path.join(self.directory, key[:2], '%s.%s' % (key, format))
+
+    def make_key(self, dbname, report_name, res_id, write_date, template_hash, lang):
+        return hashlib.sha1('\0'.join([dbname, report_name, str(res_id), str(write_date), template_hash,
+            lang or ''])).hexdigest()
+
+    def template_hash(self, path):
+
+        """
+        Returns the hash of the template file, computed again only if the file has been modified.
+        """
+
+        template_file = tools.file_open(path)
+        try:
+            mtime = os.fstat(template_file.fileno()).st_mtime
+            cached = self._template_hashes.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            template_hash = hashlib.sha1(template_file.read()).hexdigest()
+        finally:
+            template_file.close()
+        self._template_hashes[path] = (mtime, template_hash)
+        return template_hash
+
+    def get(self, key, format):
+
+        """
+        Returns the content of the document, or None if it's not in the store.
+        """
+
+        path = self._path(key, format)
+        try:
+            document = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            content = document.read()
+        finally:
+            document.close()
+        # The modification time is used as the last access time for the LRU eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return content
+
+    def set(self, key, format, content):
+
+        """
+        Stores the document, and evicts the least recently used documents if the store is full.
+        """
+
+        path = self._path(key, format)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass # Created by another thread meanwhile
+        temporary_path = '%s.%d.tmp' % (path, threading.currentThread().ident or 0)
+        document = open(temporary_path, 'wb')
+        try:
+            document.write(content)
+        finally:
+            document.close()
+        os.rename(temporary_path, path)
+
+        self._lock.acquire()
+        try:
+            if self._size is None:
+                self._size = sum([size for path, size, mtime in self._documents()])
+            else:
+                self._size += len(content)
+            if self._size > self.max_size:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _documents(self):
+        for directory, directories, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        # We remove documents until the store is at 90% of its size, to avoid an eviction on each insertion
+        documents = sorted(self._documents(), key=lambda document: document[2])
+        self._size = sum([size for path, size, mtime in documents])
+        for path, size, mtime in documents:
+            if self._size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+REPORT_CACHE = ReportCache(
+    config.get('rent_report_cache_dir') or os.path.join(tempfile.gettempdir(), 'openerp-rent-report-cache'),
+    int(config.get('rent_report_cache_size') or 512) * 1024 * 1024)
+
+def get_report_template(cr, uid, pool, report_name):
+
+    """
+    Returns the hash of the template of the report, or None if the template is not stored in a file.
+    """
+
+    report_pool = pool.get('ir.actions.report.xml')
+    report_ids = report_pool.search(cr, uid, [('report_name', '=', report_name)])
+    if not report_ids:
+        return None
+    report = report_pool.read(cr, uid, report_ids[0], ['report_rml', 'tml_source'])
+    if report.get('tml_source', 'file') != 'file' or not report['report_rml']:
+        return None
+    return REPORT_CACHE.template_hash(report['report_rml'])
+
+def create_report_cached(cr, uid, pool, report_name, model, res_id, render, context=None):
+
+    """
+    Returns the document of the record as a (content, format) tuple : documents of records which can't change
+    anymore (see CACHEABLE_STATES) are read from the cache if possible, the others are rendered by render(), a
+    function without arguments. The user must be allowed to read the record, even if its document is cached.
+    """
+
+    context = context or {}
+    model_pool = pool.get(model)
+    pool.get('ir.model.access').check(cr, uid, model, 'read')
+    model_pool.check_access_rule(cr, uid, [res_id], 'read', context=context)
+
+    key = None
+    if model in CACHEABLE_STATES:
+        table = model_pool._table
+        cr.execute('SELECT state, COALESCE(write_date, create_date) FROM %s WHERE id = %%s' % table, (res_id,))
+        row = cr.fetchone()
+        template_hash = row and row[0] in CACHEABLE_STATES[model] and get_report_template(cr, uid, pool, report_name)
+        if template_hash:
+            key = REPORT_CACHE.make_key(cr.dbname, report_name, res_id, row[1], template_hash, context.get('lang'))
+            for format in ('pdf', 'odt', 'doc', 'xls', 'ods'):
+                content = REPORT_CACHE.get(key, format)
+                if content is not None:
+                    return content, format
+
+    content, format = render()
+
+    if key:
+        try:
+            REPORT_CACHE.set(key, format, content)
+        except (IOError, OSError):
+            _logger.warning('Unable to store the rendered report %s of %s,%d in the cache', report_name, model, res_id)
+
+    return content, format
+
+class CachedAerooReport(Aeroo_report):
+
+    """
+    The report service of the Aeroo reports of the models in CACHEABLE_STATES : the documents printed one by one
+    (from the print button of the form for example) go through the cache, see create_report_cached().
+    """
+
+    def create(self, cr, uid, ids, data, context=None):
+        if len(ids) != 1:
+            return super(CachedAerooReport, self).create(cr, uid, ids, data, context)
+        pool = pooler.get_pool(cr.dbname)
+        render = lambda: super(CachedAerooReport, self).create(cr, uid, ids, data, context)
+        return create_report_cached(cr, uid, pool, self.name[len('report.'):], self.table, ids[0], render, context)
+
+def render_report_cached(cr, uid, pool, report_name, model, res_id, context=None):
+
+    """
+    Renders the report of the record with the report service, and returns a (content, format) tuple. Documents
+    of records which can't change anymore are read from the cache if possible, see create_report_cached().
+    """
+
+    service = netsvc.LocalService('report.%s' % report_name)
+    data = {'model' : model, 'id' : res_id, 'ids' : [res_id], 'report_type' : 'aeroo'}
+    if isinstance(service, CachedAerooReport):
+        return service.create(cr, uid, [res_id], data, context)
+    return create_report_cached(cr, uid, pool, report_name, model, res_id,
+        lambda: service.create(cr, uid, [res_id], data, context), context)
+
+class RenderedReportMixin(object):
+
+    """
+    Adds the get_rendered_reports() method to the inheriting objects.
+    """
+
+    @report_bugs
+    def get_rendered_reports(self, cr, uid, ids, report_name, context=None):
+
+        """
+        Returns the rendered documents of the records, as a dictionary containing the ids as keys and a
+        (base64 content, format) tuple as value. Documents of records which can't change anymore are cached.
+        """
+
+        result = {}
+        for res_id in ids:
+            content, format = render_report_cached(cr, uid, self.pool, report_name, self._name, res_id, context)
+            result[res_id] = (base64.encodestring(content), format)
+        return result
+
+class RentOrderRenderedReports(osv.osv, RenderedReportMixin):
+    _inherit = 'rent.order'
+
+RentOrderRenderedReports()
+
+class InvoiceRenderedReports(osv.osv, RenderedReportMixin):
+    _inherit = 'account.invoice'
+
+InvoiceRenderedReports()
+
+class ReportXmlCache(osv.osv):
+
+    """
+    The Aeroo reports of the models in CACHEABLE_STATES are registered with CachedAerooReport.
+    """
+
+    _inherit = 'ir.actions.report.xml'
+
+    def register_report(self, cr, name, model, tmpl_path, parser):
+        result = super(ReportXmlCache, self).register_report(cr, name, model, tmpl_path, parser)
+        service_name = 'report.%s' % name
+        service = netsvc.Service._services.get(service_name)
+        if model in CACHEABLE_STATES and service is not None and not isinstance(service, CachedAerooReport):
+            del netsvc.Service._services[service_name]
+            CachedAerooReport(cr, service_name, model, tmpl_path, parser=parser)
+        return result
+
+ReportXmlCache()
@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from report import report_sxw
+
+class Parser(report_sxw.rml_parse):
+
+    """
+    The rent order report parser. Templates can use snapshot(o) instead of walking the browse records : the
+    snapshots of all the printed orders are built at once, the first time one of them is used.
+    """
+
+    def __init__(self, cr, uid, name, context):
+        super(Parser, self).__init__(cr, uid, name, context)
+        self.report_context = context or {}
+        self.snapshot_ids = []
+        self.localcontext.update({
+            'snapshots': {},
+            'snapshot': self.snapshot,
+        })
+
+    def set_context(self, objects, data, ids, report_type=None):
+        # Only rent orders have snapshots, the parser can be used by other reports (invoices for example)
+        if objects and objects[0]._table_name == 'rent.order':
+            self.snapshot_ids = [o.id for o in objects]
+        return super(Parser, self).set_context(objects, data, ids, report_type)
+
+    def snapshot(self, order):
+
+        """
+        Returns the snapshot of the order (a browse record or an id), see rent.order.get_report_snapshots().
+        """
+
+        order_id = getattr(order, 'id', order)
+        snapshots = self.localcontext['snapshots']
+        if order_id not in snapshots:
+            ids = [id for id in self.snapshot_ids if id not in snapshots]
+            if order_id not in ids:
+                ids.append(order_id)
+            snapshots.update(self.pool.get('rent.order').get_report_snapshots(
+                self.cr, self.uid, ids, context=self.report_context))
+        return snapshots[order_id]
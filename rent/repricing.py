@@ -0,0 +1,149 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+
+from osv import osv
+from tools.translate import _
+
+from profiling import report_bugs
+from bulk import bulk_update_lines
+
+_logger = logging.getLogger('rent')
+
+# Maximum number of products searched by one query.
+REPRICE_CHUNK_SIZE = 1000
+
+# The states of the orders which can be repriced : the prices of the ongoing orders are already invoiced.
+REPRICE_STATES = ('draft', 'confirmed')
+
+class RentOrderLineRepricing(osv.osv):
+
+    """
+    Repricing of the lines of the existing orders, after the prices of the products (or the rent pricelists) have
+    been modified : the unit prices copied by on_product_changed() are computed again.
+    """
+
+    _inherit = 'rent.order.line'
+
+    def _reprice_read_lines(self, cr, uid, product_ids, states, context=None):
+        # The factor converts the unit price into the price of one product for the duration, like get_prices() :
+        # the product rent price unity is converted into the order one (see product.uom._compute_price).
+        converted = ("CASE WHEN price_unity.id IS NULL OR order_unity.id IS NULL "
+            "OR price_unity.category_id <> order_unity.category_id THEN 1.0 "
+            "ELSE price_unity.factor / order_unity.factor END")
+        factor = self._get_export_rent_price_sql(cr, uid, context=context) % {'price' : converted}
+        query = """
+            SELECT l.id, l.order_id, l.product_id, l.product_type, l.quantity, l.unit_price, COALESCE(l.discount, 0),
+                o.partner_id, o.date_begin_rent, tmpl.list_price,
+                CASE WHEN l.product_type = 'rent' THEN %s ELSE 1.0 END
+            FROM rent_order_line l
+            JOIN rent_order o ON o.id = l.order_id
+            JOIN product_product product ON product.id = l.product_id
+            JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+            LEFT JOIN product_uom price_unity ON price_unity.id = product.rent_price_unity
+            LEFT JOIN product_uom order_unity ON order_unity.id = o.rent_duration_unity
+            WHERE o.state IN %%s %s
+            ORDER BY l.order_id, l.id
+        """
+        if product_ids is None:
+            cr.execute(query % (factor, ''), (tuple(states),))
+            return cr.fetchall()
+        lines = []
+        for index in range(0, len(product_ids), REPRICE_CHUNK_SIZE):
+            cr.execute(query % (factor, 'AND l.product_id IN %s'),
+                (tuple(states), tuple(product_ids[index:index+REPRICE_CHUNK_SIZE])))
+            lines.extend(cr.fetchall())
+        return lines
+
+    @report_bugs
+    def reprice_lines(self, cr, uid, product_ids=None, states=('draft',), dry_run=False, context=None):
+
+        """
+        Computes again the unit prices of the lines of the orders in the specified states, using the products
+        prices and the rent pricelists of the customers (see rent.pricelist.get_rent_prices). If product_ids is
+        specified, only the lines of these products are repriced. The modified lines are updated by chunks, and the
+        totals of each modified order are computed once. Returns a dictionary with these keys :
+
+            lines : The number of modified lines
+            difference : The difference of the untaxed amount of the modified orders (before the global discount)
+            orders : A list of dictionaries with the 'id' and the 'difference' of each modified order
+
+        If dry_run is True, nothing is modified, only the result is computed.
+        """
+
+        if isinstance(product_ids, (int, long)):
+            product_ids = [product_ids]
+        if set(states) - set(REPRICE_STATES):
+            raise osv.except_osv(_('Error'), _('Only the draft and confirmed rent orders can be repriced.'))
+        # The lines are updated in SQL, the access rights are checked here
+        self.pool.get('ir.model.access').check(cr, uid, self._name, dry_run and 'read' or 'write')
+
+        pricelist_pool = self.pool.get('rent.pricelist')
+        lines = product_ids != [] and self._reprice_read_lines(cr, uid, product_ids, states, context=context) or []
+
+        pricelists = pricelist_pool.get_partner_pricelists(cr, uid, [line[7] for line in lines], context=context)
+        rent_lines = [line for line in lines if line[3] == 'rent']
+        rent_prices = dict(zip([line[0] for line in rent_lines], pricelist_pool.get_rent_prices(cr, uid,
+            [(pricelists.get(line[7]), line[2], line[4], line[8]) for line in rent_lines], context=context)))
+
+        updates = []
+        differences = {}
+        for line_id, order_id, product_id, product_type, quantity, unit_price, discount, partner_id, date_begin, \
+            list_price, factor in lines:
+            new_price = rent_prices[line_id] if product_type == 'rent' else list_price
+            if not new_price or new_price <= 0:
+                _logger.warning('The rent order line %d has not been repriced: the price of the product %d is not '
+                    'positive.', line_id, product_id)
+                continue
+            if abs(new_price - unit_price) < 1e-9:
+                continue
+            updates.append((line_id, new_price))
+            differences[order_id] = differences.get(order_id, 0.0) + \
+                (new_price - unit_price) * factor * (1 - discount / 100.0) * quantity
+
+        if not dry_run:
+            bulk_update_lines(cr, uid, self.pool, 'unit_price', 'float', updates, differences.keys(), context=context)
+
+        result = {
+            'lines' : len(updates),
+            'difference' : sum(differences.values()),
+            'orders' : [{'id' : order_id, 'difference' : difference}
+                for order_id, difference in sorted(differences.items())],
+        }
+        _logger.info('%s %d rent order lines of %d orders, the difference is %.2f',
+            dry_run and 'Would reprice' or 'Repriced', result['lines'], len(differences), result['difference'])
+        return result
+
+RentOrderLineRepricing()
+
+class ProductRepricing(osv.osv):
+
+    _inherit = 'product.product'
+
+    @report_bugs
+    def reprice_rent_orders(self, cr, uid, ids, dry_run=False, context=None):
+
+        """
+        Reprices the lines of the draft rent orders using these products, see rent.order.line.reprice_lines().
+        """
+
+        return self.pool.get('rent.order.line').reprice_lines(cr, uid, ids, dry_run=dry_run, context=context)
+
+ProductRepricing()
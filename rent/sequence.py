@@ -0,0 +1,173 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+import logging
+import threading
+
+import psycopg2
+import pooler
+
+from osv import osv
+from tools import config
+
+_logger = logging.getLogger('rent')
+
+class ReferenceBlock(object):
+
+    def __init__(self, sequence_id, next, end, increment, prefix, suffix, padding):
+        self.sequence_id = sequence_id
+        self.next = next
+        self.end = end
+        self.increment = increment
+        self.prefix = prefix
+        self.suffix = suffix
+        self.padding = padding
+
+class ReferenceAllocator(object):
+
+    """
+    Allocates the numbers of a sequence by blocks : a block of numbers is reserved on the ir_sequence row in a
+    separate transaction, which is committed at once, and the numbers are then given locally by this process.
+    The sequence row is locked once per block instead of once per number, and the numbers of a block can't be
+    given twice, even if the transaction which uses them is rolled back.
+
+    The numbers left in the blocks are lost when the server is stopped, so references can have gaps (as with
+    the standard sequences when a transaction is rolled back). The size of the blocks can be set with the
+    'rent_reference_block_size' option of the server configuration file.
+
+    The blocks are reserved without holding the lock of the allocator, and the sequence row is locked with NOWAIT :
+    if it's locked by another transaction (which may wait for this allocator), the number is taken from the
+    sequence by the transaction of the caller, like ir.sequence.get does.
+    """
+
+    # Number of attempts to lock the sequence row, and delay between them (in seconds).
+    RESERVE_ATTEMPTS = 3
+    RESERVE_DELAY = 0.05
+
+    def __init__(self, block_size=20):
+        self.block_size = block_size
+        self.blocks = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, dbname):
+        self._lock.acquire()
+        try:
+            for key in [key for key in self.blocks if key[0] == dbname]:
+                del self.blocks[key]
+        finally:
+            self._lock.release()
+
+    def _reserve(self, dbname, code, company_ids):
+        # Returns the reserved block, None if there is no such sequence, or False if the sequence row is locked
+        cr = pooler.get_db(dbname).cursor()
+        try:
+            for attempt in range(self.RESERVE_ATTEMPTS):
+                try:
+                    cr.execute("""
+                        SELECT id, number_next, number_increment, prefix, suffix, padding FROM ir_sequence
+                        WHERE code = %s AND active = true AND (company_id IN %s OR company_id IS NULL)
+                        ORDER BY company_id, id LIMIT 1 FOR UPDATE NOWAIT
+                    """, (code, tuple(company_ids) or (0,)))
+                    break
+                except psycopg2.OperationalError:
+                    cr.rollback()
+                    time.sleep(self.RESERVE_DELAY * (attempt + 1))
+            else:
+                return False
+            row = cr.fetchone()
+            if not row:
+                return None
+            sequence_id, number_next, increment, prefix, suffix, padding = row
+            increment = increment or 1
+            cr.execute('UPDATE ir_sequence SET number_next = number_next + %s WHERE id = %s',
+                (increment * self.block_size, sequence_id))
+            cr.commit()
+        finally:
+            cr.close()
+        return ReferenceBlock(sequence_id, number_next, number_next + increment * self.block_size, increment,
+            prefix or '', suffix or '', padding or 0)
+
+    def _take(self, key):
+        # Returns the next number of the block of the key and the block, or (None, None) if it's exhausted
+        self._lock.acquire()
+        try:
+            block = self.blocks.get(key)
+            if block is None or block.next >= block.end:
+                return None, None
+            number = block.next
+            block.next += block.increment
+            return number, block
+        finally:
+            self._lock.release()
+
+    def get(self, cr, uid, code, context=None):
+
+        """
+        Returns the next reference of the sequence, or False if there is no such sequence.
+        """
+
+        pool = pooler.get_pool(cr.dbname)
+        company_ids = pool.get('res.company').search(cr, uid, [], context=context)
+        key = (cr.dbname, code, tuple(sorted(company_ids)))
+
+        number, block = self._take(key)
+        if block is None:
+            reserved = self._reserve(cr.dbname, code, company_ids)
+            if reserved is None:
+                return False
+            if reserved is False:
+                _logger.debug('The sequence %s is locked, the reference is taken from the sequence', code)
+                return pool.get('ir.sequence').get(cr, uid, code)
+            _logger.debug('Reserved the numbers %d to %d of the sequence %s', reserved.next, reserved.end - 1, code)
+            # Another thread may have installed a block meanwhile : its numbers are used first, the reserved ones
+            # are lost
+            self._lock.acquire()
+            try:
+                block = self.blocks.get(key)
+                if block is None or block.next >= block.end:
+                    block = self.blocks[key] = reserved
+                number = block.next
+                block.next += block.increment
+            finally:
+                self._lock.release()
+
+        sequence_pool = pool.get('ir.sequence')
+        return sequence_pool._process(block.prefix) + '%%0%sd' % block.padding % number + \
+            sequence_pool._process(block.suffix)
+
+REFERENCE_ALLOCATOR = ReferenceAllocator(int(config.get('rent_reference_block_size') or 20))
+
+class Sequence(osv.osv):
+
+    """
+    The reserved blocks are dropped when a sequence is modified, so a new number_next is used at once.
+    """
+
+    _inherit = 'ir.sequence'
+
+    def write(self, cr, uid, ids, vals, context=None):
+        REFERENCE_ALLOCATOR.invalidate(cr.dbname)
+        return super(Sequence, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        REFERENCE_ALLOCATOR.invalidate(cr.dbname)
+        return super(Sequence, self).unlink(cr, uid, ids, context=context)
+
+Sequence()
@@ -0,0 +1,79 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - A rent module for OpenERP 6
+# Copyright (C) 2010-Today Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+
+from osv import osv
+from tools.translate import _
+
+from profiling import report_bugs
+
+_logger = logging.getLogger('rent')
+
+# The set-based validators, as (model, constraint method, validator method) tuples. The validators return the ids
+# of the records which violate the constraint, see rent.order.get_invalid_period_and_unity_ids() for example.
+SET_VALIDATORS = [
+    ('rent.order', 'check_period_and_unity', 'get_invalid_period_and_unity_ids'),
+    ('rent.order.line', 'check_product_type', 'get_invalid_product_type_ids'),
+    ('product.product', 'check_rent_price', 'get_invalid_rent_price_ids'),
+]
+
+class RentValidation(osv.osv):
+
+    """
+    Audit of the rent constraints on the whole database. Each constraint is checked with one query, so it can
+    be used on big databases, for example after an import done in SQL or a migration.
+    """
+
+    def _get_constraint_message(self, model, method):
+        for constraint in model._constraints:
+            if constraint[0].__name__ == method:
+                return constraint[1]
+        return method
+
+    @report_bugs
+    def validate_all(self, cr, uid, context=None):
+
+        """
+        Returns the violations of the rent constraints, as a list of dictionaries with the keys 'model', 'ids'
+        and 'message' (the message of the constraint). An empty list means that the database is valid.
+        """
+
+        access_pool = self.pool.get('ir.model.access')
+        result = []
+
+        for model_name, method, validator in SET_VALIDATORS:
+            access_pool.check(cr, uid, model_name, 'read')
+            model = self.pool.get(model_name)
+            ids = getattr(model, validator)(cr, uid, context=context)
+            if ids:
+                message = _(self._get_constraint_message(model, method))
+                _logger.warning('%d records of %s are not valid: %s', len(ids), model_name, message)
+                result.append({
+                    'model' : model_name,
+                    'ids' : ids,
+                    'message' : message,
+                })
+
+        return result
+
+    _name = 'rent.validation'
+    _auto = False
+
+RentValidation()
@@ -18,3 +18,4 @@
 #
 
 from . import rent
+from . import coeff
@@ -30,7 +30,8 @@
     "depends": ["rent", "report_aeroo_ooo"],
     "init_xml": [],
     "demo_xml": [],
-    "update_xml": ['views/rent.xml', 'reports/reports.xml'],
+    "update_xml": ['views/rent.xml', 'views/coeff.xml', 'reports/reports.xml', 'data/coeffs.xml',
+                   'security/ir.model.access.csv'],
     "active": False,
     "test": [],
     "installable": True
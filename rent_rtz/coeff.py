@@ -0,0 +1,289 @@
+# -*- encoding: utf-8 -*-
+#
+# OpenERP Rent - Extention for Rtz Evènement
+# Copyright (C) 2010-2011 Thibaut DIRLIK <thibaut.dirlik@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+
+import bisect
+import logging
+
+from openlib.orm import *
+from rent.profiling import report_bugs
+from rent.bulk import bulk_update_lines
+from rent.cache import RegistryCache
+
+from osv import osv, fields
+
+_logger = logging.getLogger('rent')
+
+# The compiled coefficients tables of each database. The timeout lets the servers sharing a database see the
+# modifications done by the others.
+COEFFS_CACHE = RegistryCache(timeout=300)
+
+MODES = (
+    ('step', 'Step (coefficient of the previous duration)'),
+    ('linear', 'Linear interpolation between durations'),
+)
+
+class CompiledCoeffTable(object):
+
+    """
+    The in-memory form of a coefficients table : durations are sorted, and the coefficient of a duration is found
+    with a binary search.
+    """
+
+    def __init__(self, table_id, mode, more, coeffs):
+        coeffs = sorted(coeffs)
+        self.table_id = table_id
+        self.mode = mode
+        self.more = more
+        self.durations = [duration for duration, coeff in coeffs]
+        self.coeffs = [coeff for duration, coeff in coeffs]
+
+    def get(self, duration):
+
+        """
+        Returns the coefficient of a duration in days. Durations longer than the last one use the 'more' coefficient,
+        durations shorter than the first one use the first coefficient.
+        """
+
+        if not self.durations or duration > self.durations[-1]:
+            return self.more
+        index = bisect.bisect_right(self.durations, duration) - 1
+        if index < 0:
+            return self.coeffs[0]
+        if self.mode == 'linear' and self.durations[index] != duration:
+            # The duration is between two breakpoints (it can't be after the last one)
+            low, high = self.durations[index], self.durations[index+1]
+            ratio = float(duration - low) / (high - low)
+            return self.coeffs[index] + (self.coeffs[index+1] - self.coeffs[index]) * ratio
+        return self.coeffs[index]
+
+class CompiledCoeffs(object):
+
+    """
+    All the compiled tables of a database, with an index to find the table of a (company, product category).
+    """
+
+    def __init__(self, tables, selectors):
+        self.tables = tables
+        self.selectors = selectors
+
+    def get_table(self, company_id=False, categ_id=False):
+
+        """
+        Returns the table of the category and the company. The most specific table is used : category and company,
+        then category only, then company only, then the tables without company and category.
+        """
+
+        for key in ((company_id, categ_id), (False, categ_id), (company_id, False), (False, False)):
+            if key in self.selectors:
+                return self.tables[self.selectors[key]]
+        return None
+
+    def get(self, duration, company_id=False, categ_id=False):
+        table = self.get_table(company_id, categ_id)
+        return table and table.get(duration) or 1.0
+
+class RentCoeffTable(osv.osv, ExtendedOsv):
+
+    """
+    A coefficients table gives the coefficient applied to the rent price of a product, depending of the rent duration
+    in days. The 'more' coefficient is used for longer durations, or for durations which are not expressed in days.
+
+    A table can be restricted to a product category and/or a company. Between two durations of the table, the
+    coefficient is the one of the previous duration (step), or interpolated (linear).
+    """
+
+    def __init__(self, pool, cr):
+        COEFFS_CACHE.invalidate(cr.dbname)
+        super(RentCoeffTable, self).__init__(pool, cr)
+
+    @report_bugs
+    def get_compiled_coeffs(self, cr, uid, context=None):
+
+        """
+        Returns the CompiledCoeffs of the database. The tables are read once, and kept in memory until one of them
+        is modified, or for 5 minutes.
+        """
+
+        compiled = COEFFS_CACHE.get(cr.dbname, 'coeffs')
+        if compiled is not None:
+            return compiled
+
+        cr.execute('SELECT id, mode, more_coeff, company_id, categ_id FROM rent_rtz_coeff_table ORDER BY sequence, id')
+        tables_rows = cr.fetchall()
+        cr.execute('SELECT table_id, duration, coeff FROM rent_rtz_coeff')
+        coeffs = {}
+        for table_id, duration, coeff in cr.fetchall():
+            coeffs.setdefault(table_id, []).append((duration, coeff))
+
+        tables, selectors = {}, {}
+        for table_id, mode, more, company_id, categ_id in tables_rows:
+            table = CompiledCoeffTable(table_id, mode or 'step', more, coeffs.get(table_id, []))
+            if sorted(table.coeffs) != table.coeffs:
+                _logger.warning('The rent coefficients table %d is not increasing with the duration.', table_id)
+            tables[table_id] = table
+            # The first table (by sequence) of each (company, category) is used
+            selectors.setdefault((company_id or False, categ_id or False), table_id)
+
+        compiled = CompiledCoeffs(tables, selectors)
+        COEFFS_CACHE.set(cr.dbname, 'coeffs', compiled)
+        return compiled
+
+    @report_bugs
+    def get_coefficients(self, cr, uid, context=None):
+
+        """
+        Returns the coefficients of the default table (without company and category) as a dictionary with these keys :
+
+            durations : A dictionary containing durations (in days) as keys, and coefficients as values
+            more : The coefficient of longer durations
+        """
+
+        table = self.get_compiled_coeffs(cr, uid, context=context).get_table()
+        if not table:
+            return {'durations' : {}, 'more' : 1.0}
+        return {'durations' : dict(zip(table.durations, table.coeffs)), 'more' : table.more}
+
+    @report_bugs
+    def reprice_draft_orders(self, cr, uid, ids=None, context=None):
+
+        """
+        Recomputes the coefficient of the rented lines of the draft rent orders, after a coefficients table has been
+        modified. If ids is specified, only the lines using one of these tables are updated. The lines are updated
+        by chunks, and the totals of each modified order are computed once. Returns the number of updated lines.
+        """
+
+        line_pool = self.pool.get('rent.order.line')
+        # The lines are updated in SQL, the access rights are checked here
+        self.pool.get('ir.model.access').check(cr, uid, line_pool._name, 'write')
+        compiled = self.get_compiled_coeffs(cr, uid, context=context)
+        day_unity_id = line_pool.get_day_unity_id(cr, uid, context=context)
+
+        cr.execute("""
+            SELECT line.id, line.coeff, o.id, o.rent_duration, o.rent_duration_unity, s.company_id, tmpl.categ_id
+            FROM rent_order_line line
+            JOIN rent_order o ON o.id = line.order_id
+            JOIN sale_shop s ON s.id = o.shop_id
+            JOIN product_product product ON product.id = line.product_id
+            JOIN product_template tmpl ON tmpl.id = product.product_tmpl_id
+            WHERE o.state = 'draft' AND line.product_type = 'rent'
+        """)
+
+        updates = []
+        order_ids = set()
+        for line_id, coeff, order_id, duration, unity_id, company_id, categ_id in cr.fetchall():
+            table = compiled.get_table(company_id, categ_id)
+            if not table or (ids and table.table_id not in ids):
+                continue
+            new_coeff = table.get(duration) if unity_id == day_unity_id else table.more
+            if abs(new_coeff - coeff) > 1e-9:
+                updates.append((line_id, new_coeff))
+                order_ids.add(order_id)
+
+        bulk_update_lines(cr, uid, self.pool, 'coeff', 'float', updates, order_ids, context=context)
+
+        _logger.info('Repriced %d rent order lines of %d draft orders', len(updates), len(order_ids))
+        return len(updates)
+
+    def create(self, cr, uid, vals, context=None):
+        COEFFS_CACHE.invalidate(cr.dbname)
+        return super(RentCoeffTable, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        COEFFS_CACHE.invalidate(cr.dbname)
+        return super(RentCoeffTable, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        COEFFS_CACHE.invalidate(cr.dbname)
+        return super(RentCoeffTable, self).unlink(cr, uid, ids, context=context)
+
+    @report_bugs
+    def on_reprice_clicked(self, cr, uid, ids, context=None):
+
+        """
+        Called when the user clicks on 'Reprice draft orders'.
+        """
+
+        self.reprice_draft_orders(cr, uid, ids, context=context)
+        return True
+
+    _name = 'rent.rtz.coeff.table'
+    _order = 'sequence, id'
+
+    _columns = {
+        'name' : fields.char('Name', size=64, required=True),
+        'sequence' : fields.integer('Sequence', help='The first matching table is used.'),
+        'company_id' : fields.many2one('res.company', 'Company', ondelete='CASCADE', help=
+            'If set, this table is only used for the rent orders of this company.'),
+        'categ_id' : fields.many2one('product.category', 'Product Category', ondelete='CASCADE', help=
+            'If set, this table is only used for the products of this category.'),
+        'mode' : fields.selection(MODES, 'Mode', required=True, help=
+            'How the coefficient of a duration which is not in the table is computed.'),
+        'more_coeff' : fields.float('Longer durations coefficient', required=True, help=
+            'The coefficient used for durations longer than the table ones, or not expressed in days.'),
+        'line_ids' : fields.one2many('rent.rtz.coeff', 'table_id', 'Coefficients'),
+    }
+
+    _defaults = {
+        'sequence' : 10,
+        'mode' : 'step',
+        'more_coeff' : 1.0,
+    }
+
+    _sql_constraints = [
+        ('valid_more_coeff', 'check(more_coeff > 0)', 'The coefficient must be superior to 0.'),
+    ]
+
+RentCoeffTable()
+
+class RentCoeff(osv.osv):
+
+    """
+    The coefficient of a duration (in days) in a coefficients table.
+    """
+
+    def create(self, cr, uid, vals, context=None):
+        COEFFS_CACHE.invalidate(cr.dbname)
+        return super(RentCoeff, self).create(cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        COEFFS_CACHE.invalidate(cr.dbname)
+        return super(RentCoeff, self).write(cr, uid, ids, vals, context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        COEFFS_CACHE.invalidate(cr.dbname)
+        return super(RentCoeff, self).unlink(cr, uid, ids, context=context)
+
+    _name = 'rent.rtz.coeff'
+    _order = 'duration'
+    _rec_name = 'duration'
+
+    _columns = {
+        'table_id' : fields.many2one('rent.rtz.coeff.table', 'Table', required=True, ondelete='CASCADE'),
+        'duration' : fields.integer('Duration (days)', required=True),
+        'coeff' : fields.float('Coefficient', required=True),
+    }
+
+    _sql_constraints = [
+        ('duration_uniq', 'unique(table_id, duration)', 'A duration can be defined only once in a table.'),
+        ('valid_coeff', 'check(coeff > 0)', 'The coefficient must be superior to 0.'),
+    ]
+
+RentCoeff()
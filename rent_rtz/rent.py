@@ -17,46 +17,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from __future__ import absolute_import
+
 from openlib.orm import *
 from openlib.tools import *
-from openlib.github import report_bugs
+from rent.profiling import report_bugs
+from rent.cache import RegistryCache
 
 from osv import osv, fields
 from tools.translate import _
 
-COEFF_MAPPING = {
-    1 : 1,
-    2 : 1.5,
-    3 : 2,
-    4 : 2.3,
-    5 : 2.5,
-    6 : 3,
-    7 : 3.5,
-    8 : 3.3,
-    9 : 3.8,
-    10 : 4.1,
-    11 : 4.4,
-    12 : 4.,
-    13 : 4.8,
-    14 : 5,
-    15 : 5.2,
-    16 : 5.5,
-    17 : 5.7,
-    18 : 6,
-    19 : 6.2,
-    20 : 6.5,
-    21 : 6.8,
-    22 : 7,
-    23 : 7.2,
-    24 : 7.5,
-    25 : 7.8,
-    26 : 8,
-    27 : 8.2,
-    28 : 8.4,
-    29 : 8.6,
-    30 : 8.8,
-    'more' : 9,
-}
+# The id of the Day UoM of each database. The registry is reloaded when a module is updated, which clears this
+# cache (see RentOrderRtzLine.__init__), and the timeout lets the other servers sharing the database see it.
+DAY_UNITY_CACHE = RegistryCache(timeout=300)
 
 class RentOrderRtz(osv.osv, ExtendedOsv):
 
@@ -105,24 +78,108 @@ class RentOrderRtzLine(osv.osv, ExtendedOsv):
 
         return duration_unit_price * line.coeff
 
+    def _get_export_rent_price_sql(self, cr, uid, context=None):
+        # Same as get_rent_price() : the coefficient replaces the duration
+        return '(%(price)s) * l.coeff'
+
+    def _get_report_fields(self, cr, uid, context=None):
+        return super(RentOrderRtzLine, self)._get_report_fields(cr, uid, context=context) + ['coeff']
+
+    def __init__(self, pool, cr):
+        DAY_UNITY_CACHE.invalidate(cr.dbname)
+        super(RentOrderRtzLine, self).__init__(pool, cr)
+
+    @report_bugs
+    def get_day_unity_id(self, cursor, user_id, context=None):
+
+        """
+        Returns the id of the Day UoM (rent.uom_day). The xml id is resolved once.
+        """
+
+        unity_id = DAY_UNITY_CACHE.get(cursor.dbname, 'uom_day')
+        if unity_id is None:
+            unity_id = self.pool.get('ir.model.data').get_object_reference(cursor, user_id, 'rent', 'uom_day')[1]
+            DAY_UNITY_CACHE.set(cursor.dbname, 'uom_day', unity_id)
+        return unity_id
+
+    @report_bugs
+    def get_coeff(self, cursor, user_id, duration, duration_unity_id, product_id=False, context=None):
+
+        """
+        Returns the coefficient of a rent duration, using the coefficients table of the product category and the
+        company of the order : the company of the shop specified by the 'shop_id' key of the context (set by the
+        order form), or the company of the user if it's missing.
+        """
+
+        compiled = self.pool.get('rent.rtz.coeff.table').get_compiled_coeffs(cursor, user_id, context=context)
+        company_id = False
+        if context and context.get('shop_id'):
+            company_id = self.pool.get('sale.shop').read(cursor, user_id, context['shop_id'],
+                ['company_id'])['company_id']
+        if not company_id:
+            company_id = self.pool.get('res.users').read(cursor, user_id, user_id, ['company_id'])['company_id']
+        categ_id = False
+        if product_id:
+            categ_id = self.pool.get('product.product').read(cursor, user_id, product_id, ['categ_id'])['categ_id']
+        table = compiled.get_table(company_id and company_id[0], categ_id and categ_id[0])
+        if not table:
+            return 1.0
+        # We check that the duration unity is days, because Rtz only rent for days. If it rent for anything
+        # else that a day, we set the bigger coeff by default.
+        if duration_unity_id != self.get_day_unity_id(cursor, user_id, context=context):
+            return table.more
+        return table.get(duration)
+
     @report_bugs
     def get_default_coeff(self, cursor, user_id, context=None):
         if context is None:
             context = {}
         if not 'duration' in context:
             return 1
-        else:
-            if context['duration'] in COEFF_MAPPING:
-                # We check that the duration unity is days, because Rtz only rent for days. If it rent for anything
-                # else that a day, we set the bigger coeff by default.
-                duration_unity_id = context['duration_unity']
-                duration_unity_xmlid = self.pool.get('product.uom').get_xml_id(
-                    cursor, user_id, [duration_unity_id], context=context)
-                duration_unity_xmlid = duration_unity_xmlid[duration_unity_id]
-                if not duration_unity_xmlid or duration_unity_xmlid != 'rent.uom_day':
-                    return COEFF_MAPPING['more']
-                return COEFF_MAPPING[context['duration']]
-        return COEFF_MAPPING['more']
+        return self.get_coeff(cursor, user_id, context['duration'], context.get('duration_unity'), context=context)
+
+    @report_bugs
+    def on_product_changed(self, cr, uid, ids, product_id, quantity, context=None):
+
+        """
+        The coefficient depends of the product category.
+        """
+
+        result = super(RentOrderRtzLine, self).on_product_changed(cr, uid, ids, product_id, quantity, context)
+        if product_id and context and 'duration' in context:
+            result['value']['coeff'] = self.get_coeff(
+                cr, uid, context['duration'], context.get('duration_unity'), product_id, context=context)
+        return result
+
+    def _prepare_bulk_lines(self, cr, uid, orders, context=None):
+
+        """
+        The coefficient of the bulk created lines is computed from the order company and the product category,
+        unless it's specified.
+        """
+
+        super(RentOrderRtzLine, self)._prepare_bulk_lines(cr, uid, orders, context=context)
+
+        product_ids = list(set([line['product_id'] for order in orders for line in order.get('lines', [])
+            if 'coeff' not in line]))
+        if not product_ids:
+            return
+        categs = dict((product['id'], product['categ_id'] and product['categ_id'][0]) for product in
+            self.pool.get('product.product').read(cr, uid, product_ids, ['categ_id'], context=context))
+        compiled = self.pool.get('rent.rtz.coeff.table').get_compiled_coeffs(cr, uid, context=context)
+        day_unity_id = self.get_day_unity_id(cr, uid, context=context)
+
+        for order in orders:
+            for line in order.get('lines', []):
+                if 'coeff' in line:
+                    continue
+                table = compiled.get_table(order.get('company_id') or False, categs.get(line['product_id']) or False)
+                if not table:
+                    line['coeff'] = 1.0
+                elif order['rent_duration_unity'] != day_unity_id:
+                    line['coeff'] = table.more
+                else:
+                    line['coeff'] = table.get(order['rent_duration'])
 
     @report_bugs
     def get_invoice_lines_data(self, cr, uid, ids, line_price_factor, first_invoice=False, context=None):
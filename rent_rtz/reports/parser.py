@@ -17,24 +17,149 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from __future__ import absolute_import
+
 from datetime import datetime
-from report import report_sxw
-from tools.misc import DEFAULT_SERVER_DATETIME_FORMAT
+from tools.misc import DEFAULT_SERVER_DATETIME_FORMAT, DEFAULT_SERVER_DATE_FORMAT
+
+from rent.reports.parser import Parser as RentOrderParser
+
+def parse_server_datetime(value):
+
+    """
+    Parses a datetime or a date in the server format ('2011-01-31 18:00:00' or '2011-01-31') and returns a datetime
+    object. The fields are read at fixed positions, which is a lot faster than datetime.strptime().
+    """
+
+    try:
+        if len(value) == 19 and value[4] == '-' and value[7] == '-' and value[10] == ' ':
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        if len(value) == 10 and value[4] == '-' and value[7] == '-':
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    except ValueError:
+        pass
+    # Unusual values (with microseconds for example) use the slow path
+    try:
+        return datetime.strptime(value[:19], DEFAULT_SERVER_DATETIME_FORMAT)
+    except ValueError:
+        return datetime.strptime(value[:10], DEFAULT_SERVER_DATE_FORMAT)
+
+class FormatCache(object):
+
+    """
+    Keeps the most recently used formatted values. Values are stored in a 'recent' generation, which becomes the
+    'old' generation once it's full : old values used again are moved back to the recent generation, the others are
+    dropped at the next rotation. This is an approximation of a LRU cache which costs one dictionary lookup.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.recent = {}
+        self.old = {}
 
-class Parser(report_sxw.rml_parse):
+    def get(self, key):
+        value = self.recent.get(key)
+        if value is None:
+            value = self.old.get(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if len(self.recent) >= self.size:
+            self.old = self.recent
+            self.recent = {}
+        self.recent[key] = value
+
+class Parser(RentOrderParser):
+
+    """
+    The rent order parser (see rent.reports.parser), with the formatting functions of the Rtz templates.
+    """
 
     def __init__(self, cr, uid, name, context):
         super(Parser, self).__init__(cr, uid, name, context)
+        self.format_cache = FormatCache()
+        self.currency_symbols = {}
         self.localcontext.update({
+            'format_date': self.format_date,
             'format_datetime': self.format_datetime,
+            'format_period': self.format_period,
+            'format_currency': self.format_currency,
         })
 
-    def format_datetime(self, value):
+    def format_date(self, value, format='%d/%m/%y'):
+
+        """
+        Format a date or a datetime (server format) into a date only string. Empty values give an empty string.
+        """
+
+        if not value:
+            return ''
+        key = ('date', value, format)
+        result = self.format_cache.get(key)
+        if result is None:
+            result = parse_server_datetime(value).strftime(format)
+            self.format_cache.set(key, result)
+        return result
+
+    def format_datetime(self, value, format='%d/%m/%y'):
 
         """
         Format the datetime into a date only string.
         """
 
-        datetime_object = datetime.strptime(value, DEFAULT_SERVER_DATETIME_FORMAT)
+        return self.format_date(value, format)
+
+    def format_period(self, begin, end, format='%d/%m/%y'):
+
+        """
+        Format a period into a 'begin - end' string, or only one date if begin and end are the same day.
+        """
+
+        begin, end = self.format_date(begin, format), self.format_date(end, format)
+        if not end or begin == end:
+            return begin
+        return '%s - %s' % (begin, end)
+
+    def get_currency_symbol(self, document=None):
+
+        """
+        Returns the currency symbol of the document : a browse record (its currency, or the currency of its company)
+        or a snapshot of a rent order. The default document is the first printed object.
+        """
+
+        if document is None:
+            objects = self.localcontext.get('objects') or []
+            document = objects and objects[0] or None
+        if isinstance(document, dict):
+            return document.get('company', {}).get('currency_symbol') or ''
+        key = document is not None and (document._table_name, document.id) or None
+        if key not in self.currency_symbols:
+            currency = None
+            if document is not None and 'currency_id' in document._table._columns:
+                currency = document.currency_id
+            elif document is not None and 'company_id' in document._table._columns and document.company_id:
+                currency = document.company_id.currency_id
+            if not currency:
+                user = self.pool.get('res.users').browse(self.cr, self.uid, self.uid)
+                currency = user.company_id.currency_id
+            self.currency_symbols[key] = currency and currency.symbol or ''
+        return self.currency_symbols[key]
+
+    def format_currency(self, amount, digits=2, symbol=None, document=None):
+
+        """
+        Format an amount in the lang of the report, followed by the currency symbol (the currency of the document by
+        default, see get_currency_symbol).
+        """
 
-        return datetime_object.strftime('%d/%m/%y')
\ No newline at end of file
+        if symbol is None:
+            symbol = self.get_currency_symbol(document)
+        key = ('currency', self.localcontext.get('lang'), amount, digits, symbol)
+        result = self.format_cache.get(key)
+        if result is None:
+            result = ('%s %s' % (self.formatLang(amount or 0.0, digits=digits), symbol)).strip()
+            self.format_cache.set(key, result)
+        return result